@@ -203,4 +203,139 @@ class TraceProperties:
         return self.get_max_amp() / self.get_SD()
 
     def get_RLI(self):
-        return self.rli
\ No newline at end of file
+        return self.rli
+
+class MapProperties:
+    def __init__(self, traces, start, width, int_pts, per_amp=0.5, rli=1.0):
+        """
+        TraceProperties for every trace of an array at once, e.g. a height * width * points map.
+        Applies the same rules (PhotoZ Data.cpp:measureProperties and getSD) with whole-array operations;
+        every getter returns an array shaped like traces without its last (time) axis.
+
+        Parameters
+        ----------
+        traces : np.ndarray
+            Array of processed data with time on the last axis.
+        start, width, int_pts, per_amp :
+            As for TraceProperties.
+        rli : float or np.ndarray
+            RLI value(s), broadcast to the map shape (default: 1.0).
+        """
+        self.traces = np.asarray(traces)
+        self.map_shape = self.traces.shape[:-1]
+        self.start = start
+        self.width = width
+
+        # truncate width if start + width exceeds data length
+        num_pts = self.traces.shape[-1]
+        if self.start + self.width > num_pts:
+            self.width = num_pts - self.start - 1
+        self.int_pts = int_pts
+        self.per_amp = per_amp
+        self.rli = np.broadcast_to(rli, self.map_shape)
+
+        # Outputs
+        self.max_amp = None
+        self.max_amp_latency = None
+        self.half_amp_latency = None
+        self.max_amp_latency_pt = None
+        self.half_amp_latency_decay = None
+        self.half_width = None
+        self.sd = None
+
+        # Run calculations
+        self.measure_properties()
+
+    def measure_properties(self):
+        """ Vectorized TraceProperties.measure_properties. Each search loop there stops at the
+            first point meeting its condition; here that is the first True along the time axis. """
+        num_pts = self.traces.shape[-1]
+        X = self.traces.reshape(-1, num_pts)
+        rows = np.arange(X.shape[0])
+        start, end = self.start, self.start + self.width
+
+        #-------------------------------------------------------
+        # 1. Max Amp: first maximum in [start, end], if positive
+        # 2. Max Amp Latency: else end
+        window = X[:, start:min(end + 1, num_pts)].astype(np.float64)
+        i_max = np.argmax(window, axis=1)
+        window_max = window[rows, i_max]
+        is_positive = window_max > 0.0
+        max_amp = np.where(is_positive, window_max, 0.0)
+        max_amp_latency = np.where(is_positive, start + i_max, end)
+
+        #-------------------------------------------------------
+        # 3. Half Amp Latency: first point in [start, max amp latency] reaching half amp, interpolated
+        half_amp = max_amp * self.per_amp
+        index = np.arange(start, min(end + 1, num_pts))
+        rising = (window >= half_amp[:, np.newaxis]) \
+            & (index[np.newaxis, :] <= max_amp_latency[:, np.newaxis])
+        is_found = rising.any(axis=1)
+        i_rise = start + np.argmax(rising, axis=1)
+        half_amp_latency = self._interpolate(X, rows, i_rise, X[rows, i_rise].astype(np.float64) - half_amp)
+        half_amp_latency[i_rise == start] = start
+        half_amp_latency[~is_found] = start
+
+        # 4. Half Width = t(Decay to half amp) - t(Rise to half amp)
+        # first point in (max amp latency, end] below half amp, interpolated
+        falling = (window < half_amp[:, np.newaxis]) \
+            & (index[np.newaxis, :] > max_amp_latency[:, np.newaxis])
+        is_found = falling.any(axis=1)
+        i_fall = start + np.argmax(falling, axis=1)
+        half_amp_latency_decay = self._interpolate(X, rows, i_fall, half_amp - X[rows, i_fall].astype(np.float64))
+        half_amp_latency_decay[i_fall == max_amp_latency + 1] = i_fall[i_fall == max_amp_latency + 1]
+        half_amp_latency_decay[~is_found] = start
+        half_width = half_amp_latency_decay - half_amp_latency
+        half_width[half_width < 0] = 0
+
+        # Convert points to ms
+        self.max_amp = max_amp.reshape(self.map_shape)
+        self.max_amp_latency_pt = max_amp_latency.reshape(self.map_shape)
+        self.max_amp_latency = (max_amp_latency * self.int_pts).reshape(self.map_shape)
+        self.half_amp_latency = (half_amp_latency * self.int_pts).reshape(self.map_shape)
+        self.half_amp_latency_decay = half_amp_latency_decay.reshape(self.map_shape)
+        self.half_width = (half_width * self.int_pts).reshape(self.map_shape)
+
+        # SD, summed point by point in the same order as Data.cpp:getSD
+        sum1 = np.zeros(X.shape[0])
+        sum2 = np.zeros(X.shape[0])
+        num = 50
+        startPt = 10
+        for i in range(startPt, startPt + num):
+            data = X[:, i].astype(np.float64)
+            sum1 += data
+            sum2 += data * data
+        self.sd = np.sqrt((sum2 - sum1 * sum1 / num) / (num - 1)).reshape(self.map_shape)
+
+    @staticmethod
+    def _interpolate(X, rows, i, numerator):
+        """ float(i) - numerator / (X[i] - X[i-1]) per row, or float(i) where the slope is zero """
+        denom = X[rows, i].astype(np.float64) - X[rows, np.maximum(i - 1, 0)].astype(np.float64)
+        is_flat = (denom == 0)
+        return np.where(is_flat, i.astype(np.float64),
+                        i - numerator / np.where(is_flat, 1.0, denom))
+
+    def get_max_amp(self):
+        return self.max_amp
+
+    def get_max_amp_latency(self):
+        return self.max_amp_latency
+
+    def get_half_amp_latency(self):
+        return self.half_amp_latency
+
+    def get_half_amp_latency_decay(self):
+        return self.half_amp_latency_decay
+
+    def get_half_width(self):
+        return self.half_width
+
+    def get_SD(self):
+        return self.sd
+
+    def get_SNR(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.get_max_amp() / self.get_SD()
+
+    def get_RLI(self):
+        return np.array(self.rli)
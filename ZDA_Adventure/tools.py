@@ -1,5 +1,8 @@
 import numpy as np
 import math
+import os
+import hashlib
+from collections import OrderedDict
 from skimage.measure import block_reduce
 
 
@@ -14,6 +17,19 @@ class Tools:
         else:
             self.Data = Data
         
+    @staticmethod
+    def polynomial_baseline_operator(num_pts, degree, fit_mask=None):
+        '''
+        Least-squares polynomial baseline as a linear operator: a (num_pts x num_fit_pts) matrix H such that
+        traces[..., fit_mask] @ H.T is the baseline of every trace over all num_pts points.
+        The design matrix is the same for every pixel, so all pixels are fitted with one multiply.
+        The fitted values do not depend on the x scale, so x is mapped to [-1, 1] to keep high degrees well-conditioned.
+        '''
+        if fit_mask is None:
+            fit_mask = np.ones(num_pts, dtype=bool)
+        V = np.vander(np.linspace(-1, 1, num_pts), degree + 1)
+        return V @ np.linalg.pinv(V[fit_mask])
+
     def Polynomial(self, startPt=None, numPt=None, Data=None):
         '''
         Implement 3-degrees polynomial regression to the Original Data. The skip window can be set by adjust numPt and startPt.
@@ -22,28 +38,15 @@ class Tools:
         if Data is None:
             Data = self.Data
         
-        index = np.linspace(0, (Data.shape[3]-1), Data.shape[3])
-        
-        if startPt is not None:
-            if numPt is not None:
-                index_d = np.delete(index, np.arange(startPt, startPt+numPt, step=1), axis=0)
-                index_skip = True
-        else:
-            index_d = index
-            index_skip = False
+        fit_mask = np.ones(Data.shape[3], dtype=bool)
+        if startPt is not None and numPt is not None:
+            fit_mask[startPt:startPt+numPt] = False
+        H = self.polynomial_baseline_operator(Data.shape[3], 3, fit_mask)
+        if np.issubdtype(Data.dtype, np.floating):
+            H = H.astype(Data.dtype)
           
         for i in range(Data.shape[0]):
-            for j in range(Data.shape[1]):
-                for k in range(Data.shape[2]):
-                    
-                    if index_skip:
-                        array = np.delete(np.copy(Data[i][j][k]), np.arange(startPt, startPt+numPt, step=1), axis=0)
-                    else:
-                        array = np.copy(Data[i][j][k])
-                    
-                    coeffs = np.polyfit(index_d, array, 3)
-                    Data_fit = np.polyval(coeffs, index)
-                    Data[i][j][k] = Data[i][j][k] - Data_fit
+            Data[i] = Data[i] - Data[i][:, :, fit_mask] @ H.T
                     
         return Data
     
@@ -149,25 +152,10 @@ class Tools:
         endPt = startPt + numPt
         s = np.arange(length)
         mask = (s >= 3) & ~((s >= startPt) & (s < endPt))
-        xs = s[mask]
-        xs = np.array(xs)
-        V = np.column_stack((xs**3, xs**2, xs, np.ones_like(xs)))
-        x_all = np.arange(length)
+        H = self.polynomial_baseline_operator(length, 3, mask)
         
         for i in range(Data.shape[0]):
-            for j in range(Data.shape[1]):
-                for k in range(Data.shape[2]):
-                    
-                    data = np.asarray(Data[i][j][k], dtype=float)
-                    ys = data[mask]
-                    ys = np.array(ys)
-
-                    A, *_ = np.linalg.lstsq(V, ys, rcond=None)
-
-                    baseline = ((A[0]*x_all + A[1])*x_all + A[2])*x_all + A[3]
-
-                    Data[i][j][k] -= baseline
-                    print('Trial #{}, Row #{}, Column #{}.'.format(i, j, k))
+            Data[i] = Data[i] - np.asarray(Data[i], dtype=float)[:, :, mask] @ H.T
         return Data
     
     def Rli_Division(self, Rli, Data=None):
@@ -175,136 +163,346 @@ class Tools:
         ΔF/F.
         '''
         
+        if Data is None:
+            Data = self.Data
+        
         # Load the RLI Data.
         rli_low = Rli['rli_low']
         rli_low = np.array(rli_low)
-        rli_low = rli_low.reshape(80, 80)
+        rli_low = rli_low.reshape(Data.shape[1], Data.shape[2])
         rli_high = Rli['rli_high']
         rli_high = np.array(rli_high)
-        rli_high = rli_high.reshape(80, 80)
+        rli_high = rli_high.reshape(Data.shape[1], Data.shape[2])
         rli_max = Rli['rli_max']
         rli_max = np.array(rli_max)
-        rli_max = rli_max.reshape(80, 80)
+        rli_max = rli_max.reshape(Data.shape[1], Data.shape[2])
         
-        if Data is None:
-            Data = self.Data
-        
-        for i in range(Data.shape[0]):
-            for j in range(Data.shape[1]):
-                for k in range(Data.shape[2]):
-                    rli = (rli_high[j][k] - rli_low[j][k]) / 3276.8
-                    rli = round(rli, 6)
-                    if rli ==0:
-                        rli = -1
-                    
-                    Data[i][j][k] = Data[i][j][k] / (rli * 2340)
+        rli = np.round((rli_high - rli_low) / 3276.8, 6)
+        rli[rli == 0] = -1
+
+        rli = rli * 2340
+        if np.issubdtype(Data.dtype, np.floating):
+            rli = rli.astype(Data.dtype)
+        Data[...] = Data / rli[np.newaxis, :, :, np.newaxis]
         
         return Data
     
-    def T_filter(self, Data=None):
+    def T_filter(self, Data=None, dtype=np.float64, chunk_size=1 << 18):
         '''
         Apply bionomial8 Temporal Filter to the Target Data.
+        Filters the time axis in place, a chunk of traces (about chunk_size samples) at a time, so the working
+        buffers stay small whatever the size of Data. Points near the ends are normalized by the kernel weights
+        that fall inside the trace (93/163/219/247 and 255/247/219/163), as in PhotoZ.
+        dtype is the precision the filter computes in, e.g. np.float32 for float32 Data.
         '''
         
         if Data is None:
             Data = self.Data
-        
-        for i in range(Data.shape[0]):
-                    
-            input = np.copy(Data[i])
-        
-            num = Data.shape[3]
-            output = np.zeros((Data.shape[1], Data.shape[2], Data.shape[3]))
-
-            output[:, :, 0] = (input[:, :, 4] + 8 * input[:, :, 3] + 28 * input[:, :, 2] + 56 * input[:, :, 1]) / 93
-            output[:, :, 1] = (input[:, :, 5] + 8 * input[:, :, 4] + 28 * input[:, :, 3] + 56 * input[:, :, 2] 
-                               + 70 * input[:, :, 1]) / 163
-            output[:, :, 2] = (input[:, :, 6] + 8 * input[:, :, 5] + 28 * input[:, :, 4] 
-                               + 56 * (input[:, :, 1] + input[:, :, 3]) + 70 * input[:, :, 2]) / 219
-            output[:, :, 3] = (input[:, :, 7] + 8 * input[:, :, 6] + 28 * (input[:, :, 1] + input[:, :, 5]) 
-                               + 56 * (input[:, :, 2] + input[:, :, 4]) + 70 * input[:, :, 3]) / 247
-
-            end = num-4	
-            for s in range(4, end):
-                output[:, :, s] = (input[:, :, s-4]+input[:, :, s+4] + 8*(input[:, :, s-3]+input[:, :, s+3]) 
-                                    + 28*(input[:, :, s-2]+input[:, :, s+2])+56*(input[:, :, s-1]+input[:, :, s+1])+70*input[:, :, s])/256
-
-            output[:, :, num-4] = (input[:, :, num-8] + 8 * (input[:, :, num-7] + input[:, :, num-1]) 
-                                    + 28 * (input[:, :, num-6] + input[:, :, num-2]) + 56 * (input[:, :, num-5] + input[:, :, num-3]) 
-                                    + 70 * input[:, :, num-4]) / 255
-            output[:, :, num-3] = (input[:, :, num-7] + 8 * input[:, :, num-6] + 28 * (input[:, :, num-5] + input[:, :, num-1]) 
-                                    + 56 * (input[:, :, num-4] + input[:, :, num-2]) + 70 * input[:, :, num-3]) / 247
-            output[:, :, num-2] = (input[:, :, num-6] + 8 * input[:, :, num-5] + 28 * input[:, :, num-4] 
-                                    + 56 * (input[:, :, num-3] + input[:, :, num-1]) + 70 * input[:, :, num-2]) / 219
-            output[:, :, num-1] = (input[:, :, num-5] + 8 * input[:, :, num-4] + 28 * input[:, :, num-3] 
-                                    + 56 * input[:, :, num-2] + 70 * input[:, :, num-1]) / 163
-            
-            '''
-            output[0] = (output[6]+output[10])/2
-            output[1] = (output[7] + output[9]) / 2
-            output[2] = (output[8] + output[10]) / 2
-            output[3] = (output[9] + output[6]) / 2
-            output[4] = (output[10] + output[7]) / 2
-            output[5] = (output[11] + output[13]) / 2
-            '''
-            
-            Data[i] = output
+
+        if Data.ndim > 1 and not Data.flags.c_contiguous:
+            # traces cannot be viewed as one 2-D array: filter each sub-array
+            for i in range(Data.shape[0]):
+                self.T_filter(Data=Data[i], dtype=dtype, chunk_size=chunk_size)
+            return Data
+
+        num = Data.shape[-1]
+        traces = Data.reshape((-1, num))  # a view, written in place
+        n_traces = max(1, chunk_size // num)
+        for r0 in range(0, traces.shape[0], n_traces):
+            self.T_filter_chunk(traces[r0:r0 + n_traces], dtype)
                 
         return Data
+
+    @staticmethod
+    def T_filter_chunk(Data, dtype):
+        '''
+        Binomial8 filter of a (traces * points) chunk, written back into the chunk.
+        '''
+        input = np.array(Data, dtype=dtype)
+        num = Data.shape[-1]
+
+        Data[..., 0] = (input[..., 4] + 8 * input[..., 3] + 28 * input[..., 2] + 56 * input[..., 1]) / 93
+        Data[..., 1] = (input[..., 5] + 8 * input[..., 4] + 28 * input[..., 3] + 56 * input[..., 2]
+                        + 70 * input[..., 1]) / 163
+        Data[..., 2] = (input[..., 6] + 8 * input[..., 5] + 28 * input[..., 4]
+                        + 56 * (input[..., 1] + input[..., 3]) + 70 * input[..., 2]) / 219
+        Data[..., 3] = (input[..., 7] + 8 * input[..., 6] + 28 * (input[..., 1] + input[..., 5])
+                        + 56 * (input[..., 2] + input[..., 4]) + 70 * input[..., 3]) / 247
+
+        # full kernel for s in [4, num-4): sum the input shifted by each kernel offset, accumulating in place
+        end = num-4
+        acc = input[..., 0:end-4] + input[..., 8:num]
+        term = np.empty_like(acc)
+        for offset, weight in ((3, 8), (2, 28), (1, 56)):
+            np.add(input[..., 4-offset:end-offset], input[..., 4+offset:end+offset], out=term)
+            term *= weight
+            acc += term
+        np.multiply(input[..., 4:end], 70, out=term)
+        acc += term
+        acc /= 256
+        Data[..., 4:end] = acc
+
+        Data[..., num-4] = (input[..., num-8] + 8 * (input[..., num-7] + input[..., num-1])
+                            + 28 * (input[..., num-6] + input[..., num-2]) + 56 * (input[..., num-5] + input[..., num-3])
+                            + 70 * input[..., num-4]) / 255
+        Data[..., num-3] = (input[..., num-7] + 8 * input[..., num-6] + 28 * (input[..., num-5] + input[..., num-1])
+                            + 56 * (input[..., num-4] + input[..., num-2]) + 70 * input[..., num-3]) / 247
+        Data[..., num-2] = (input[..., num-6] + 8 * input[..., num-5] + 28 * input[..., num-4]
+                            + 56 * (input[..., num-3] + input[..., num-1]) + 70 * input[..., num-2]) / 219
+        Data[..., num-1] = (input[..., num-5] + 8 * input[..., num-4] + 28 * input[..., num-3]
+                            + 56 * input[..., num-2] + 70 * input[..., num-1]) / 163
+        return Data
     
     def S_filter(self, sigma, Data=None):
         '''
         Apply Gaussian Spatial Filter to the Target Data. 
         Sigma here means the spatial constant which is used to calculate the ceterWeight.
+        Each diode becomes the weighted mean of its 3x3 neighborhood (center weighted by centerWeight, neighbors by 1),
+        normalized by the weights of the neighbors that exist, so border diodes are not pulled toward zero.
         '''
         
         if Data is None:
             Data = self.Data
         
-        Trials, height, width, points = Data.shape    
-        proData = np.zeros((Trials, height*width, points))
-        for i in range(Data.shape[0]):
-            proData[i] = Data[i].reshape(height*width, points)
-            
+        Trials, height, width, points = Data.shape
         centerWeight = np.exp((0.5)/(sigma**2))
-        
-        num_diodes, numPts = proData.shape[1], proData.shape[2]
-        output = np.zeros_like(proData)
 
-        for i in range(Data.shape[0]):
-            for center_diode in range(num_diodes):
-                
-                x = center_diode % width
-                y = center_diode // width
-
-                acc = np.zeros(numPts)
-                weight_sum = 0.0
-
-                acc += proData[i][center_diode] * centerWeight
-                weight_sum += centerWeight
+        dtype = Data.dtype.type if np.issubdtype(Data.dtype, np.floating) else np.float64
+        proData = np.asarray(Data, dtype=dtype)
+        output = proData * dtype(centerWeight)
+        weight_sum = np.full((height, width), centerWeight, dtype=dtype)
 
-                for j in range(9):
-                    if j == 4:
-                        continue
+        # add each neighbor offset, in the same order as PhotoZ, where it falls inside the image
+        for j in range(9):
+            if j == 4:
+                continue
 
-                    xoffset = (j % 3) - 1
-                    yoffset = (j // 3) - 1
-                    nx, ny = x + xoffset, y + yoffset
+            xoffset = (j % 3) - 1
+            yoffset = (j // 3) - 1
+            y0, y1 = max(0, -yoffset), height - max(0, yoffset)
+            x0, x1 = max(0, -xoffset), width - max(0, xoffset)
 
-                    if nx < 0 or nx >= width or ny < 0 or ny >= height:
-                        continue
+            output[:, y0:y1, x0:x1, :] += proData[:, y0+yoffset:y1+yoffset, x0+xoffset:x1+xoffset, :]
+            weight_sum[y0:y1, x0:x1] += 1.0
 
-                    neighbor = nx + ny * width
-            
+        output /= weight_sum[np.newaxis, :, :, np.newaxis]
+        
+        return output
+
+
+class Preprocessor:
+    '''
+    The preprocessing shared by the AutoExporter, MovieMaker and ROI tools. Enabled stages always run in this order:
+        polynomial baseline -> RLI division -> temporal filter -> spatial filter -> binning
+    on one working copy of the data (float32 by default), which each stage updates in place where it can.
+    '''
+
+    stage_order = ['baseline_correction', 'rli_division', 'temporal_filter', 'spatial_filter', 'binning']
+
+    def __init__(self, baseline_correction=True, skip_window_start=None, skip_window_width=None,
+                 rli_division=True, temporal_filter=False, spatial_filter=False, spatial_filter_sigma=1.0,
+                 binning_factor=1, dtype=np.float32):
+        self.baseline_correction = baseline_correction
+        self.skip_window_start = skip_window_start
+        self.skip_window_width = skip_window_width
+        self.rli_division = rli_division
+        self.temporal_filter = temporal_filter
+        self.spatial_filter = spatial_filter
+        self.spatial_filter_sigma = spatial_filter_sigma
+        self.binning_factor = binning_factor
+        self.dtype = dtype
+
+    def get_stages(self):
+        '''
+        The enabled stages, in the order they run.
+        '''
+        enabled = {'baseline_correction': self.baseline_correction,
+                   'rli_division': self.rli_division,
+                   'temporal_filter': self.temporal_filter,
+                   'spatial_filter': self.spatial_filter,
+                   'binning': self.binning_factor > 1}
+        return [stage for stage in self.stage_order if enabled[stage]]
+
+    def get_cache_key(self):
+        '''
+        The settings that determine the output, for PreprocessCache keys.
+        '''
+        return (tuple(self.get_stages()), self.skip_window_start, self.skip_window_width,
+                float(self.spatial_filter_sigma), self.binning_factor, np.dtype(self.dtype).name)
 
-                    acc += proData[i][neighbor]
-                    weight_sum += 1.0
+    def run(self, Data, Rli=None):
+        '''
+        Preprocess Data (Trials * height * width * points). Returns the processed Data and the RLI,
+        binned to match if binning is enabled. The caller's Data and Rli are left unchanged.
+        '''
+        tools = Tools()
+        Data = np.array(Data, dtype=self.dtype)
+        if Rli is not None:
+            Rli = dict(Rli)
+
+        for stage in self.get_stages():
+            if stage == 'baseline_correction':
+                tools.Polynomial(startPt=self.skip_window_start, numPt=self.skip_window_width, Data=Data)
+            elif stage == 'rli_division' and Rli is not None:
+                tools.Rli_Division(Rli, Data=Data)
+            elif stage == 'temporal_filter':
+                tools.T_filter(Data=Data, dtype=self.dtype)
+            elif stage == 'spatial_filter':
+                Data = tools.S_filter(self.spatial_filter_sigma, Data=Data)
+            elif stage == 'binning':
+                Data, Rli = tools.Binning(self.binning_factor, Data=Data, rli=Rli)
+                Data = Data.astype(self.dtype, copy=False)
+
+        return Data, Rli
+
+
+class PreprocessCache:
+    '''
+    Cache of Preprocessor output, keyed by the ZDA file's path, size and modification time, the trial and the
+    Preprocessor settings. Two layers: an in-process memo of the most recently used arrays (up to max_memo_bytes),
+    and an optional on-disk store in cache_dir (one .npz per entry, least recently used entries evicted beyond
+    max_disk_bytes) that is shared across runs, worker processes and tools. cache_dir=None keeps the memo only.
+    '''
+
+    default_cache = None
+    default_cache_dir = os.path.join(os.path.expanduser("~"), ".tsm_to_zda", "preprocess_cache")
+
+    def __init__(self, cache_dir=None, max_disk_bytes=4e9, max_memo_bytes=1e9):
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memo_bytes = max_memo_bytes
+        self.memo = OrderedDict()
+        self.memo_bytes = 0
+        self.set_cache_dir(cache_dir)
+
+    @classmethod
+    def get_default(cls):
+        '''
+        Process-wide cache shared by the exporter, movie maker and ROI tools.
+        Memo only, unless the on-disk store is turned on with set_default_disk_cache.
+        '''
+        if cls.default_cache is None:
+            cls.default_cache = cls()
+        return cls.default_cache
 
-                if weight_sum > 0:
-                    output[i][center_diode] = acc / weight_sum
-                else:
-                    output[i][center_diode] = 0.0
-        
-        output = output.reshape(Data.shape[0], Data.shape[1], Data.shape[2], Data.shape[3])
-        
-        return output
\ No newline at end of file
+    @classmethod
+    def set_default_disk_cache(cls, enabled, cache_dir=None):
+        '''
+        Turn the default cache's on-disk store on (in cache_dir, by default in the user's home directory) or off.
+        '''
+        if cache_dir is None:
+            cache_dir = cls.default_cache_dir
+        cls.get_default().set_cache_dir(cache_dir if enabled else None)
+
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # the memo is not sent to worker processes
+        state = self.__dict__.copy()
+        state['memo'] = OrderedDict()
+        state['memo_bytes'] = 0
+        return state
+
+    def get_key(self, filename, preprocessor, trial=None):
+        # a rewritten file gets a new size or modification time, so the file itself is not read here
+        st = os.stat(filename)
+        file_id = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+        key = repr((file_id, trial, preprocessor.get_cache_key()))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def run(self, preprocessor, filename, load, trial=None):
+        '''
+        preprocessor.run(Data, Rli) for the data of filename (all trials, or only trial), where load() reads
+        and returns (Data, Rli). A cached result is reused if there is one, and then the file is not read.
+        '''
+        key = self.get_key(filename, preprocessor, trial)
+        cached = self.get(key)
+        if cached is None:
+            cached = preprocessor.run(*load())
+            self.put(key, *cached)
+        Data, Rli = cached
+        # callers may modify the returned arrays in place
+        if Rli is not None:
+            Rli = {k: np.copy(v) for k, v in Rli.items()}
+        return np.copy(Data), Rli
+
+    def get_entry_filename(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            return self.memo[key]
+        if self.cache_dir is None:
+            return None
+        entry_filename = self.get_entry_filename(key)
+        try:
+            with np.load(entry_filename) as npz:
+                Data = npz['data']
+                Rli = None
+                if 'has_rli' in npz.files:
+                    Rli = {k[len('rli_'):]: npz[k] for k in npz.files if k.startswith('rli_')}
+            os.utime(entry_filename)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        self.put_memo(key, Data, Rli)
+        return Data, Rli
+
+    def put(self, key, Data, Rli=None):
+        self.put_memo(key, Data, Rli)
+        if self.cache_dir is None:
+            return
+        arrays = {'data': Data}
+        if Rli is not None:
+            arrays['has_rli'] = np.array(True)
+            for k in Rli:
+                arrays['rli_' + k] = Rli[k]
+        entry_filename = self.get_entry_filename(key)
+        tmp_filename = entry_filename + "." + str(os.getpid()) + ".part"
+        try:
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_filename, entry_filename)
+        except OSError as e:
+            print("Could not write preprocess cache entry", entry_filename, ":", e)
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return
+        self.evict()
+
+    def put_memo(self, key, Data, Rli=None):
+        nbytes = Data.nbytes
+        if nbytes > self.max_memo_bytes:
+            return
+        if key in self.memo:
+            self.memo_bytes -= self.memo.pop(key)[0].nbytes
+        self.memo[key] = (Data, Rli)
+        self.memo_bytes += nbytes
+        while self.memo_bytes > self.max_memo_bytes:
+            _, (old_data, _) = self.memo.popitem(last=False)
+            self.memo_bytes -= old_data.nbytes
+
+    def evict(self):
+        '''
+        Delete the least recently used entries until the on-disk store fits in max_disk_bytes.
+        '''
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith(".npz"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, f))
+            except OSError:
+                continue  # evicted by another process
+            entries.append((st.st_mtime, st.st_size, f))
+        total_bytes = sum([e[1] for e in entries])
+        for _, size, f in sorted(entries):
+            if total_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, f))
+            except OSError:
+                pass
+            total_bytes -= size
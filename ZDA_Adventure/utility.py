@@ -1,5 +1,12 @@
 import numpy as np
 import struct
+from scipy import sparse
+
+try:
+    from ZDA_Adventure.zda_reader import ZDA_Reader
+except ImportError:
+    # imported from inside ZDA_Adventure/, e.g. by its notebooks
+    from zda_reader import ZDA_Reader
 
 class ROIFileReader:
     '''
@@ -130,6 +137,51 @@ class TraceSelector:
             return Data[trial, roi[:, 1], roi[:, 0], :]
 
 
+class ROIMask:
+    
+    """ ROI list compiled into a sparse ROIs x pixels weight matrix """
+    def __init__(self, rois, height, width):
+        '''
+        rois is a list of ROIs, each a list of (x,y) tuples or [x,y] lists, over images of height x width.
+        Row i of the matrix averages the pixels of rois[i] (a repeated pixel counts as often as it
+        appears, as in TraceSelector.get_trace_from_roi), so all ROI traces are one matrix multiply.
+        '''
+        self.height = height
+        self.width = width
+        self.n_rois = len(rois)
+        roi_sizes = np.array([len(roi) for roi in rois], dtype=int)
+        if np.any(roi_sizes < 1):
+            raise ValueError("Cannot average an empty ROI")
+        if self.n_rois > 0:
+            pts = np.concatenate([np.array(roi, dtype=int).reshape(-1, 2) for roi in rois])
+        else:
+            pts = np.zeros((0, 2), dtype=int)
+        x, y = pts[:, 0], pts[:, 1]
+        if np.any((x < 0) | (x >= width) | (y < 0) | (y >= height)):
+            raise IndexError("ROI pixel out of bounds for " + str(height) + " x " + str(width) + " image")
+        rows = np.repeat(np.arange(self.n_rois), roi_sizes)
+        weights = np.repeat(1.0 / roi_sizes, roi_sizes)
+        # duplicate (row, pixel) entries are summed
+        self.matrix = sparse.csr_matrix((weights, (rows, y * width + x)),
+                                        shape=(self.n_rois, height * width))
+
+    def get_traces(self, data):
+        '''
+        Mean trace of every ROI: n_rois x points.
+        data is Height x Width x Points, or Trials x Height x Width x Points (averaged over trials).
+        '''
+        data = np.asarray(data)
+        if data.ndim == 4:
+            data = np.mean(data, axis=0)
+        return self.matrix @ data.reshape(self.height * self.width, -1)
+
+    def get_means(self, image):
+        '''
+        Mean value of every ROI in a Height x Width image, e.g. an RLI frame.
+        '''
+        return self.matrix @ np.asarray(image).reshape(-1)
+
+
 class DataLoader:
     
     def __init__(self, filedir, rli_only=False):
@@ -157,126 +209,57 @@ class DataLoader:
         '''
         Read ZDA file and convert the data into numpy array which can be used in Python.
         Including RLI Data, MetaData, Raw Data, and Supplymental Data.
+        The Raw Data stays memory-mapped, so trials and pixels are only read from disk when they are used.
         '''
         
-        # Load and read the binary ZDA file.
-        file = open(filedir, 'rb')
-        
-        # Read in different scales.
-        chSize = 1
-        shSize = 2
-        nSize = 4
-        tSize = 8
-        fSize = 4
-        
-        # MetaData.
-        metadata = {}
-        metadata['version'] = (file.read(chSize))
-        metadata['slice_number'] = (file.read(shSize))
-        metadata['location_number'] = (file.read(shSize))
-        metadata['record_number'] = (file.read(shSize))
-        metadata['camera_program'] = (file.read(nSize))
-
-        metadata['number_of_trials'] = (file.read(chSize))
-        metadata['interval_between_trials'] = (file.read(chSize))
-        metadata['acquisition_gain'] = (file.read(shSize))
-        metadata['points_per_trace'] = (file.read(nSize))
-        metadata['time_RecControl'] = (file.read(tSize))
-
-        metadata['reset_onset'] = struct.unpack('f',(file.read(fSize)))[0]
-        metadata['reset_duration'] = struct.unpack('f',(file.read(fSize)))[0]
-        metadata['shutter_onset'] = struct.unpack('f',(file.read(fSize)))[0]
-        metadata['shutter_duration'] = struct.unpack('f',(file.read(fSize)))[0]
-
-        metadata['stimulation1_onset'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['stimulation1_duration'] = struct.unpack('f',(file.read(fSize)))[0]
-        metadata['stimulation2_onset'] = struct.unpack('f',(file.read(fSize)))[0]
-        metadata['stimulation2_duration'] = struct.unpack('f',(file.read(fSize)))[0]
-
-        metadata['acquisition_onset'] = struct.unpack('f',(file.read(fSize)))[0]
-        metadata['interval_between_samples'] = struct.unpack('f',(file.read(fSize)))[0]
-        metadata['raw_width'] = (file.read(nSize))
-        metadata['raw_height'] = (file.read(nSize))
-
-        for k in metadata:
-            if k in ['interval_between_samples',] or 'onset' in k or 'duration' in k:
-                pass
-            elif k == 'time_RecControl':
-                pass
-            else:
-                metadata[k] = int.from_bytes(metadata[k], "little")
-
-        num_diodes = metadata['raw_width'] * metadata['raw_height']
-        
-        file.seek(1024, 0)
+        # One header parse; RLI, Raw and Supplymental Data are views into the binary ZDA file.
+        self.zda_reader = ZDA_Reader(filedir, rli_only=rli_only)
+        metadata = self.zda_reader.get_meta()
         
         # RLI 
-        rli = {}
-
-        rli['rli_low'] = [int.from_bytes(file.read(shSize), "little") for _ in range(num_diodes)]
-        for _ in range(8):
-            _ = file.read(shSize)  
-        rli['rli_high'] = [int.from_bytes(file.read(shSize), "little") for _ in range(num_diodes)]
-        for _ in range(8):
-            _ = file.read(shSize)  
-        rli['rli_max'] = [int.from_bytes(file.read(shSize), "little") for _ in range(num_diodes)]
-        for _ in range(8):
-            _ = file.read(shSize)  
-        
         w = metadata['raw_width']
         h = metadata['raw_height']
-        for k in rli:
-            rli[k] = np.array(rli[k]).reshape((h, w))
+        rli = {}
+        for k, v in self.zda_reader.get_rli().items():
+            rli[k] = v.astype(int).reshape((h, w))
 
-        if rli_only:
-            file.close()
+        if rli_only or self.zda_reader.get_images() is None:
             return None, metadata, rli, None
         
-        # Raw Data.
-        raw_data = np.zeros((metadata['number_of_trials'],
-                             metadata['points_per_trace'],
-                             metadata['raw_width'],
-                             metadata['raw_height'])).astype(int)
+        # Raw Data, Trials * Points * Width * Height.
+        raw_data = np.transpose(self.zda_reader.get_images(), (0, 3, 1, 2))
         
         # Supplymental Data (analog input (aka FP) data)
-        supplyment = np.zeros((metadata['number_of_trials'], 8, metadata['points_per_trace']))
-        
-        for i in range(metadata['number_of_trials']):
-            for jw in range(metadata['raw_width']):
-                for jh in range(metadata['raw_height']):
-                    for k in range(metadata['points_per_trace']):
-                        pt = file.read(shSize)
-                        if not pt:
-                            print("Ran out of points.",len(raw_data))
-                            file.close()
-                        raw_data[i,k,jw,jh] = int.from_bytes(pt, "little", signed=True)
-                        
-            for jw in range(8):
-                for jh in range(metadata['points_per_trace']):
-                    supplyment[i][jw][jh] = int.from_bytes(file.read(shSize), 'little', signed=True)
-
-        file.close()
+        supplyment = self.zda_reader.get_fp_arr().astype(np.float64)
         
         return raw_data, metadata, rli, supplyment
     
-    def discard_and_rearrange(self):
+    def discard_and_rearrange(self, trial=None, window=None):
         '''
         Rearrange the Data Array into a shape of Trials * Rows * Columns * Timepoints.
+        Optionally select a single trial (kept as a length-1 trial axis) and/or
+        a spatial window ((row_start, row_end), (col_start, col_end)).
         '''
         
-        Data = np.copy(self.data)
-        Supplyment = self.supplyment
+        Data = self.data
+        if trial is not None:
+            Data = Data[trial:trial + 1]
         Data_rearrange = np.transpose(Data, (0, 2, 3, 1))
+        if window is not None:
+            (r0, r1), (c0, c1) = window
+            Data_rearrange = Data_rearrange[:, r0:r1, c0:c1, :]
+        Data_rearrange = Data_rearrange.astype(int)
+        Supplyment = self.supplyment
         
         return Data_rearrange, Supplyment
     
-    def fix_and_supply(self):
+    def fix_and_supply(self, trial=None, window=None):
         '''
         Last step of preprocessing the Data Array.
         '''
         
         # Load the Rearranged Data.
-        Data_Raw, Supplyment = self.discard_and_rearrange()
+        Data_Raw, Supplyment = self.discard_and_rearrange(trial=trial, window=window)
         
         # Invert and Scale amplitude
         Data_Raw = -Data_Raw / self.scale_amplitude
@@ -284,12 +267,12 @@ class DataLoader:
         
         return Data_Raw, fp_data
     
-    def get_data(self):
+    def get_data(self, trial=None, window=None):
         '''
-        Return the Final Data Array.
+        Return the Final Data Array, or only one trial and/or spatial window of it.
         '''
         
-        Data, _ = self.fix_and_supply()
+        Data, _ = self.fix_and_supply(trial=trial, window=window)
         
         return Data
 
@@ -313,5 +296,5 @@ class DataLoader:
         '''
 
         if self.fp_data is None:
-            _, fp = self.fix_and_supply()
-        return fp
+            self.fp_data = self.supplyment / self.scale_amplitude
+        return self.fp_data
@@ -0,0 +1,156 @@
+import os
+import struct
+import numpy as np
+
+
+class ZDA_Reader:
+    '''
+    Reads a PhotoZ ZDA file by parsing the 1024-byte header once and exposing
+    the RLI, image and FP (BNC) blocks as array views over a single bulk read.
+
+    On-disk layout (see PhotoLib Controller::saveData):
+        < header, 1024 bytes >
+        < RLI low  : (width * height + num_fp_pts) shorts >
+        < RLI high : (width * height + num_fp_pts) shorts >
+        < RLI max  : (width * height + num_fp_pts) shorts >
+        < Trial #1 : (width * height + num_fp_pts) traces of points_per_trace shorts >
+        ...
+    '''
+
+    header_size = 1024
+    header_format = '<BHHHIBBHI8s10fII'
+    header_fields = ['version', 'slice_number', 'location_number', 'record_number', 'camera_program',
+                     'number_of_trials', 'interval_between_trials', 'acquisition_gain', 'points_per_trace',
+                     'time_RecControl',
+                     'reset_onset', 'reset_duration', 'shutter_onset', 'shutter_duration',
+                     'stimulation1_onset', 'stimulation1_duration',
+                     'stimulation2_onset', 'stimulation2_duration',
+                     'acquisition_onset', 'interval_between_samples',
+                     'raw_width', 'raw_height']
+    rli_keys = ['rli_low', 'rli_high', 'rli_max']
+    default_num_fp_pts = 8  # old rig and TSM-to-ZDA conversions both write 8 FP channels
+
+    def __init__(self, filename=None, num_fp_pts=None, use_memmap=True, rli_only=False):
+        self.filename = None
+        self.num_fp_pts = num_fp_pts
+        self.use_memmap = use_memmap
+        self.metadata = {}
+        self.rli = None
+        self.images = None
+        self.fp_arr = None
+        self.raw = None
+        if filename is not None:
+            self.load_zda(filename, rli_only=rli_only)
+
+    def read_header(self, filename):
+        ''' Parse the metadata header into a dict. '''
+        with open(filename, 'rb') as file:
+            header = file.read(struct.calcsize(self.header_format))
+        metadata = dict(zip(self.header_fields, struct.unpack(self.header_format, header)))
+        return metadata
+
+    def infer_num_fp_pts(self, filename, metadata):
+        ''' The number of FP channels is not stored in the header, so solve for it from the file size.
+            Falls back to the default if the file is truncated or padded. '''
+        num_diodes = metadata['raw_width'] * metadata['raw_height']
+        data_bytes = os.path.getsize(filename) - self.header_size
+        trace_bytes = 2 * (len(self.rli_keys) + metadata['number_of_trials'] * metadata['points_per_trace'])
+        if trace_bytes > 0 and data_bytes % trace_bytes == 0 and data_bytes // trace_bytes >= num_diodes:
+            return data_bytes // trace_bytes - num_diodes
+        return self.default_num_fp_pts
+
+    def load_zda(self, filename, rli_only=False):
+        ''' Map (or bulk-read) the file and set up the RLI, image and FP views.
+            Returns False if the file ran out of points. '''
+        self.filename = filename
+        self.metadata = self.read_header(filename)
+        meta = self.metadata
+
+        num_fp_pts = self.num_fp_pts
+        if num_fp_pts is None:
+            num_fp_pts = self.infer_num_fp_pts(filename, meta)
+        meta['num_fp_pts'] = num_fp_pts
+
+        w, h = meta['raw_width'], meta['raw_height']
+        n_trials, n_pts = meta['number_of_trials'], meta['points_per_trace']
+        num_diodes = w * h + num_fp_pts
+        rli_count = len(self.rli_keys) * num_diodes
+        count = rli_count
+        if not rli_only:
+            count += n_trials * num_diodes * n_pts
+
+        available = (os.path.getsize(filename) - self.header_size) // 2
+        is_complete = available >= count
+        if not is_complete:
+            print("Ran out of points.", filename, "has", available, "of", count, "expected points.")
+            count = min(count, rli_count) if available >= rli_count else 0
+        if count == 0:
+            return False
+
+        if self.use_memmap:
+            self.raw = np.memmap(filename, dtype='<i2', mode='r', offset=self.header_size, shape=(count,))
+        else:
+            with open(filename, 'rb') as file:
+                file.seek(self.header_size, 0)
+                self.raw = np.fromfile(file, dtype='<i2', count=count)
+
+        rli_block = self.raw[:rli_count].view('<u2').reshape(len(self.rli_keys), num_diodes)
+        self.rli = {k: rli_block[i, :w * h] for i, k in enumerate(self.rli_keys)}
+
+        if rli_only or not is_complete:
+            return is_complete
+
+        trial_block = self.raw[rli_count:].reshape(n_trials, num_diodes, n_pts)
+        self.images = trial_block[:, :w * h, :].reshape(n_trials, w, h, n_pts)
+        self.fp_arr = trial_block[:, w * h:, :]
+        return True
+
+    def close(self):
+        ''' Drop the array views so that a memory-mapped file is released. '''
+        self.raw, self.images, self.fp_arr, self.rli = None, None, None, None
+
+    def get_meta(self):
+        return self.metadata
+
+    def get_dim(self):
+        return [self.metadata['number_of_trials'], self.metadata['points_per_trace'],
+                self.metadata['raw_width'], self.metadata['raw_height']]
+
+    def get_rli(self):
+        ''' RLI frames as flat (width * height) unsigned views, keyed rli_low / rli_high / rli_max '''
+        return self.rli
+
+    def get_images(self, signed=True):
+        ''' Image data as a Trials x Width x Height x Points view '''
+        if self.images is None or signed:
+            return self.images
+        return self.images.view('<u2')
+
+    def get_trial(self, trial, signed=True):
+        ''' Copy of a single trial, Width x Height x Points.
+            When memory-mapped, only that trial's bytes are read from disk. '''
+        return np.array(self.get_images(signed=signed)[trial])
+
+    def get_trace(self, jw, jh, trial=None, signed=True):
+        ''' Copy of a single pixel's trace: Trials x Points, or Points if trial is given.
+            Each trial's trace is one contiguous run of points_per_trace shorts on disk. '''
+        images = self.get_images(signed=signed)
+        if trial is None:
+            return np.array(images[:, jw, jh, :])
+        return np.array(images[trial, jw, jh, :])
+
+    def get_window(self, jw_range, jh_range, trial=None, signed=True):
+        ''' Copy of the spatial window images[..., jw0:jw1, jh0:jh1, :]: Trials x w x h x Points,
+            or w x h x Points if trial is given. Only the traces inside the window are read. '''
+        jw0, jw1 = jw_range
+        jh0, jh1 = jh_range
+        images = self.get_images(signed=signed)
+        if trial is None:
+            return np.array(images[:, jw0:jw1, jh0:jh1, :])
+        return np.array(images[trial, jw0:jw1, jh0:jh1, :])
+
+    def get_fp_arr(self, signed=True):
+        ''' FP (analog input) data as a Trials x num_fp_pts x Points view '''
+        if self.fp_arr is None or signed:
+            return self.fp_arr
+        return self.fp_arr.view('<u2')
@@ -1,5 +1,11 @@
+import multiprocessing
+
 from lib.gui.gui import GUI
 
 
 PRODUCTION_MODE = True
-gui = GUI(production_mode=PRODUCTION_MODE)
+
+if __name__ == '__main__':
+    # conversion and export worker processes re-import this script (spawn on Windows): only start the GUI here
+    multiprocessing.freeze_support()
+    gui = GUI(production_mode=PRODUCTION_MODE)
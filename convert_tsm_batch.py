@@ -0,0 +1,120 @@
+""" Headless batch conversion of a directory of TurboSM .tsm/.tbn pairs into PhotoZ ZDA files.
+
+Files are sorted by name and split into trial groups of --trials files (leftover files are skipped),
+and the groups are converted in parallel across a process pool. Finished ZDA files are skipped on
+the next run, so an interrupted batch can simply be re-run to resume.
+
+Example:
+    python convert_tsm_batch.py /data/archive/07-12-24 --out /data/zda/07-12-24 --camera-program 4 --trials 5 -j 8
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from lib.camera_settings import CameraSettings
+from lib.tsm_converter import TSM_Converter
+
+
+def find_tsm_files(data_dir):
+    """ Sorted .tsm files in data_dir that have a matching .tbn file """
+    tsm_files = []
+    for file in sorted(os.listdir(data_dir)):
+        if not file.endswith(".tsm"):
+            continue
+        tsm_file = os.path.join(data_dir, file)
+        if not os.path.exists(tsm_file[:-4] + ".tbn"):
+            print("Skipping", tsm_file, "(no .tbn file)")
+            continue
+        tsm_files.append(tsm_file)
+    return tsm_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a directory of TSM/TBN files to ZDA files in parallel.")
+    parser.add_argument("data_dir", help="directory containing .tsm/.tbn pairs")
+    parser.add_argument("--out", default=None, help="output directory (default: <data_dir>/converted_zda)")
+    parser.add_argument("--camera-program", type=int, default=4, help="TurboSM camera program (sets crop and binning)")
+    parser.add_argument("--binning", type=int, default=None, help="override the camera program's binning")
+    parser.add_argument("--trials", type=int, default=5, help="number of .tsm files (trials) per ZDA file")
+    parser.add_argument("--slice", type=int, default=1)
+    parser.add_argument("--location", type=int, default=1)
+    parser.add_argument("--record", type=int, default=1, help="record number of the first ZDA file")
+    parser.add_argument("--skip-points", type=int, default=0, help="points to crop from the start of each trace")
+    parser.add_argument("--num-points", type=int, default=None,
+                        help="points per trace to keep, counted from the start of the recording")
+    parser.add_argument("--flatten-points", type=int, default=0)
+    parser.add_argument("--preprocess", action="store_true", help="invert and baseline-correct before writing")
+    parser.add_argument("--keep-names", action="store_true",
+                        help="name ZDA files after the first .tsm of each group instead of slice_loc_rec.zda")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--overwrite", action="store_true", help="reconvert groups whose ZDA file already exists")
+    args = parser.parse_args()
+
+    out_dir = args.out
+    if out_dir is None:
+        out_dir = os.path.join(args.data_dir, "converted_zda")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    cam_settings = CameraSettings().get_program_settings(args.camera_program)
+    binning = cam_settings['binning'] if args.binning is None else args.binning
+    t_cropping = [args.skip_points, -1 if args.num_points is None else args.num_points - 1]
+    converter = TSM_Converter(cam_settings, binning, t_cropping, args.trials,
+                              args.slice, args.location, args.record,
+                              num_flatten_points=args.flatten_points,
+                              apply_preprocess=args.preprocess,
+                              filename_PhotoZ_format=not args.keep_names)
+
+    tsm_files = find_tsm_files(args.data_dir)
+    filenames = [os.path.splitext(os.path.basename(f))[0] for f in tsm_files]
+    path_groups, filename_groups = converter.group_files(tsm_files, filenames)
+    n_discard = len(tsm_files) - args.trials * len(path_groups)
+    if n_discard > 0:
+        print("Cannot group", len(tsm_files), "trials into groups of", str(args.trials) + ".",
+              "Skipping last", n_discard, "files.")
+
+    # resume: skip groups that already have a finished ZDA file
+    pending = []
+    for i_group in range(len(path_groups)):
+        zda_file = os.path.join(out_dir, converter.get_zda_filename(filename_groups[i_group][0], i_group))
+        if os.path.exists(zda_file) and not args.overwrite:
+            print("Already converted:", zda_file)
+            continue
+        pending.append(i_group)
+    print(len(pending), "of", len(path_groups), "trial groups to convert with", args.workers, "workers.")
+
+    start_time = time.time()
+    n_files, n_bytes, n_failed = 0, 0, 0
+    executor = ProcessPoolExecutor(max_workers=args.workers)
+    try:
+        futures = {executor.submit(converter.convert_group, path_groups[i], filename_groups[i], i, out_dir): i
+                   for i in pending}
+        for future in as_completed(futures):
+            i_group = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                n_failed += 1
+                print("Failed to convert group", i_group, path_groups[i_group], ":", e)
+                continue
+            n_files += stats['n_files']
+            n_bytes += stats['n_bytes']
+            elapsed = time.time() - start_time
+            print("[" + str(n_files) + "/" + str(len(pending) * args.trials) + " files]",
+                  stats['zda_file'], "in", round(stats['seconds'], 1), "s",
+                  "(" + str(round(stats['seconds'] / stats['n_files'], 2)), "s/file) |",
+                  "overall", round(n_files / elapsed, 2), "files/s,",
+                  round(n_bytes / elapsed / 1e6, 1), "MB/s")
+    except KeyboardInterrupt:
+        print("Interrupted. Re-run the same command to resume; unfinished groups are left as .part files.")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    print("Converted", n_files, "files in", round(time.time() - start_time, 1), "s.",
+          n_failed, "trial group(s) failed.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,18 @@
 from sklearn.mixture import GaussianMixture
 import matplotlib.pyplot as plt
 import numpy as np
-import random
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Cluster:
-    """ Object representing a region of interest / cluster """
+    """ Object representing a region of interest / cluster.
+        Pixels are [column, row] points of a width x width image; pixel operations
+        run on the cluster's boolean mask image """
+    # pixels sharing an edge are contiguous; pixels sharing an edge or corner are adjacent
+    contiguity_structure = ndimage.generate_binary_structure(2, 1)
+    adjacency_structure = ndimage.generate_binary_structure(2, 2)
+
     def __init__(self, pixels, width):
         self.width = width
         self.pixels = pixels
@@ -13,44 +20,26 @@ class Cluster:
     def get_pixels(self):
         return self.pixels
 
-    def get_border_pixels(self, px=None, adj_map=None):
+    def get_mask(self):
+        """ Boolean image that is True at the cluster's pixels """
+        mask = np.zeros((self.width, self.width), dtype=bool)
+        if len(self.pixels) > 0:
+            px = np.asarray(self.pixels, dtype=int).reshape(-1, 2)
+            mask[px[:, 1], px[:, 0]] = True
+        return mask
+
+    @staticmethod
+    def mask_to_pixels(mask):
+        rows, cols = np.nonzero(mask)
+        return np.stack([cols, rows], axis=1).tolist()
+
+    def get_border_pixels(self):
         """ Return a list of pixels bordering the region. Intersection with cluster is null set. """
         if len(self.pixels) < 1:
             return []
-        border = []
-        if adj_map is None:
-            adj_map = self.build_adjacency_map()
-        if px is None:
-            px = self.pixels[0]
-        y, x = px
-        border += self.get_adj_px_not_in_cluster(x, y, adj_map)
-        neighbors = self.get_px_unvisited_neighbors_from_adj_list(x, y, adj_map)
-        for pt2 in neighbors:
-            y2, x2 = pt2
-            border += self.get_border_pixels(pt2, adj_map)
-
-        adj_map[y][x] = True
-        return border
-
-    def get_adj_px_not_in_cluster(self, x, y, adj_map):
-        """ Return a list of the pixels that are adjacent to x, y but not in the adj_map """
-        border = []
-        for x2 in range(max(0, x-1), min(self.width-1, x+1)):
-            for y2 in range(max(0, y - 1), min(self.width - 1, y + 1)):
-                if y2 not in adj_map or x2 not in adj_map[y2]:
-                    border.append([y2, x2])
-        return border
-
-    def get_px_unvisited_neighbors_from_adj_list(self, x, y, adj_map):
-        """ Return a list of points neighboring x, y """
-        neighbors = []
-        for y2 in [y - 1, y, y + 1]:
-            if y2 in adj_map:
-                for x2 in [x - 1, x, x + 1]:
-                    if x2 in adj_map[y2]:
-                        if not adj_map[y2][x2] and abs(x - x2) + abs(y - y2) < 2:
-                            neighbors.append([y2, x2])
-        return neighbors
+        mask = self.get_mask()
+        border = ndimage.binary_dilation(mask, structure=self.adjacency_structure) & ~mask
+        return self.mask_to_pixels(border)
 
     def point_to_diode_number(self, pt):
         # in photoZ diode #s
@@ -60,97 +49,124 @@ class Cluster:
         return [(diode-1) % self.width, int((diode-1) / self.width)]
 
     def is_adjacent_to(self, cluster2):
-        """ Returns True if this cluster is adjacent to cluster2 object """
-        for px in self.pixels:
-            y1, x1 = px
-            for px2 in cluster2.get_pixels():
-                y2, x2 = px2
-                if np.abs(x1 - x2) < 2 or np.abs(y1 - y2) < 2:
-                    return True
-        return False
+        """ Returns True if this cluster touches (or overlaps) cluster2 object """
+        if len(self.pixels) < 1 or len(cluster2.get_pixels()) < 1:
+            return False
+        near_self = ndimage.binary_dilation(self.get_mask(), structure=self.adjacency_structure)
+        return bool(np.any(near_self & cluster2.get_mask()))
 
     def get_cluster_size(self):
         return len(self.pixels)
 
     def get_cluster_snr(self, snr_map):
-        avg_snr = 0
-        for px in self.pixels:
-            y, x = px
-            avg_snr += snr_map[x, y]
-        return avg_snr / max(1, self.get_cluster_size())
-
-    def find_contiguous(self, pt, adj_map):
-        contig_list = [pt]
-        y, x = pt
-        adj_map[y][x] = True
-        neighbors = self.get_px_unvisited_neighbors_from_adj_list(x, y, adj_map)
-        for pt2 in neighbors:
-            y2, x2 = pt2
-            contig_list.append(pt2)
-            adj_map[y2][x2] = True
-            contig_list += self.find_contiguous(pt2, adj_map)  # recursive depth first search
-        return contig_list
-
-    def find_unvisited(self, adj_list):
-        """ Return next unvisited pixel, or None """
-        for y in adj_list:
-            for x in adj_list[y]:
-                if not adj_list[y][x]:
-                    return [y, x]
-        return None
-
-    def build_adjacency_map(self):
-        adj_map = {}
-        for px in self.pixels:
-            y, x = px
-            if y not in adj_map:
-                adj_map[y] = {}
-            adj_map[y][x] = False  # whether point has been visited
-        return adj_map
+        return np.sum(snr_map[self.get_mask()]) / max(1, self.get_cluster_size())
 
     def create_new_cluster(self, new_pixels):
         return Cluster(new_pixels, self.width)
 
     def remove_pixels(self, pixels):
-        hash_map = {}
-        for px in pixels:
-            y, x = px
-            if y not in hash_map:
-                hash_map[y] = {}
-            hash_map[y][x] = True
-        for i in range(len(self.pixels)-1, -1, -1):
-            y, x = self.pixels[i]
-            if y in hash_map and x in hash_map[y]:
-                del self.pixels[i]
+        removed = Cluster(pixels, self.width).get_mask()
+        self.pixels = [px for px in self.pixels if not removed[px[1], px[0]]]
 
     def attempt_split(self):
-        """ If possible, remove non-contiguous points and return as list of new cluster(s) """
+        """ If possible, remove non-contiguous points and return as list of new cluster(s).
+            This cluster keeps the contiguous part containing its first pixel """
         if len(self.pixels) < 2:
             return []
-        new_clusters = []
-        adj_map = self.build_adjacency_map()
-        n_visited = 0
-        pt = self.pixels[0]
-        while n_visited < len(self.pixels):
-            new_island = self.find_contiguous(pt, adj_map)
-            n_visited += len(new_island)
-
-            new_clusters.append(self.create_new_cluster(new_island))
-            self.remove_pixels(new_island)
-
-            if n_visited < len(self.pixels):
-                pt = self.find_unvisited(adj_map)
-
+        labels, n_labels = ndimage.label(self.get_mask(), structure=self.contiguity_structure)
+        if n_labels < 2:
+            return []
+        y, x = self.pixels[0]
+        keep_label = labels[x, y]
+        new_clusters = [self.create_new_cluster(self.mask_to_pixels(labels == label))
+                        for label in range(1, n_labels + 1) if label != keep_label]
+        self.pixels = [px for px in self.pixels if labels[px[1], px[0]] == keep_label]
         return new_clusters
 
     def get_df_f(self, max_amps, rli):
         """ Computer df/f, where df is the peak fluorescence change from
             RLI, and f = RLI (base fluorescence) """
-        avg_dff = 0
-        for px in self.pixels:
-            y, x = px
-            avg_dff += max_amps[x, y] / rli[x, y]
-        return avg_dff / max(1, self.get_cluster_size())
+        mask = self.get_mask()
+        return np.sum(max_amps[mask] / rli[mask]) / max(1, self.get_cluster_size())
+
+
+class ClusterLabelImage:
+    """ A set of clusters (e.g. one SNR stratum) as a single label image of a width x width map:
+        0 is background and cluster i has label i + 1. Per-cluster measures are computed for all
+        clusters at once with labeled-array operations. Clusters are assumed not to overlap """
+
+    def __init__(self, clusters, width):
+        self.width = width
+        self.labels = np.zeros((width, width), dtype=np.int32)
+        self.n_clusters = 0
+        for cluster in clusters:
+            self.add_cluster(cluster)
+
+    def add_cluster(self, cluster):
+        self.n_clusters += 1
+        self.labels[cluster.get_mask()] = self.n_clusters
+
+    def get_clusters(self):
+        """ The clusters as a list of Cluster objects, in label order """
+        clusters = [[] for _ in range(self.n_clusters)]
+        rows, cols = np.nonzero(self.labels)
+        for label, col, row in zip(self.labels[rows, cols], cols, rows):
+            clusters[label - 1].append([int(col), int(row)])
+        return [Cluster(pixels, self.width) for pixels in clusters]
+
+    def get_cluster_sizes(self):
+        return np.bincount(self.labels.ravel(), minlength=self.n_clusters + 1)[1:]
+
+    def get_cluster_means(self, value_map):
+        """ Average of value_map over each cluster """
+        sums = np.bincount(self.labels.ravel(), weights=np.asarray(value_map, dtype=np.float64).ravel(),
+                           minlength=self.n_clusters + 1)[1:]
+        return sums / np.maximum(1, self.get_cluster_sizes())
+
+    def get_cluster_snrs(self, snr_map):
+        return self.get_cluster_means(snr_map)
+
+    def get_df_fs(self, max_amps, rli):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dff = np.where(self.labels > 0, max_amps / rli, 0)
+        return self.get_cluster_means(dff)
+
+    def split(self):
+        """ Split non-contiguous clusters: each extra contiguous part gets a new label at the end.
+            The part containing the cluster's first pixel (in row-major order) keeps its label """
+        slices = ndimage.find_objects(self.labels)
+        for i, sl in enumerate(slices):
+            if sl is None:
+                continue
+            label = i + 1
+            parts, n_parts = ndimage.label(self.labels[sl] == label, structure=Cluster.contiguity_structure)
+            region = self.labels[sl]
+            for part in range(2, n_parts + 1):
+                self.n_clusters += 1
+                region[parts == part] = self.n_clusters
+        return self
+
+    def get_adjacent(self, other):
+        """ Boolean array: whether each cluster touches (or overlaps) any cluster of other ClusterLabelImage """
+        near_other = ndimage.binary_dilation(other.labels > 0, structure=Cluster.adjacency_structure)
+        adjacent = np.zeros(self.n_clusters + 1, dtype=bool)
+        adjacent[self.labels[near_other]] = True
+        return adjacent[1:]
+
+    def get_border_image(self):
+        """ Label image of the pixels bordering each cluster, outside all clusters.
+            A pixel bordering several clusters gets the largest label """
+        dilated = ndimage.grey_dilation(self.labels, footprint=Cluster.adjacency_structure)
+        return np.where(self.labels == 0, dilated, 0)
+
+    def keep(self, keep):
+        """ Keep only the clusters where boolean array keep is True, relabelled 1..n in order """
+        new_labels = np.zeros(self.n_clusters + 1, dtype=np.int32)
+        keep = np.asarray(keep, dtype=bool)
+        new_labels[1:][keep] = np.arange(1, np.count_nonzero(keep) + 1)
+        self.labels = new_labels[self.labels]
+        self.n_clusters = int(np.count_nonzero(keep))
+        return self
 
 
 class FlattenedContrastNormalizer:
@@ -241,37 +257,26 @@ class ContrastNormalizer:
 
 class GMM_ROI_Identifier:
 
-    def __init__(self):
-        pass
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
 
     def generate_points(self, snr_map, n_points=100000, percentile_cutoff=85, upper_cutoff=100):
         """ Use MC method to generate points, interpreting
-            the intensity map as a probability distribution """
-        z_max = np.max(snr_map)
+            the intensity map as a probability distribution.
+            Pixels are drawn directly with probability proportional to their SNR,
+            restricted to SNRs between the percentile cutoffs """
         cutoff = np.percentile(snr_map, percentile_cutoff)
-        if upper_cutoff == 100:
-            upper_cutoff = None
-        else:
-            upper_cutoff = np.percentile(snr_map, upper_cutoff)
-
-        samples = []
-        while len(samples) < n_points:
-            # sample a random point uniformly
-            w, h = snr_map.shape
-            x_sample = random.randint(0, w - 1)
-            y_sample = random.randint(0, h - 1)
-
-            # reject outright if SNR is below cutoff
-            if snr_map[x_sample][y_sample] < cutoff or \
-                    (upper_cutoff is not None and snr_map[x_sample][y_sample] > upper_cutoff):
-                continue
-            else:  # sample from SNR map as probability
-                z_sample = random.uniform(0, z_max)
-
-                if snr_map[x_sample][y_sample] >= z_sample:
-                    samples.append([y_sample, x_sample])
-
-        return np.array(samples)
+        in_range = snr_map >= cutoff
+        if upper_cutoff != 100:
+            in_range &= snr_map <= np.percentile(snr_map, upper_cutoff)
+        weights = np.where(in_range, np.clip(snr_map, 0, None), 0).astype(np.float64).ravel()
+        total = np.sum(weights)
+        if not total > 0:
+            raise ValueError("No pixel with positive SNR between the percentile cutoffs to sample from")
+
+        indices = self.rng.choice(weights.size, size=n_points, p=weights / total)
+        x_samples, y_samples = np.unravel_index(indices, snr_map.shape)
+        return np.stack([y_samples, x_samples], axis=1)
 
     def heatmap_of_scatter(self, samples, w, h):
         heatmap, xedges, yedges = np.histogram2d(samples[:, 0],
@@ -283,15 +288,41 @@ class GMM_ROI_Identifier:
         plt.imshow(heatmap.T, extent=extent, origin='upper')
         plt.show()
 
-    def find_gmm_cluster_number(self, X, k_start=1, k_search=40, k_step=4, aic_only=True):
+    def find_gmm_cluster_number(self, X, k_start=1, k_search=40, k_step=4, aic_only=True,
+                                n_workers=1, warm_start=False):
+        """ Fit a GMM for each k in range(k_start, k_search, k_step) and plot AIC (and BIC) vs k.
+            Fits run in n_workers processes. With warm_start, the fits run in order of k and
+            each one starts from the previous model's means plus k_step of its worst-explained points """
         n_components = np.arange(k_start, k_search, k_step)
-        models = [GaussianMixture(n, covariance_type='full', random_state=0).fit(X)
-                  for n in n_components]
+        if warm_start:
+            models = []
+            means_init = None
+            for n in n_components:
+                model = fit_gaussian_mixture(X, n, means_init=means_init)
+                models.append(model)
+                means_init = self.get_next_means_init(X, model, k_step)
+        elif n_workers > 1 and len(n_components) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     initializer=init_gmm_worker,
+                                     initargs=(X,)) as executor:
+                # largest k first: those fits take longest
+                futures = {n: executor.submit(fit_gaussian_mixture_worker, n) for n in n_components[::-1]}
+                models = [futures[n].result() for n in n_components]
+        else:
+            models = [fit_gaussian_mixture(X, n) for n in n_components]
         if not aic_only:
             plt.plot(n_components, [m.bic(X) for m in models], label='BIC')
         plt.plot(n_components, [m.aic(X) for m in models], label='AIC')
         plt.legend(loc='best')
         plt.xlabel('n_components')
+        return n_components, models
+
+    @staticmethod
+    def get_next_means_init(X, model, k_step):
+        """ Initial means for a model with k_step more components: the model's means plus
+            the k_step points the model explains worst """
+        worst = np.argsort(model.score_samples(X))[:k_step]
+        return np.concatenate([model.means_, X[worst]], axis=0)
 
     def gaussian_mixture_model(self, X, k, show=True):
         gmm = GaussianMixture(n_components=k)
@@ -324,3 +355,20 @@ class GMM_ROI_Identifier:
                     alpha=a)
         if show:
             plt.show()
+
+
+def fit_gaussian_mixture(X, n, means_init=None):
+    return GaussianMixture(n, covariance_type='full', random_state=0, means_init=means_init).fit(X)
+
+
+# worker process state for GMM_ROI_Identifier k-sweeps, set once per process
+worker_gmm_points = None
+
+
+def init_gmm_worker(X):
+    global worker_gmm_points
+    worker_gmm_points = X
+
+
+def fit_gaussian_mixture_worker(n):
+    return fit_gaussian_mixture(worker_gmm_points, n)
@@ -1,12 +1,12 @@
-#from lib.analysis.cell_roi import RandomROISample
 from lib.analysis.laminar_dist import *
 
 
 
 class Barrel_ROI_Creator():
 
-    def __init__(self, max_rois=100):
+    def __init__(self, max_rois=100, seed=None):
         self.max_rois = max_rois
+        self.rng = np.random.default_rng(seed)
 
     def get_rand_roi_filename(self, subdir, barrel_idx, file):
         return subdir + '/' + file.split('.dat')[0] +'ROIs-rand_' + str(barrel_idx) + '.dat'
@@ -22,28 +22,30 @@ class Barrel_ROI_Creator():
                 barrel_roi_map[px_string] = i
         return barrel_roi_map
     
-    def get_rand_rois(self, barrel_rois, roi_dimensions=1):
-        """ Creates random circular rois in the barrel roi. Barrel ROI is list of list of [x, y] points that define the barrel.
-            Returns list of rois. """
-        barrel_roi_map = self.create_barreL_roi_map(barrel_rois)
-
-        new_rois = {i: [] for i in range(len(barrel_rois))}
-        nr_map = {}
-
-        roi_sampler = RandomROISample(roi_dimensions)
-        while(any([len(new_rois[k]) < self.max_rois for k in new_rois])):
-                i, j = roi_sampler.get_random_point()
-                px_string = str(j) + ',' + str(i)
-                if px_string not in barrel_roi_map \
-                    or (j,i) in nr_map:
-                    continue
-                else:
-                    barrel_idx = barrel_roi_map[px_string]
-                    if len(new_rois[barrel_idx]) < self.max_rois:
-                        new_rois[barrel_idx].append([j, i])
-                    nr_map[(j, i)] = 1
+    def create_barrel_label_image(self, barrel_rois, h=80, w=80):
+        """ w x h array of the barrel index of each pixel [x, y], -1 outside all barrels.
+            A pixel in several barrels belongs to the last one, as in create_barreL_roi_map """
+        labels = np.full((w, h), -1, dtype=int)
+        for i in range(len(barrel_rois)):
+            if len(barrel_rois[i]) == 0:
+                continue
+            px = np.array(barrel_rois[i], dtype=int).reshape(-1, 2)
+            px = px[(px[:, 0] >= 0) & (px[:, 0] < w) & (px[:, 1] >= 0) & (px[:, 1] < h)]
+            labels[px[:, 0], px[:, 1]] = i
+        return labels
+
+    def get_rand_rois(self, barrel_rois, roi_dimensions=1, h=80, w=80):
+        """ Creates random single-pixel rois in the barrel roi. Barrel ROI is list of list of [x, y] points that define the barrel.
+            Returns barrel_idx: list of up to max_rois distinct [x, y] points, in random order. """
+        labels = self.create_barrel_label_image(barrel_rois, h=h, w=w)
+
+        new_rois = {}
+        for i in range(len(barrel_rois)):
+            px = np.argwhere(labels == i)
+            n = min(self.max_rois, len(px))
+            new_rois[i] = px[self.rng.permutation(len(px))[:n]].tolist()
         return new_rois
-    
+
     def get_barrel_idx_of_point(self, barrel_roi_map, px):
         px_string = str(px[0]) + ',' + str(px[1])
         if px_string not in barrel_roi_map:
@@ -9,6 +9,7 @@ from lib.analysis.align import *
 from lib.file.ROI_reader import ROIFileReader as ROIFileReaderLegacy
 from lib.file.ROI_writer import ROIFileWriter
 from lib.analysis.barrel_roi import Barrel_ROI_Creator
+from lib.file.dataset_index import DatasetIndex
 
 from lib.analysis.roi_annotator import MaxSNRROIAnnotator
 from ZDA_Adventure.utility import *
@@ -89,9 +90,11 @@ class SingleCellFinder:
 
 class RandomROISample:
     """ An ROI object that creates random samples of specified size.
-        Max ROIs is specified, but as many as possible under the limit are created."""
+        Max ROIs is specified, but as many as possible under the limit are created.
+        ROIs are cut from a stencil of pixel offsets sorted by distance, and overlaps are tested
+        against a bitmap of occupied pixels. Pass seed (or a numpy Generator) for a reproducible sample."""
 
-    def __init__(self, n_px_per_roi, max_rois=100, width=80, height=80):
+    def __init__(self, n_px_per_roi, max_rois=100, width=80, height=80, seed=None):
         self.w = width
         self.h = height
         self.max_rois = max_rois
@@ -105,6 +108,12 @@ class RandomROISample:
         self.px_per_roi = n_px_per_roi
         self.overlap_counter = OverlapCounterROI([], [])
         self.centers = []
+        self.rng = np.random.default_rng(seed)
+
+        self.stencil, self.stencil_dist = self.create_stencil()
+        # ROI of a center far enough from the edges that no pixel within the ROI radius is clipped
+        self.interior_roi = self.select_roi_pixels(self.stencil, self.stencil_dist)
+        self.interior_margin = int(self.stencil_dist[min(self.px_per_roi, len(self.stencil_dist)) - 1])
 
     def get_roi_centers(self):
         return self.centers
@@ -114,65 +123,96 @@ class RandomROISample:
 
     def get_random_point(self):
         return [
-            random.randint(0, self.w-1),
-            random.randint(0, self.h-1)
+            int(self.rng.integers(0, self.w)),
+            int(self.rng.integers(0, self.h))
         ]
 
+    def create_stencil(self):
+        """ Pixel offsets [dx, dy] sorted by distance, out to the largest radius an ROI can need:
+            that of a center in a corner of the array, where only a quarter of the disk is in bounds """
+        dx, dy = np.meshgrid(np.arange(self.w), np.arange(self.h), indexing='ij')
+        corner_dist = np.sort(np.sqrt(dx * dx + dy * dy), axis=None)
+        max_radius = corner_dist[min(self.px_per_roi, corner_dist.size) - 1]
+
+        r = int(np.ceil(max_radius))
+        dx, dy = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1), indexing='ij')
+        dx, dy = dx.ravel(), dy.ravel()
+        dist = np.sqrt(dx * dx + dy * dy)
+        order = np.argsort(dist, kind='stable')
+        order = order[dist[order] <= max_radius]
+        return np.stack([dx[order], dy[order]], axis=1), dist[order]
+
+    def select_roi_pixels(self, pts, dist):
+        """ The px_per_roi closest points, ties at the ROI radius broken in [x, y] order.
+            pts are sorted by dist """
+        if len(pts) == 0:
+            return pts
+        eff_radius = dist[min(self.px_per_roi, len(dist)) - 1]
+        pts = pts[dist <= eff_radius]
+        pts = pts[np.lexsort((pts[:, 1], pts[:, 0]))]
+        return pts[:self.px_per_roi]
+
+    def get_circle_roi_pixels(self, center):
+        """ create_circle_roi as an array of [x, y] pixels """
+        x, y = center
+        m = self.interior_margin
+        if m <= x < self.w - m and m <= y < self.h - m:
+            return self.interior_roi + [x, y]
+
+        # near the edges: the ROI grows into the pixels left in bounds
+        pts = self.stencil + [x, y]
+        in_bounds = (pts[:, 0] >= 0) & (pts[:, 0] < self.w) & (pts[:, 1] >= 0) & (pts[:, 1] < self.h)
+        return self.select_roi_pixels(pts[in_bounds], self.stencil_dist[in_bounds])
+
+    def get_mask_bitmap(self, mask):
+        """ Boolean w x h array of the pixels in mask (list of [x, y]). No mask: all pixels """
+        if mask is None:
+            return np.ones((self.w, self.h), dtype=bool)
+        in_mask = np.zeros((self.w, self.h), dtype=bool)
+        if len(mask) > 0:
+            px = np.array(mask, dtype=int).reshape(-1, 2)
+            px = px[(px[:, 0] >= 0) & (px[:, 0] < self.w) & (px[:, 1] >= 0) & (px[:, 1] < self.h)]
+            in_mask[px[:, 0], px[:, 1]] = True
+        return in_mask
+
+    def get_candidate_centers(self, in_mask):
+        """ [x, y] of every center whose ROI can reach a pixel of the mask """
+        near_mask = np.zeros_like(in_mask)
+        xs, ys = np.nonzero(in_mask)
+        for dx, dy in self.stencil:
+            cx, cy = xs - dx, ys - dy
+            ok = (cx >= 0) & (cx < self.w) & (cy >= 0) & (cy < self.h)
+            near_mask[cx[ok], cy[ok]] = True
+        return np.argwhere(near_mask)
+
     def take_random_sample(self, mask=None):
+        """ Non-overlapping ROIs that each overlap the mask, from centers drawn in random order """
         roi_list = []
+        occupied = np.zeros((self.w, self.h), dtype=bool)
+        in_mask = self.get_mask_bitmap(mask)
+        candidates = self.get_candidate_centers(in_mask)
 
-        # track whether we've failed to add any new ROIs recently (due to overlap)
+        # track failures (overlap with a previous ROI or outside the mask)
         n_failures = 0
 
-        while len(roi_list) < self.max_rois:
-
-            # randomly sample and look for overlaps.
-            center = self.get_random_point()
-            potential_roi = self.create_circle_roi(center)
-
-            failure = False
-            for roi in roi_list:
-                if self.do_rois_overlap(roi, potential_roi):
-                    failure = True
-            if not self.do_rois_overlap(mask, potential_roi):
-                failure = True
-            if not failure:
-                roi_list.append(potential_roi)
-                self.centers.append(center)
-            else:
-                # track failures to guarantee halting
+        for center in candidates[self.rng.permutation(len(candidates))]:
+            if len(roi_list) >= self.max_rois:
+                break
+            roi = self.get_circle_roi_pixels(center)
+            xs, ys = roi[:, 0], roi[:, 1]
+            if occupied[xs, ys].any() or not in_mask[xs, ys].any():
                 n_failures += 1
-            
-            if n_failures > int(self.max_rois * 5):
-                print("n_failures: " + str(n_failures))
-                return roi_list
-            
+                continue
+            occupied[xs, ys] = True
+            roi_list.append(roi.tolist())
+            self.centers.append(center.tolist())
+
         print("n_failures: " + str(n_failures))
         return roi_list
 
     def create_circle_roi(self, center):
         """ Create an ROI of the px num located at center"""
-        dist_matrix = np.zeros((self.w, self.h))
-        n_smallest_distances = []
-        for i in range(self.w):
-            for j in range(self.h):
-                d = Line([i, j], center).get_length()
-                dist_matrix[i][j] = d
-                if len(n_smallest_distances) < 1 or d < n_smallest_distances[-1]:
-                    n_smallest_distances.append(d)
-                    n_smallest_distances.sort()
-                    if len(n_smallest_distances) > self.px_per_roi:
-                        n_smallest_distances.pop()
-
-        eff_radius = n_smallest_distances[-1]
-        roi = []
-        for i in range(self.w):
-            for j in range(self.h):
-                if dist_matrix[i][j] <= eff_radius:
-                    roi.append([i, j])
-                if len(roi) >= self.px_per_roi:
-                    return roi[:self.px_per_roi]
-        return roi[:self.px_per_roi]
+        return self.get_circle_roi_pixels(center).tolist()
 
 class ROIWizard:
     """ 
@@ -193,7 +233,8 @@ class ROIWizard:
             measure_window_width=0,
             enable_temporal_filter=True,
             enable_spatial_filter=False,
-            spatial_filter_sigma=1.0,):
+            spatial_filter_sigma=1.0,
+            random_seed=None):
         self.data_dir = data_dir
         self.n_px_per_roi = n_px_per_roi
         self.max_rois = max_rois
@@ -217,7 +258,9 @@ class ROIWizard:
         self.enable_temporal_filter = enable_temporal_filter
         self.enable_spatial_filter = enable_spatial_filter
         self.spatial_filter_sigma = spatial_filter_sigma
+        self.rng = np.random.default_rng(random_seed)  # random ROIs are reproducible given random_seed
         self.keywords_to_exclude = ['amp', 'snr', 'sd', 'latency', 'halfwidth', 'trace', 'stim_time', 'max_amp', 'rli']
+        self.dataset_index = DatasetIndex.for_data_dir(self.data_dir)
 
         # Ladder
         self.corners_keyword = 'corners'
@@ -230,13 +273,13 @@ class ROIWizard:
         keywords_to_exclude = self.keywords_to_exclude
         if self.roi_file_exclusion_keyword is not None and len(self.roi_file_exclusion_keyword) > 0:
             keywords_to_exclude.append(self.roi_file_exclusion_keyword)
-        for file in os.listdir(subdir):
+        for file in self.dataset_index.listdir(subdir):
             if str(rec_id) in file and roi_keyword in file:
                     if not any(exclude_kw in file for exclude_kw in keywords_to_exclude):
                         roi_files.append(file)
         if not shallow_search:
             # also search in subdirectories of subdir
-            for root, dirs, files in os.walk(subdir):
+            for root, dirs, files in self.dataset_index.walk(subdir):
                 # prepend the relative path to the file
                 relative_path = os.path.relpath(root, subdir)
 
@@ -257,6 +300,7 @@ class ROIWizard:
                           "Ladder": 'ladder',
                           "3x3 SNR Maximal": "snr3x3",
                           "5x5 SNR Maximal": "snr5x5",
+                          "7x7 SNR Maximal": "snr7x7",
                           "Masked Grid": "masked_grid"
                           }[self.roi_type]
         if roi_idx == "":
@@ -264,7 +308,7 @@ class ROIWizard:
         return subdir + '/' + file.split('.dat')[0] +self.output_keyword + "_" + roi_type_short +"_" + str(roi_idx) + '.dat'
 
     def get_stripe_dir_files(self, subdir, file):
-        stripe_dir_files = os.listdir(subdir)
+        stripe_dir_files = self.dataset_index.listdir(subdir)
         file_prefix = file.split('.dat')[0]
         if self.stripe_dir_keyword is not None:
             stripe_dir_files = [f for f in stripe_dir_files if self.stripe_dir_keyword in f]
@@ -275,7 +319,7 @@ class ROIWizard:
 
     def get_corners_file(self, subdir, file):
         file_prefix = file.split('.dat')[0]
-        corner_files = os.listdir(subdir)
+        corner_files = self.dataset_index.listdir(subdir)
         corner_files = [f for f in corner_files if self.corners_keyword in f and f.endswith('.dat')]
         corner_files = [f for f in corner_files if not (self.output_keyword in f)]
         corner_files = [f for f in corner_files if file_prefix in f]
@@ -336,7 +380,7 @@ class ROIWizard:
         prev_slic, prev_loc, prev_roi_file = None, None, None
         slic, loc, rec = None, None, None
         roi_file = None
-        for subdir, dirs, files in os.walk(self.data_dir):
+        for subdir, dirs, files in self.dataset_index.walk(self.data_dir):
 
             msra = MaxSNRROIAnnotator(subdir, roi_scan_radius=(box_size-1)//2,
                                       measure_window_start=self.measure_window_start,
@@ -381,16 +425,14 @@ class ROIWizard:
                     # load zda file 
                     dl = DataLoader(zda_full_path)
 
-                    zda_arr = tools.Polynomial(startPt=self.skip_window_start,
-                                                numPt=self.skip_window_width,
-                                                Data=zda_arr)
-                    
-                    zda_arr = dl.get_data(rli_division=False)
-                    tools = Tools()
-                    if self.enable_temporal_filter:
-                        zda_arr = tools.T_filter(Data=zda_arr)
-                    if self.enable_spatial_filter:
-                        zda_arr = tools.S_filter(Data=zda_arr, sigma=self.spatial_filter_sigma)
+                    preprocessor = Preprocessor(skip_window_start=self.skip_window_start,
+                                                skip_window_width=self.skip_window_width,
+                                                rli_division=False,
+                                                temporal_filter=self.enable_temporal_filter,
+                                                spatial_filter=self.enable_spatial_filter,
+                                                spatial_filter_sigma=self.spatial_filter_sigma)
+                    zda_arr, _ = PreprocessCache.get_default().run(preprocessor, zda_full_path,
+                                                                   lambda: (dl.get_data(), None))
 
                     zda_arr = np.mean(zda_arr, axis=0)  # average across trials
                     new_rois = []
@@ -458,7 +500,6 @@ class ROIWizard:
         '''take sample of MAX_ROIS random pixels from barrel ROIs'''
         
         new_rois = {i: [] for i in range(len(barrel_rois))}
-        roi_sampler = RandomROISample(self.n_px_per_roi, max_rois=self.max_rois)
 
         # remove any barrel_rois that are smaller than n_px_per_roi * 5
         #barrel_rois = [roi for roi in barrel_rois if len(roi) > self.n_px_per_roi * 5]
@@ -467,32 +508,16 @@ class ROIWizard:
         if len(barrel_rois) == 0:
             return new_rois
 
-        nr_map = {}
-        infinite_loop_guard = 0
         if self.n_px_per_roi == 1:
-            while(any([(len(new_rois[k]) < min(self.max_rois, len(barrel_rois[k])-1)) for k in new_rois])):
-                i, j = roi_sampler.get_random_point()
-                px_string = str(j) + ',' + str(i)
-                infinite_loop_guard += 1
-                if infinite_loop_guard > 10000:
-                    print("Infinite loop guard triggered. Returning current ROIs.")
-                    print(len(new_rois))
-                    return new_rois
-                if px_string not in barrel_roi_map \
-                    or (j,i) in nr_map:
-                    continue
-                else:
-                    barrel_idx = barrel_roi_map[px_string]
-                    if barrel_idx in new_rois and len(new_rois[barrel_idx]) < self.max_rois:
-                        new_rois[barrel_idx].append([[j, i]])
-                        infinite_loop_guard = 0
-                    nr_map[(j, i)] = 1
+            rand_px = Barrel_ROI_Creator(max_rois=self.max_rois, seed=self.rng).get_rand_rois(barrel_rois)
+            for i in rand_px:
+                new_rois[i] = [[px] for px in rand_px[i]]
             print(len(new_rois))
             return new_rois
         elif self.n_px_per_roi > 1:
             print("Creating random ROIs. {} ROIs per barrel, {} pixels per ROI.".format(self.max_rois, self.n_px_per_roi))
             for i in range(len(barrel_rois)):
-                roi_sampler = RandomROISample(self.n_px_per_roi, max_rois=self.max_rois)
+                roi_sampler = RandomROISample(self.n_px_per_roi, max_rois=self.max_rois, seed=self.rng)
                 new_rois[i] = roi_sampler.take_random_sample(mask=barrel_rois[i])
             return new_rois
 
@@ -503,13 +528,15 @@ class ROIWizard:
             return self.create_snr_maximal_rois(box_size=3)
         elif self.roi_type == '5x5 SNR Maximal':
             return self.create_snr_maximal_rois(box_size=5)
+        elif self.roi_type == '7x7 SNR Maximal':
+            return self.create_snr_maximal_rois(box_size=7)
         pa.alert("Input ROI files will be read from:\n" + self.data_dir + "obeying the following rules:\n" +
             "- ROI files must contain the keyword: " + self.roi_keyword + "\n" +
             "- ROI files must end with .dat\n" +
             "- ROI files must NOT contain the keyword: " + self.stripe_dir_keyword + "\n" +
             "- ROI files must NOT contain the keyword: " + self.output_keyword + "\n" +
             "- ROI files must NOT contain the keyword: " + self.corners_keyword + "\n")
-        for subdir, dirs, files in os.walk(self.data_dir):
+        for subdir, dirs, files in self.dataset_index.walk(self.data_dir):
 
             for file in files:
                 if self.roi_keyword in file and file.endswith('.dat') \
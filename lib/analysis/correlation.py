@@ -1,6 +1,8 @@
+import os
 import numpy as np
-from scipy import signal
-from statsmodels.tsa.stattools import grangercausalitytests
+from scipy import stats, sparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import gc
 import matplotlib.pyplot as plt
 import random
@@ -21,10 +23,21 @@ class FunctionalConnectivityMatrix:
 
     The correlation is computed using the Pearson correlation coefficient, 
     mutual information, or other correlation measures.
+
+    All pairs are computed at once with matrix products: the rows of set1 are processed
+    in blocks of BLOCK_SIZE series (against blocks of set2), which caps memory use for
+    pixel-level matrices, and blocks are spread over NUM_WORKERS processes if > 1.
+    compute_correlation_to_disk writes the blocks to disk instead, optionally keeping
+    only the strongest edges of each row.
     """
 
-    def __init__(self, measure_windows=None):
+    # most pairs plotted per call when plot_rate > 0
+    max_plots = 10
+
+    def __init__(self, measure_windows=None, block_size=256, num_workers=1):
         self.measure_windows = measure_windows
+        self.block_size = block_size
+        self.num_workers = num_workers
 
     def compute_correlation(self, set1, set2, method='max_cross_corr', max_lag=12, lag=None, plot_rate=0.1):
         """
@@ -33,85 +46,260 @@ class FunctionalConnectivityMatrix:
         Args:
             set1: List of time series (e.g., pixels) from the first set.
             set2: List of time series (e.g., pixels) from the second set.
+            method: 'pearson' (at a single lag), 'max_cross_corr' (cross-correlation
+                at lags 1..max_lag), or 'granger' (1 - p-value of the SSR F-test that the
+                set1 series Granger-causes the set2 series, at lags 1..max_lag).
             plot_rate: What fraction of the time series to plot.
 
         Returns:
-            A 2D NumPy array representing the functional connectivity matrix.
+            A 2D NumPy array representing the functional connectivity matrix, or for the lag
+            methods a 3D array (set1 x set2 x lag) and the array of lags.
         """
 
         if method not in ['pearson', 'max_cross_corr', 'granger']:
             raise ValueError("Unsupported method.")
 
-        def max_cross_corr(ts1, ts2, lag=max_lag):
-            """
-            if ts2 is a lagged signal, computes the
-            maximum cross-correlation between ts1 and ts2 within a lag up to LAG
-            """
-            corr = signal.correlate(ts1, ts2, mode='full')
-            lags = signal.correlation_lags(len(ts1), len(ts2), mode='full')
-            
-            corr = corr[(lags > 0) & (lags <= lag)]
-            return min(1, np.max(corr) / 40)
-
-        def pearson_corr(ts1, ts2, lag=lag, normalize=True, plot_rate=plot_rate):
-            """
-            Compute the Pearson correlation coefficient between two time series.
-            """
-            ts1 = np.array(ts1)
-            ts2 = np.array(ts2)
-            if lag is None:
-                lag = 0
-            # shift ts2 forward by lag
-            ts1_, ts2_ = self._apply_measure_windows_and_lag_ts(ts1, ts2, lag, normalize=normalize, plot_rate=plot_rate)
-            res = np.corrcoef(ts1_, ts2_)[0, 1]
-
-            return res
-
-        def granger_causality(ts1, ts2, max_lag=max_lag):
-            """
-            Compute the Granger causality between two time series. Does the first
-            time series cause the second one?
-            """
-            ts1 = np.array(ts1).reshape(-1, 1)
-            ts2 = np.array(ts2).reshape(-1, 1)
-            test_result = grangercausalitytests(np.hstack((ts2, ts1)), max_lag, verbose=False)
-            
-            p_values = [1 - test[0]['ssr_ftest'][1] for test in test_result.values()]
-            lags = np.array(list(test_result.keys()))
-            return p_values, lags
-
-        corr_function = pearson_corr if method == 'pearson' else max_cross_corr \
-            if method == 'max_cross_corr' else granger_causality \
-            if method == 'granger' else None
-
         is_lag_analysis = (method in ['max_cross_corr', 'granger'])
 
-        # need to apply measure winndows after the lag is applied
-        # to avoid correlation artifacts
-        #if self.measure_windows:
-        #    set1 = self._apply_measure_windows(set1)
-        #    set2 = self._apply_measure_windows(set2)
+        X1, X2, lag = self._prepare_series(set1, set2, method, lag)
 
-        num_rows = len(set1)
-        num_cols = len(set2)
-        fc_matrix = None
+        num_rows = len(X1)
+        num_cols = len(X2)
+        lags = np.arange(1, max_lag + 1)
         if not is_lag_analysis:
             fc_matrix = np.zeros((num_rows, num_cols))
         else:
             fc_matrix = np.zeros((num_rows, num_cols, max_lag))
 
-        for i, ts1 in enumerate(set1):
-            for j, ts2 in enumerate(set2):
-                if not is_lag_analysis:
-                    fc_matrix[i, j] = corr_function(ts1, ts2)
-                else:
-                    p_values, lags = corr_function(ts1, ts2, max_lag)
-                    fc_matrix[i, j, :] = p_values
+        for r0, r1, block in self._iter_row_blocks(method, X1, X2, max_lag):
+            fc_matrix[r0:r1] = block
+        gc.collect()
+
+        if method == 'pearson' and plot_rate > 0:
+            self._plot_sample_pairs(set1, set2, lag, plot_rate)
 
         if is_lag_analysis:
             return fc_matrix, lags
         return fc_matrix
 
+    def compute_correlation_to_disk(self, set1, set2, filename, method='max_cross_corr', max_lag=12, lag=None,
+                                    top_k=None, threshold=None):
+        """
+        Out-of-core compute_correlation, for matrices too large for memory (e.g. pixel x pixel x lag).
+        The matrix is computed in blocks of BLOCK_SIZE rows of set1, and each block is written
+        to disk before the next is computed.
+
+        Args:
+            set1, set2, method, max_lag, lag: As for compute_correlation.
+            filename: Without top_k and threshold, a .npy file that receives the full matrix,
+                returned memory-mapped. Otherwise an .npz file of the kept edges only (see load_edges).
+            top_k: Keep the top_k strongest edges of each row.
+            threshold: Keep only edges at least this strong.
+                The strength of an edge is its value, or for the lag methods its maximum over
+                the lags; the lag of that maximum is kept with it.
+
+        Returns:
+            The memory-mapped matrix (and the lags for the lag methods), or the kept edges
+            as returned by load_edges.
+        """
+        if method not in ['pearson', 'max_cross_corr', 'granger']:
+            raise ValueError("Unsupported method.")
+
+        is_lag_analysis = (method in ['max_cross_corr', 'granger'])
+        is_sparse = top_k is not None or threshold is not None
+
+        X1, X2, lag = self._prepare_series(set1, set2, method, lag)
+        lags = np.arange(1, max_lag + 1)
+        shape = (len(X1), len(X2), max_lag) if is_lag_analysis else (len(X1), len(X2))
+
+        # written under a temporary name and renamed, so an interrupted run never leaves a partial matrix
+        tmp_filename = filename + ".part"
+        if not is_sparse:
+            fc_matrix = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=np.float64, shape=shape)
+            for r0, r1, block in self._iter_row_blocks(method, X1, X2, max_lag):
+                fc_matrix[r0:r1] = block
+                fc_matrix.flush()
+            del fc_matrix
+            os.replace(tmp_filename, filename)
+            fc_matrix = np.load(filename, mmap_mode='r')
+            if is_lag_analysis:
+                return fc_matrix, lags
+            return fc_matrix
+
+        row_counts = np.zeros(len(X1), dtype=np.int64)
+        indices, data, edge_lags = [], [], []
+        for r0, r1, block in self._iter_row_blocks(method, X1, X2, max_lag):
+            block = np.where(np.isnan(block), -np.inf, block)
+            strength = block
+            if is_lag_analysis:
+                i_lag = np.argmax(block, axis=2)
+                strength = np.take_along_axis(block, i_lag[:, :, np.newaxis], axis=2)[:, :, 0]
+            keep = np.isfinite(strength)
+            if threshold is not None:
+                keep &= (strength >= threshold)
+            if top_k is not None and top_k < strength.shape[1]:
+                top = np.zeros_like(keep)
+                i_top = np.argpartition(-strength, top_k - 1, axis=1)[:, :top_k]
+                np.put_along_axis(top, i_top, True, axis=1)
+                keep &= top
+            rows, cols = np.nonzero(keep)
+            row_counts[r0:r1] = np.bincount(rows, minlength=r1 - r0)
+            indices.append(cols)
+            data.append(strength[rows, cols])
+            if is_lag_analysis:
+                edge_lags.append(lags[i_lag[rows, cols]])
+
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f,
+                     shape=np.array(shape[:2]),
+                     indptr=np.concatenate([[0], np.cumsum(row_counts)]),
+                     indices=np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.int64),
+                     data=np.concatenate(data) if len(data) > 0 else np.zeros(0),
+                     lags=np.concatenate(edge_lags) if len(edge_lags) > 0 else np.zeros(0, dtype=np.int64))
+        os.replace(tmp_filename, filename)
+        return self.load_edges(filename)
+
+    @staticmethod
+    def load_edges(filename):
+        """
+        Load the edges written by compute_correlation_to_disk with top_k or threshold.
+
+        Returns:
+            A sparse (CSR) matrix of edge strengths, set1 x set2, and a sparse matrix of
+            the lag of each edge (None for a Pearson matrix).
+        """
+        with np.load(filename) as npz:
+            shape = tuple(npz['shape'])
+            indptr, indices = npz['indptr'], npz['indices']
+            strengths = sparse.csr_matrix((npz['data'], indices, indptr), shape=shape)
+            edge_lags = None
+            if len(npz['lags']) == len(indices) and len(indices) > 0:
+                edge_lags = sparse.csr_matrix((npz['lags'], indices, indptr), shape=shape)
+        return strengths, edge_lags
+
+    def _prepare_series(self, set1, set2, method, lag):
+        """ Series as arrays, with measure windows, lag and normalization applied for Pearson """
+        X1 = np.asarray(set1, dtype=np.float64)
+        X2 = np.asarray(set2, dtype=np.float64)
+        if method == 'pearson':
+            if lag is None:
+                lag = 0
+            # measure windows are applied after the lag is applied, to avoid correlation artifacts;
+            # then each series is z-normalized once, so that correlations are dot products
+            X1, X2 = self._apply_measure_windows_and_lag(X1, X2, lag)
+            X1, X2 = self._z_normalize(X1), self._z_normalize(X2)
+        return X1, X2, lag
+
+    def _iter_row_blocks(self, method, X1, X2, max_lag):
+        """ Yield (r0, r1, connectivity of rows r0:r1 of X1) in row order. With a process pool,
+            at most 2 blocks per worker are in flight, so finished blocks do not pile up in memory """
+        row_blocks = [(r0, min(r0 + self.block_size, len(X1))) for r0 in range(0, len(X1), self.block_size)]
+        if self.num_workers > 1 and len(row_blocks) > 1:
+            with ProcessPoolExecutor(max_workers=self.num_workers,
+                                     initializer=init_connectivity_worker,
+                                     initargs=(self, method, X2, max_lag)) as executor:
+                pending = deque()
+                for r0, r1 in row_blocks:
+                    pending.append((r0, r1, executor.submit(compute_connectivity_block_worker, X1[r0:r1])))
+                    if len(pending) >= 2 * self.num_workers:
+                        r0, r1, future = pending.popleft()
+                        yield r0, r1, future.result()
+                while len(pending) > 0:
+                    r0, r1, future = pending.popleft()
+                    yield r0, r1, future.result()
+        else:
+            for r0, r1 in row_blocks:
+                yield r0, r1, self._compute_block(method, X1[r0:r1], X2, max_lag)
+
+    def _compute_block(self, method, X1, X2, max_lag):
+        """ Connectivity of rows X1 (a block of set1) with all of X2, in blocks of X2 """
+        blocks = []
+        for c0 in range(0, len(X2), self.block_size):
+            X2_block = X2[c0:c0 + self.block_size]
+            if method == 'pearson':
+                blocks.append(X1 @ X2_block.T)
+            elif method == 'max_cross_corr':
+                blocks.append(self._cross_corr(X1, X2_block, max_lag))
+            else:
+                blocks.append(self._granger_causality(X1, X2_block, max_lag))
+        if len(blocks) == 0:
+            return np.zeros((len(X1), 0) if method == 'pearson' else (len(X1), 0, max_lag))
+        return np.concatenate(blocks, axis=1)
+
+    @staticmethod
+    def _z_normalize(X):
+        """ Zero mean, unit norm rows: the dot product of two rows is their Pearson correlation """
+        Z = X - X.mean(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return Z / np.linalg.norm(Z, axis=1, keepdims=True)
+
+    @staticmethod
+    def _cross_corr(X1, X2, max_lag):
+        """
+        If X2 holds lagged signals, the cross-correlation of each pair, as signal.correlate
+        computes it, at lags 1..max_lag (scaled by 1/40 and capped at 1).
+        Its maximum over the lag axis is the maximum cross-correlation within max_lag.
+        """
+        n1, n2 = X1.shape[1], X2.shape[1]
+        corr = np.full((len(X1), len(X2), max_lag), np.nan)
+        for k in range(1, max_lag + 1):
+            m = min(n1 - k, n2)
+            if m > 0:
+                # correlate(ts1, ts2)[lag k] = sum_n ts1[n + k] * ts2[n]
+                corr[:, :, k - 1] = X1[:, k:k + m] @ X2[:, :m].T
+        return np.minimum(1, corr / 40)
+
+    @staticmethod
+    def _granger_causality(X1, X2, max_lag):
+        """
+        Compute the Granger causality between all pairs of time series. Does the first
+        time series (rows of X1) cause the second one (rows of X2)?
+        Per lag p, the SSR F-test of statsmodels' grangercausalitytests, with the OLS fits
+        batched: the target's own-lag fit is shared by all rows of X1, and the rows' lags
+        are tested against the residual of that fit.
+        Returns 1 - p-value per pair and lag.
+        """
+        n_pts = X2.shape[1]
+        result = np.zeros((len(X1), len(X2), max_lag))
+        for p in range(1, max_lag + 1):
+            n_obs = n_pts - p
+            df_resid = n_obs - 2 * p - 1
+            if df_resid <= 0:
+                result[:, :, p - 1] = np.nan
+                continue
+            y = X2[:, p:]  # target (n2, n_obs)
+            # lagged series: [..., i] is the series at t - (i + 1)
+            y_lags = np.stack([X2[:, p - i - 1:n_pts - i - 1] for i in range(p)], axis=2)
+            x_lags = np.stack([X1[:, p - i - 1:n_pts - i - 1] for i in range(p)], axis=2)
+
+            # restricted model: constant + own lags, one fit per target
+            own = np.concatenate([np.ones((len(X2), n_obs, 1)), y_lags], axis=2)
+            q, _ = np.linalg.qr(own)  # (n2, n_obs, p + 1)
+            resid = y - np.matmul(q, np.matmul(y[:, np.newaxis, :], q).transpose(0, 2, 1))[:, :, 0]
+            ssr_own = np.sum(resid * resid, axis=1)
+
+            # unrestricted model: add the other series' lags, projected off the restricted design.
+            # qx[i, j] = q_j^T x_i for all pairs as one matrix product
+            n1, n2 = len(X1), len(X2)
+            qx = (q.transpose(0, 2, 1).reshape(n2 * (p + 1), n_obs)
+                  @ x_lags.transpose(1, 0, 2).reshape(n_obs, n1 * p))
+            qx = qx.reshape(n2, p + 1, n1, p).transpose(2, 0, 1, 3)
+            gram = np.matmul(x_lags.transpose(0, 2, 1), x_lags)[:, np.newaxis] \
+                - np.matmul(qx.transpose(0, 1, 3, 2), qx)
+            xr = np.matmul(x_lags.transpose(0, 2, 1), resid.T).transpose(0, 2, 1)  # (n1, n2, p)
+            try:
+                coef = np.linalg.solve(gram, xr[..., np.newaxis])[..., 0]
+            except np.linalg.LinAlgError:
+                # a constant series makes its fit singular: least squares, as statsmodels' pinv does
+                coef = np.matmul(np.linalg.pinv(gram, hermitian=True), xr[..., np.newaxis])[..., 0]
+            explained = np.sum(xr * coef, axis=2)
+            ssr_joint = ssr_own[np.newaxis, :] - explained
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                f_stat = (ssr_own[np.newaxis, :] - ssr_joint) / ssr_joint / p * df_resid
+            result[:, :, p - 1] = 1 - stats.f.sf(f_stat, p, df_resid)
+        return result
+
     def _apply_measure_windows(self, time_series_set):
         """
         Apply the measure windows to the time series.
@@ -120,12 +308,12 @@ class FunctionalConnectivityMatrix:
             time_series: List of time series.
 
         Returns:
-            A list of time series with measure windows applied.
+            An array of time series with measure windows applied.
         """
-        filtered_series = []
-        for ts in time_series_set:
-            filtered_series.append(self._apply_measure_windows_ts(filtered_ts))
-        return filtered_series
+        X = np.asarray(time_series_set)
+        if not self.measure_windows:
+            return X
+        return np.concatenate([X[:, start:end] for start, end in self.measure_windows], axis=1)
 
     def _apply_measure_windows_ts(self, ts):
         """
@@ -143,6 +331,43 @@ class FunctionalConnectivityMatrix:
             filtered_ts.extend(ts[start:end])
         return filtered_ts
 
+    def _apply_measure_windows_and_lag(self, X1, X2, lag, normalize=True):
+        """
+        _apply_measure_windows_and_lag_ts for every series at once.
+
+        Args:
+            X1, X2: arrays of time series, one per row.
+
+        Returns:
+            The two arrays with measure windows and lag applied.
+        """
+        measure_windows = self.measure_windows
+        if not measure_windows:
+            measure_windows = [(0, None)]
+        filtered_X1 = []
+        filtered_X2 = []
+        for start, end in measure_windows:
+            sub1 = X1[:, start:end]
+            sub2 = X2[:, start:end]
+            if normalize:  # normalize both to the same max
+                sub1 = sub1 / np.max(sub1, axis=1, keepdims=True)
+                sub2 = sub2 / np.max(sub2, axis=1, keepdims=True)
+
+            # apply lag to X2
+            sub2 = sub2[:, lag:]
+            sub1 = sub1[:, :sub2.shape[1]]
+            filtered_X1.append(sub1)
+            filtered_X2.append(sub2)
+        return np.concatenate(filtered_X1, axis=1), np.concatenate(filtered_X2, axis=1)
+
+    def _plot_sample_pairs(self, set1, set2, lag, plot_rate):
+        """ Plot a random sample of about plot_rate of the pairs, at most max_plots """
+        n_pairs = len(set1) * len(set2)
+        n_plots = min(self.max_plots, sum(random.random() < plot_rate for _ in range(min(n_pairs, 1000))))
+        for _ in range(n_plots):
+            ts1 = np.array(set1[random.randrange(len(set1))])
+            ts2 = np.array(set2[random.randrange(len(set2))])
+            self._apply_measure_windows_and_lag_ts(ts1, ts2, lag, plot_rate=1.0)
 
     def _apply_measure_windows_and_lag_ts(self, ts1, ts2, lag, normalize=True, plot_rate=0.1):
         """
@@ -159,7 +384,10 @@ class FunctionalConnectivityMatrix:
         
         filtered_ts1 = []
         filtered_ts2 = []
-        for start, end in self.measure_windows:
+        measure_windows = self.measure_windows
+        if not measure_windows:
+            measure_windows = [(0, None)]
+        for start, end in measure_windows:
             ts_subsections1 = ts1[start:end]
             ts_subsections2 = ts2[start:end]
             if normalize: # normalize both to the same max
@@ -182,3 +410,17 @@ class FunctionalConnectivityMatrix:
         
 
         return filtered_ts1, filtered_ts2
+
+
+# worker process state for FunctionalConnectivityMatrix blocks, set once per process
+worker_connectivity = None
+
+
+def init_connectivity_worker(fc, method, X2, max_lag):
+    global worker_connectivity
+    worker_connectivity = (fc, method, X2, max_lag)
+
+
+def compute_connectivity_block_worker(X1_block):
+    fc, method, X2, max_lag = worker_connectivity
+    return fc._compute_block(method, X1_block, X2, max_lag)
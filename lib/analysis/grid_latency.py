@@ -1,6 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from lib.analysis.laminar_dist import LaminarVisualization, GridVisualization
+from lib.analysis.correlation import FunctionalConnectivityMatrix
 
 
 # Code to build a directed graph analysis of spatial
@@ -90,6 +91,8 @@ class Grid:
         self.adjacency_matrix = np.zeros((self.n, self.n), dtype=np.int8)
         self.dir_latency_matrix = np.zeros((self.n, self.n), dtype=np.int8)  # i -> j if latency(i) < latency(j)
         self.latency_tolerance = latency_tolerance  # ms to count as non-simultaneous difference between latencies
+        self.connectivity = None  # sparse functional connectivity between nodes, see load_connectivity
+        self.connectivity_lags = None
         self.connect_neighbors()  # populate adjacency matrix
 
     def create_latency_map(self, ):
@@ -111,6 +114,25 @@ class Grid:
     def are_neighbors(self, i, j):
         return self.adjacency_matrix[i, j] == 1
 
+    def load_connectivity(self, filename):
+        """ Load the significant functional connectivity edges between the nodes, as written by
+            FunctionalConnectivityMatrix.compute_correlation_to_disk with top_k or threshold,
+            without loading the dense connectivity matrix """
+        connectivity, connectivity_lags = FunctionalConnectivityMatrix.load_edges(filename)
+        if connectivity.shape != (self.n, self.n):
+            raise ValueError("Connectivity matrix of shape " + str(connectivity.shape) +
+                             " does not match grid of " + str(self.n) + " nodes.")
+        self.connectivity = connectivity
+        self.connectivity_lags = connectivity_lags
+
+    def are_functionally_connected(self, i, j):
+        return self.connectivity is not None and self.connectivity[i, j] != 0
+
+    def get_functional_edges(self, i):
+        """ (node indices, edge strengths) of the functional connectivity edges out of node i """
+        row = self.connectivity.getrow(i)
+        return row.indices, row.data
+
     def determine_prior_node(self, nd, nd2):
         """ If either node is before the other, return them in latency increasing order. Else returns None """
         lat = nd.get_latency()
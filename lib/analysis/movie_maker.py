@@ -17,6 +17,7 @@ from ZDA_Adventure.utility import *
 from ZDA_Adventure.measure_properties import *
 
 from lib.auto_GUI.auto_PhotoZ import AutoPhotoZ
+from lib.file.dataset_index import DatasetIndex
 
 
 class MovieMaker:
@@ -36,6 +37,8 @@ class MovieMaker:
 
         self.progress = progress
         self.stop_event = kwargs['stop_event']
+        self.preprocess_cache = kwargs.get('preprocess_cache', PreprocessCache.get_default())
+        self.dataset_index = kwargs.get('dataset_index', DatasetIndex.for_data_dir(self.data_dir))
 
     def are_all_frames_present(self, output_dir, start_frame, end_frame, frame_step_size):
         for frame in range(start_frame, end_frame+1, frame_step_size):
@@ -46,10 +49,8 @@ class MovieMaker:
 
     def estimate_total_time(self):
         total_time = 0
-        for subdir, dirs, files in os.walk(self.data_dir):
-            for zda_file in os.listdir(subdir):
-                if zda_file.endswith('.zda'):
-                    total_time += (self.end_frame - self.start_frame) // self.frame_step_size
+        for _ in self.dataset_index.find_files(self.data_dir, ext='.zda'):
+            total_time += (self.end_frame - self.start_frame) // self.frame_step_size
         return total_time
     
     def load_zda_file(self, filename, baseline_correction=True, spatial_filter=False):
@@ -61,25 +62,23 @@ class MovieMaker:
             print("File is not a ZDA file: " + filename)
             return None
         # TO DO: enable RLI division by default
-        data_loader = DataLoader(filename,
-                          number_of_points_discarded=0)
-        data = data_loader.get_data(rli_division=False)
-
-        tools = Tools()
-        data = tools.T_filter(Data=data)
-        if spatial_filter:
-            data = tools.S_filter(Data=data, sigma=1)
-        if baseline_correction:
-            data = tools.Polynomial(startPt=self.skip_window_start,
-                                    numPt=self.skip_window_width,
-                                    Data=data)
+        data_loader = DataLoader(filename)
+
+        preprocessor = Preprocessor(baseline_correction=baseline_correction,
+                                    skip_window_start=self.skip_window_start,
+                                    skip_window_width=self.skip_window_width,
+                                    rli_division=False,
+                                    temporal_filter=True,
+                                    spatial_filter=spatial_filter,
+                                    spatial_filter_sigma=1)
+        data, _ = self.preprocess_cache.run(preprocessor, filename, lambda: (data_loader.get_data(), None))
         
         return data
     
     def make_movie_headless(self):
-        for subdir, dirs, files in os.walk(self.data_dir):
+        for subdir, dirs, files in self.dataset_index.walk(self.data_dir):
 
-            for zda_file in os.listdir(subdir):
+            for zda_file in files:
                 if zda_file.endswith('.zda'):
                     rec_id = zda_file.split('.')[0]
                     print(rec_id)
@@ -153,9 +152,9 @@ class MovieMaker:
             return
         
         current_color_bound_setting = 1.0
-        for subdir, dirs, files in os.walk(self.data_dir):
+        for subdir, dirs, files in self.dataset_index.walk(self.data_dir):
 
-            for zda_file in os.listdir(subdir):
+            for zda_file in files:
                 if zda_file.endswith('.zda'):
 
                     rec_id = zda_file.split('.')[0]
@@ -3,6 +3,8 @@ import os
 import numpy as np
 import pyautogui as pa
 
+from lib.file.dataset_index import DatasetIndex
+
 
 class PairedPulseExporter:
     """ Paired Pulse Exporter """
@@ -11,12 +13,13 @@ class PairedPulseExporter:
         """ Param_file is a path to a csv file """
         self.data_dir = data_dir
         self.auto_exporter = auto_exporter
+        self.dataset_index = DatasetIndex.for_data_dir(self.data_dir)
         self.param_file = os.path.join(self.data_dir, "ppr_catalog.csv")
 
     def build_shuffle_file_dict(self, subdir):
         ''' Build a shuffle file directory mapping slice/loc to list of IPIs '''
         shuffle_file_dict = {'ipi': {}, 'is_single_pulse_control': {}, 'record_numbers': {}}
-        for zda_file in os.listdir(subdir):
+        for zda_file in self.dataset_index.listdir(subdir):
             if zda_file.endswith('.zda'):
                 # parse slice, location, record from file name
                 slice_num, loc_num, rec_num = [int(x) for x in zda_file.split("/")[-1].split('.')[0].split('_')[:3]]
@@ -76,10 +79,10 @@ class PairedPulseExporter:
         """
         example_params = pd.DataFrame(columns=['zda_file', 'pulse1_start', 'pulse1_width', 'pulse2_start', 'pulse2_width', 'baseline_start', 'baseline_width'])
 
-        for subdir, dirs, files in os.walk(self.data_dir):
+        for subdir, dirs, files in self.dataset_index.walk(self.data_dir):
             shuffle_file_dict = self.build_shuffle_file_dict(subdir)
             print(shuffle_file_dict)
-            for zda_file in os.listdir(subdir):
+            for zda_file in files:
                 if zda_file.endswith('.zda'):
                     # parse slice, location, record from file name
                     slice_num, loc_num, rec_num = [int(x) for x in zda_file.split("/")[-1].split('.')[0].split('_')[:3]]
@@ -400,6 +400,51 @@ class BarrelLayerROIAnnotator(BaseROIAnnotator):
         return cancel_button
 
 
+class IncrementalROISNR:
+    """ SNR of an ROI's average trace, as TraceProperties.get_SNR measures it, for an ROI that grows
+        one pixel at a time. Keeps the running sum of the ROI's traces, so adding or testing a pixel
+        costs one trace instead of re-averaging the whole ROI, and scores many candidate pixels at once. """
+
+    # baseline SD points, as in TraceProperties.get_SD (PhotoZ Data.cpp:getSD)
+    sd_start = 10
+    sd_num = 50
+
+    def __init__(self, zda_arr, start, width, roi=()):
+        self.zda_arr = zda_arr
+        num_pts = zda_arr.shape[-1]
+        if start + width > num_pts:
+            width = num_pts - start - 1
+        self.window = slice(start, min(start + width + 1, num_pts))
+        self.sum_trace = np.zeros(num_pts)
+        self.n_px = 0
+        for px in roi:
+            self.add(px)
+
+    def add(self, px):
+        self.sum_trace += self.zda_arr[px[0], px[1]]
+        self.n_px += 1
+
+    def _get_SNRs(self, sum_traces, n_px):
+        """ SNR of the average traces sum_traces / n_px (one per row) """
+        window = sum_traces[:, self.window] / n_px
+        max_amp = np.maximum(window.max(axis=1), 0.0) if window.shape[1] > 0 else np.zeros(len(window))
+        baseline = sum_traces[:, self.sd_start:self.sd_start + self.sd_num] / n_px
+        sum1 = baseline.sum(axis=1)
+        sum2 = (baseline * baseline).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sd = np.sqrt((sum2 - sum1 * sum1 / self.sd_num) / (self.sd_num - 1))
+            return max_amp / sd
+
+    def get_SNR(self):
+        return self._get_SNRs(self.sum_trace[np.newaxis, :], self.n_px)[0]
+
+    def get_candidate_SNRs(self, pixels):
+        """ SNR of the ROI with each of pixels (list of [x, y]) added, as an array """
+        pixels = np.array(pixels, dtype=int).reshape(-1, 2)
+        traces = self.zda_arr[pixels[:, 0], pixels[:, 1]]
+        return self._get_SNRs(self.sum_trace[np.newaxis, :] + traces, self.n_px + 1)
+
+
 class MaxSNRROIAnnotator(BaseROIAnnotator):
     """Annotator for 5x5 Maximal SNR ROI identification.
     In the first sweep, for each slice/location, the user
@@ -480,43 +525,58 @@ class MaxSNRROIAnnotator(BaseROIAnnotator):
     def _compute_roi_snr(self, zda_arr, roi):
         """ Compute the SNR for a given patch and ROI.
             Average the ROI into a single trace, then compute SNR. """
-        roi_traces = np.array([zda_arr[px[0], px[1]] for px in roi])
-        roi_avg_trace = np.mean(roi_traces, axis=0) 
-        tp = TraceProperties(roi_avg_trace, 
-                             self.measure_window_start, 
-                             self.measure_window_width,
-                                0.5,  # assume 2000 Hz
-                                )
-        tp_snr = tp.get_SNR()
-        return tp_snr
+        return IncrementalROISNR(zda_arr, self.measure_window_start, self.measure_window_width, roi).get_SNR()
+
+    @staticmethod
+    def _get_ring_pixels(zda_arr, x, y, radius):
+        """ Pixels at chessboard distance radius from (x, y) that lie in zda_arr, in row-major offset order """
+        ring = []
+        for i in range(-radius, radius + 1):
+            for j in range(-radius, radius + 1):
+                if max(abs(i), abs(j)) != radius:
+                    continue
+                if 0 <= x + i < zda_arr.shape[0] and 0 <= y + j < zda_arr.shape[1]:
+                    ring.append([x + i, y + j])
+        return ring
 
     def _build_max_snr_roi(self, zda_arr, x, y):
-        """ Compute the maximal SNR ROI within a 5x5 patch."""
-        # first look at 3x3 around center, greedily add pixels that increase current SNR
-        current_roi = [[x,y]]
-        if self.roi_scan_radius > 0:
-            for i in range(-1, 2):
-                for j in range(-1, 2):
-                    if i == 0 and j == 0:
-                        continue
-                    curr_avg_snr = self._compute_roi_snr(zda_arr, current_roi)
-                    test_roi = current_roi + [[x+i, y+j]]
-                    test_avg_snr = self._compute_roi_snr(zda_arr, test_roi)
-                    if test_avg_snr > curr_avg_snr:
-                        current_roi.append([x+i, y+j])
-        # then look at 5x5 border pixels, greedily add pixels that increase current SNR
-        if self.roi_scan_radius > 1:
-            for i in range(-2, 3):
-                for j in range(-2, 3):
-                    if i >=-1 and i <=1 and j >=-1 and j <=1:
-                        continue
-                    curr_avg_snr = self._compute_roi_snr(zda_arr, current_roi)
-                    test_roi = current_roi + [[x+i, y+j]]
-                    test_avg_snr = self._compute_roi_snr(zda_arr, test_roi)
-                    if test_avg_snr > curr_avg_snr:
-                        current_roi.append([x+i, y+j])
+        """ Compute the maximal SNR ROI within a (2 * roi_scan_radius + 1)^2 patch.
+            Rings around the center are scanned from the inside out (3x3 border, then 5x5 border, ...),
+            greedily adding each pixel, in order, that increases the SNR of the current ROI. """
+        current_roi = [[x, y]]
+        roi_snr = IncrementalROISNR(zda_arr, self.measure_window_start, self.measure_window_width, current_roi)
+        for radius in range(1, self.roi_scan_radius + 1):
+            ring = self._get_ring_pixels(zda_arr, x, y, radius)
+            while len(ring) > 0:
+                # score the rest of the ring at once; add the first pixel that helps, then re-score after it
+                improves = roi_snr.get_candidate_SNRs(ring) > roi_snr.get_SNR()
+                if not improves.any():
+                    break
+                i = int(np.argmax(improves))
+                roi_snr.add(ring[i])
+                current_roi.append(ring[i])
+                ring = ring[i + 1:]
         return current_roi
 
+    def _load_snr_patch(self, dl, x, y):
+        """ Read and preprocess only the patch of the zda file that _build_max_snr_roi can touch
+            around (x, y), plus a 1-pixel halo so the 3x3 spatial filter matches the full-image result.
+            Returns the trial-averaged patch and the image coordinates of its corner. """
+        r = self.roi_scan_radius + 1
+        x0, x1 = max(x - r, 0), min(x + r + 1, dl.width)
+        y0, y1 = max(y - r, 0), min(y + r + 1, dl.height)
+        zda_arr = dl.get_data(window=((x0, x1), (y0, y1)))
+        rli = {k: v[x0:x1, y0:y1] for k, v in dl.get_rli().items()}
+
+        preprocessor = Preprocessor(skip_window_start=self.skip_window_start,
+                                    skip_window_width=self.skip_window_width,
+                                    temporal_filter=self.enable_temporal_filter,
+                                    spatial_filter=self.enable_spatial_filter,
+                                    spatial_filter_sigma=self.spatial_filter_sigma)
+        zda_arr, _ = preprocessor.run(zda_arr, rli)
+
+        return np.mean(zda_arr, axis=0), (x0, y0)  # average across trials
+
     def _secondary_processing(self):
         """ Second sweep to draw soma ROIs around previously annotated centers. """
         pa.alert("Maximizing SNR for ROIs around the centers you annotated. " +\
@@ -536,21 +596,9 @@ class MaxSNRROIAnnotator(BaseROIAnnotator):
                 zda_file_path = self.slice_location_to_soma_centers[date_slic_loc_key]['zda_file_paths'][rec_id]
                 date, slic_id, loc_id = date_slic_loc_key.split("_")
                 
-                # load full zda file
+                # open zda file; only the patches around the soma centers are read from disk
                 print("Loading ZDA file for SNR computation:", zda_file_path)
                 dl = DataLoader(zda_file_path)
-                zda_arr = dl.get_data()
-                tools = Tools()
-                zda_arr = tools.Polynomial(startPt=self.skip_window_start,
-                            numPt=self.skip_window_width,
-                            Data=zda_arr)
-                zda_arr = tools.Rli_Division(dl.get_rli(), Data=zda_arr)
-                if self.enable_temporal_filter:
-                    zda_arr = tools.T_filter(Data=zda_arr)
-                if self.enable_spatial_filter:
-                    zda_arr = tools.S_filter(Data=zda_arr, sigma=self.spatial_filter_sigma)
-
-                zda_arr = np.mean(zda_arr, axis=0)  # average across trials
                 rli_img = np.array(dl.rli['rli_high']).reshape((dl.height, dl.width))
 
                 rois = []
@@ -559,8 +607,10 @@ class MaxSNRROIAnnotator(BaseROIAnnotator):
                 for center in roi_centers:
                     x_center, y_center = int(center[0]), int(center[1])
                     print(f" Built soma ROI from center at: {x_center}, {y_center} ")
-                    # Compute maximal SNR ROI in the patch (placeholder function)
-                    roi = self._build_max_snr_roi(zda_arr, x_center, y_center)
+                    patch, (x0, y0) = self._load_snr_patch(dl, x_center, y_center)
+                    # Compute maximal SNR ROI in the patch, then shift back to image coordinates
+                    roi = self._build_max_snr_roi(patch, x_center - x0, y_center - y0)
+                    roi = [[px[0] + x0, px[1] + y0] for px in roi]
 
                     print("\troi size:", len(roi))
 
@@ -4,6 +4,9 @@ import numpy as np
 import pyautogui as pa
 import threading
 import math
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from lib.auto_GUI.auto_PhotoZ import AutoPhotoZ
 from lib.auto_GUI.auto_DAT import AutoDAT
@@ -11,11 +14,15 @@ from lib.utilities import parse_date
 from lib.analysis.laminar_dist import Line
 from lib.analysis.laminar_dist import LaminarROI
 from lib.file.ROI_reader import ROIFileReader as ROIFileReaderLegacy
+from lib.file.export_store import ExportStore
+from lib.file.export_manifest import ExportManifest
+from lib.file.dataset_index import DatasetIndex
 
 from ZDA_Adventure.maps import *
 from ZDA_Adventure.tools import *
 from ZDA_Adventure.utility import *
 from ZDA_Adventure.measure_properties import *
+from ZDA_Adventure.zda_reader import ZDA_Reader
 
 
 class AutoExporter(AutoPhotoZ):
@@ -28,7 +35,7 @@ class AutoExporter(AutoPhotoZ):
                             microns_per_pixel, is_export_by_trial, num_export_trials, headless_mode=False,
                             skip_window_start=94, skip_window_width=70, measure_window_start=94, measure_window_width=70,
                             enable_temporal_filter=True, enable_spatial_filter=False, spatial_filter_sigma=1.0, 
-                            binning_factor=1,
+                            binning_factor=1, export_format='dat', num_export_workers=1,
                             progress=None, **kwargs):
         super().__init__(**kwargs)
         self.is_export_amp_traces = is_export_amp_traces
@@ -67,6 +74,15 @@ class AutoExporter(AutoPhotoZ):
         self.spatial_filter_sigma = spatial_filter_sigma
         self.binning_factor = binning_factor
         self.last_opened_roi_file = None
+        self.roi_mask_cache = {}  # (ROI file, mtime, image shape) -> ROIMask
+
+        # 'dat': one PhotoZ-compatible text file per export, 'npz': one binary ExportStore per recording
+        self.export_format = export_format
+        self.export_stores = {}  # store filename -> open ExportStore
+
+        # headless export of ZDA files in parallel worker processes if > 1
+        self.num_export_workers = num_export_workers
+        self.export_work_units = []
 
         # assume analog input channel 1 is always connected. Used to measure stim time.
         # Note channel i is shown as channel i-7 in PhotoZ GUI
@@ -75,6 +91,10 @@ class AutoExporter(AutoPhotoZ):
 
         self.progress = progress
         self.stop_event = kwargs.get('stop_event', threading.Event())
+        # preprocessed arrays, reused across PPR pulses, export passes and tools
+        self.preprocess_cache = kwargs.get('preprocess_cache', PreprocessCache.get_default())
+        # directory listings of the data tree, refreshed incrementally instead of re-walked
+        self.dataset_index = kwargs.get('dataset_index', DatasetIndex.for_data_dir(self.data_dir))
 
         self.ppr_catalog = None  # for PPR export
 
@@ -88,8 +108,34 @@ class AutoExporter(AutoPhotoZ):
         self.is_export_by_trial = is_export_by_trial
         self.num_export_trials = num_export_trials
 
-    def load_zda_file(self, filename, baseline_correction=True, rli_divison=True):
-        """ Load a ZDA file and return a numpy array """
+    def __getstate__(self):
+        """ Picklable copy for export worker processes: leaves out the GUI progress,
+            the stop event and open stores/caches """
+        state = self.__dict__.copy()
+        for k in ['progress', 'stop_event', 'export_stores', 'roi_mask_cache', 'export_work_units']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.progress = None
+        self.stop_event = threading.Event()
+        self.export_stores = {}
+        self.roi_mask_cache = {}
+        self.export_work_units = []
+
+    def get_preprocessor(self, baseline_correction=True, rli_division=True):
+        return Preprocessor(baseline_correction=baseline_correction,
+                            skip_window_start=self.skip_window_start,
+                            skip_window_width=self.skip_window_width,
+                            rli_division=rli_division,
+                            temporal_filter=self.enable_temporal_filter,
+                            spatial_filter=self.enable_spatial_filter,
+                            spatial_filter_sigma=self.spatial_filter_sigma,
+                            binning_factor=self.binning_factor)
+
+    def open_zda_file_headless(self, filename):
+        """ Open a ZDA file for reading trials: a DataLoader over its memory map, or None """
         if not os.path.exists(filename):
             print("ZDA file not found: " + filename)
             return None
@@ -97,49 +143,73 @@ class AutoExporter(AutoPhotoZ):
             print("File is not a ZDA file: " + filename)
             return None
         print("loading ZDA file: " + filename)
-        # TO DO: enable RLI division by default
-        data_loader = DataLoader(filename)
-        data = data_loader.get_data()
+        return DataLoader(filename)
+
+    def get_fp_data(self, data_loader):
+        num_pts = data_loader.points
 
         # note Tianchang's data loader only loads trial=1 for fp_data
         fp_data = data_loader.get_fp()
-        if not fp_data.shape[0] == 8 or not fp_data.shape[1] == data.shape[3]:
+        if not fp_data.shape[0] == 8 or not fp_data.shape[1] == num_pts:
             # average over trials
             fp_data = np.average(fp_data, axis=0)
 
-        assert fp_data.shape[0] == 8 and fp_data.shape[1] == data.shape[3], \
+        assert fp_data.shape[0] == 8 and fp_data.shape[1] == num_pts, \
             "FP data shape is not correct: " + str(fp_data.shape) \
-            + " for file: " + filename + \
-            " Expected shape: (8, " + str(data.shape[3])+"), ZDA Adventure was only pulling" \
+            + " for file: " + data_loader.filedir + \
+            " Expected shape: (8, " + str(num_pts)+"), ZDA Adventure was only pulling" \
             " Trial 1 for FP data; please check ZDA_Adventure DataLoader " \
             " implementation for changed behavior (maybe it's pulling all trials now)."
-                    
-        # load rli
-        rli = data_loader.get_rli()
-
-        tools = Tools()
-
-        # polyfit baseline correction
-        if baseline_correction:
-            data = tools.Polynomial(startPt=self.skip_window_start,
-                                    numPt=self.skip_window_width,
-                                    Data=data)
-        # rli division
-        if rli_divison:
-            rli = data_loader.get_rli()
-            data = tools.Rli_Division(rli, Data=data)
-        
-        # filtering
-        if self.enable_temporal_filter:
-            data = tools.T_filter(Data=data)
-        if self.enable_spatial_filter:
-            data = tools.S_filter(Data=data, sigma=self.spatial_filter_sigma)
+        return fp_data
 
-        # binning
-        if self.binning_factor > 1:
-            data, rli = tools.Binning(self.binning_factor, Data=data, rli=rli)
+    def load_zda_file(self, filename, baseline_correction=True, rli_divison=True, trial=None):
+        """ Load a ZDA file and return a numpy array.
+            If trial is given, only that trial is read and processed (trial axis of length 1) """
+        data_loader = self.open_zda_file_headless(filename)
+        if data_loader is None:
+            return None
+        # TO DO: enable RLI division by default
+        fp_data = self.get_fp_data(data_loader)
+        preprocessor = self.get_preprocessor(baseline_correction=baseline_correction, rli_division=rli_divison)
+        data, rli = self.preprocess_cache.run(preprocessor, filename,
+                                              lambda: (data_loader.get_data(trial=trial), data_loader.get_rli()),
+                                              trial=trial)
 
         return data, fp_data, rli
+
+    def load_trial_arr(self, data_loader, i_trial, no_baseline=False):
+        """ Return the processed height * width * timepoints array to export for i_trial:
+            that trial alone if exporting by trial, otherwise the trial average.
+            Also returns the same array without baseline correction if no_baseline (else None), fp data and RLI.
+            Each trial is read from data_loader once and run through both preprocessings,
+            one trial at a time, so that peak memory stays at about one trial. """
+        preprocessors = [self.get_preprocessor()]
+        if no_baseline:
+            preprocessors.append(self.get_preprocessor(baseline_correction=False))
+
+        trials = [i_trial] if self.is_export_by_trial else range(data_loader.trials)
+        trial_sums, rli = [None] * len(preprocessors), None
+        for j_trial in trials:
+            raw = []  # the raw trial, read at most once and only if some result is not cached
+
+            def load():
+                if len(raw) == 0:
+                    raw.append((data_loader.get_data(trial=j_trial), data_loader.get_rli()))
+                return raw[0]
+
+            for k, preprocessor in enumerate(preprocessors):
+                data, trial_rli = self.preprocess_cache.run(preprocessor, data_loader.filedir, load, trial=j_trial)
+                if rli is None:
+                    rli = trial_rli
+                if trial_sums[k] is None:
+                    trial_sums[k] = data[0]
+                else:
+                    trial_sums[k] += data[0]
+
+        trial_arrs = [trial_sum / len(trials) for trial_sum in trial_sums]
+        if len(trial_arrs) < 2:
+            trial_arrs.append(None)
+        return trial_arrs[0], trial_arrs[1], self.get_fp_data(data_loader), rli
     
     def load_roi_file(self, filename):
         """ Load an ROI file and return as a list of lists of [x,y] """
@@ -152,6 +222,22 @@ class AutoExporter(AutoPhotoZ):
             " make sure is is excluded by the keywords_to_exclude list in get_roi_filenames().")
             raise e
 
+    def get_roi_mask(self, rois, shape):
+        """ Return the ROIMask of the non-empty rois over images of shape (height, width).
+            Compiled masks are cached per ROI file (the last opened one, which rois were loaded from) and shape """
+        rois = [roi for roi in rois if len(roi) > 0]
+        key = None
+        roi_file = self.last_opened_roi_file
+        if roi_file is not None and os.path.exists(roi_file):
+            key = (os.path.abspath(roi_file), os.path.getmtime(roi_file), tuple(shape))
+            roi_mask = self.roi_mask_cache.get(key)
+            if roi_mask is not None and roi_mask.n_rois == len(rois):
+                return roi_mask
+        roi_mask = ROIMask(rois, shape[0], shape[1])
+        if key is not None:
+            self.roi_mask_cache[key] = roi_mask
+        return roi_mask
+
     def get_roi_filenames(self, subdir, rec_id, roi_keyword, shallow_search=True):
         """ Return all files that match the rec_id and the roi_keyword in the subdir folder
          However, roi_files cannot have the trace_type keywords in them 
@@ -161,7 +247,7 @@ class AutoExporter(AutoPhotoZ):
         if self.export_rois_exclusion_keyword is not None and len(self.export_rois_exclusion_keyword) > 0:
             keywords_to_exclude.append(self.export_rois_exclusion_keyword)
         if shallow_search:
-            for file in os.listdir(subdir):
+            for _, file, _, _, _ in self.dataset_index.find_files(subdir, recursive=False):
                 if str(rec_id) in file and roi_keyword in file:
                     if not any(exclude_kw in file for exclude_kw in keywords_to_exclude):
                         roi_files.append(file)
@@ -170,17 +256,14 @@ class AutoExporter(AutoPhotoZ):
                         print("(The following keywords are excluded from ROI files: ", keywords_to_exclude, ")")
         else:
             # also search in subdirectories of subdir
-            for root, dirs, files in os.walk(subdir):
+            for root, file, _, _, _ in self.dataset_index.find_files(subdir):
                 # prepend the relative path to the file
-                relative_path = os.path.relpath(root, subdir)
-
-                for file in files:
-                    file_path = os.path.join(relative_path, file)
-                    #print("search relative path for ROIs:", relative_path, file_path)
-                    if str(rec_id) in file_path and roi_keyword in file_path:
-                        if not any(exclude_kw in file_path for exclude_kw in keywords_to_exclude):
-                            if file_path not in roi_files:
-                                roi_files.append(file_path)
+                file_path = os.path.join(os.path.relpath(root, subdir), file)
+                #print("search relative path for ROIs:", file_path)
+                if str(rec_id) in file_path and roi_keyword in file_path:
+                    if not any(exclude_kw in file_path for exclude_kw in keywords_to_exclude):
+                        if file_path not in roi_files:
+                            roi_files.append(file_path)
         if len(roi_files) < 1:
             roi_files = [None]
         return roi_files
@@ -189,56 +272,69 @@ class AutoExporter(AutoPhotoZ):
         """ Return the first file that matches the rec_id and the electrode_keyword in the subdir folder 
         Defaults to None if no files are found """
         if shallow_search:
-            for file in os.listdir(subdir):
+            for _, file, _, _, _ in self.dataset_index.find_files(subdir, recursive=False):
                 if str(rec_id) in file and electrode_keyword in file:
                     return file
         if not shallow_search:
             # also search in subdirectories of subdir
-            for root, dirs, files in os.walk(subdir):
+            for root, file, _, _, _ in self.dataset_index.find_files(subdir):
                 # prepend the relative path to the file
-                relative_path = os.path.relpath(root, subdir)
-
-                for file in files:
-                    file_path = os.path.join(relative_path, file)
-                    #print("search relative path for electrode:", relative_path, file_path)
-                    if str(rec_id) in file_path and electrode_keyword in file_path:
-                        return file_path
+                file_path = os.path.join(os.path.relpath(root, subdir), file)
+                #print("search relative path for electrode:", file_path)
+                if str(rec_id) in file_path and electrode_keyword in file_path:
+                    return file_path
         return None
 
     def create_data_map(self):
         data_map = {}
         # Data mapping loop -- locate and organize all zda files into slice, loc, rec structure 
-        for subdir, dirs, files in os.walk(self.data_dir):
-            date = parse_date(subdir)
-            for zda_file in os.listdir(subdir):
-                if zda_file.endswith('.zda'):
-                    rec_id = zda_file.split('.')[0]
-                    print("\n", subdir + "/" + zda_file)
-                    slic_id, loc_id, _ = [int(x) for x in rec_id.split("_")]
-
-                    if subdir not in data_map:
-                        data_map[subdir] = {}
-                    if slic_id not in data_map[subdir]:
-                        data_map[subdir][slic_id] = {}
-                    if loc_id not in data_map[subdir][slic_id]:
-                        data_map[subdir][slic_id][loc_id] = {
-                            'zda_files': []
-                        }
-                    data_map[subdir][slic_id][loc_id]['zda_files'].append(subdir + "/" + zda_file)
+        for subdir, zda_file, slic_id, loc_id, _ in self.dataset_index.find_files(self.data_dir, ext='.zda'):
+            print("\n", subdir + "/" + zda_file)
+            if slic_id is None:
+                print("Skipping ZDA file not named slice_location_record.zda:", zda_file)
+                continue
+
+            if subdir not in data_map:
+                data_map[subdir] = {}
+            if slic_id not in data_map[subdir]:
+                data_map[subdir][slic_id] = {}
+            if loc_id not in data_map[subdir][slic_id]:
+                data_map[subdir][slic_id][loc_id] = {
+                    'zda_files': []
+                }
+            data_map[subdir][slic_id][loc_id]['zda_files'].append(subdir + "/" + zda_file)
         return data_map
 
     def get_export_target_filename(self, subdir, slic_id, loc_id, rec_id, trace_type, roi_prefix):
-        """ Return the filename to store the exported trace data in a .dat file """
+        """ Return the filename to store the exported trace data in a .dat file,
+            or, for the npz export format, a reference to its array in the recording's ExportStore """
         slic_id = self.pad_zeros(str(slic_id))
         loc_id = self.pad_zeros(str(loc_id))
         rec_id = self.pad_zeros(str(rec_id))
         if roi_prefix is None:
             roi_prefix = ""
         roi_prefix = roi_prefix.replace("/", "_").replace("\\", "_")
+        if self.export_format == 'npz':
+            store_fn = subdir + "/" + "_".join([self.export_trace_prefix, slic_id, loc_id, rec_id]) + ".npz"
+            key = "_".join([trace_type, roi_prefix]).replace(" ", "_")
+            return ExportStore.make_reference(store_fn.replace(" ", "_"), key)
         target_fn = subdir + "/" + "_".join([self.export_trace_prefix, slic_id, loc_id, rec_id, trace_type, roi_prefix]) 
         target_fn = target_fn.replace(" ", "_")
         return target_fn + ".dat"
 
+    def get_export_store(self, reference):
+        """ Return the open ExportStore and the array key named by an export reference """
+        store_fn, key = ExportStore.split_reference(reference)
+        if store_fn not in self.export_stores:
+            self.export_stores[store_fn] = ExportStore(store_fn)
+        return self.export_stores[store_fn], key
+
+    def save_export_stores(self):
+        """ Write out and close all open ExportStores """
+        for store_fn in self.export_stores:
+            self.export_stores[store_fn].save()
+        self.export_stores = {}
+
     def update_export_map(self, export_map, subdir, slic_id, loc_id, rec_id, trace_type, roi_prefix, filename):
         """ Update the export map with the filename of newly created file"""
         if rec_id not in export_map[subdir][slic_id][loc_id]:
@@ -263,11 +359,13 @@ class AutoExporter(AutoPhotoZ):
         return total_files
 
     def export(self, rebuild_map_only=False):
-        """ Export all traces and maps """
+        """ Export all traces and maps. With rebuild_map_only, only the export map is rebuilt
+            (nothing is exported), reusing the maps of subdirs unchanged since the last summary """
         data_map = self.create_data_map()
         export_map = dict(data_map)
         total_files = self.estimate_total_zda_files(data_map)
         self.progress.set_current_total(total_files, unit='ZDA files')
+        manifest = self.open_export_manifest()
 
         if not self.headless_mode and self.is_export_latency_maps:
             pa.alert(text="Latency map export is only supported in headless mode. " +
@@ -275,18 +373,62 @@ class AutoExporter(AutoPhotoZ):
                      " We will never support latency map export Legacy/GUI mode because it is now deprecated.", 
                      title="Latency Map Export Not Supported", button="OK")
             self.is_export_latency_maps = False
+        if not self.headless_mode and self.export_format != 'dat':
+            print("Binary export is only supported in headless mode. Exporting PhotoZ .dat files.")
+            self.export_format = 'dat'
+
+        map_settings = self.get_export_map_settings()
+        if not rebuild_map_only:
+            # exported files are about to be rewritten in place: don't trust the saved maps until summarized
+            manifest.clear_subdir_maps()
+            manifest.save()
 
+        self.export_work_units = []
+        cached_subdirs = set()
         for subdir in data_map:
+            if rebuild_map_only:
+                subdir_map = manifest.get_subdir_map(subdir, self.get_subdir_listing(subdir), map_settings)
+                if subdir_map is not None:
+                    export_map[subdir] = copy.deepcopy(subdir_map)
+                    cached_subdirs.add(subdir)
+                    print("Unchanged since last summary:", subdir)
+                    self.progress.increment_progress_value(self.estimate_total_zda_files({subdir: data_map[subdir]}))
+                    continue
             aPhz = None
             if not self.headless_mode:
                 aPhz = AutoPhotoZ(data_dir=subdir)
             for slic_id in data_map[subdir]:
                 self.export_slice(subdir, slic_id, aPhz, data_map, export_map, rebuild_map_only)
                 if self.stop_event.is_set():
+                    self.save_export_stores()
                     return
-        self.generate_summary_csv(export_map)
+        if len(self.export_work_units) > 0:
+            self.run_export_work_units(export_map)
+            if self.stop_event.is_set():
+                return
+        self.save_export_stores()
+        self.generate_summary_csv(export_map, manifest, map_settings, cached_subdirs)
         self.progress.complete()
 
+    def open_export_manifest(self):
+        return ExportManifest(self.data_dir + "/export_manifest.pickle")
+
+    def get_subdir_listing(self, subdir):
+        """ Names in subdir that its export map depends on (ZDA, ROI, electrode and exported files),
+            leaving out the summary files written to the data directory """
+        return sorted(name for name in self.dataset_index.listdir(subdir, force=True)
+                      if not name.startswith("export_manifest.pickle") and name != "export_summary.csv")
+
+    def get_export_map_settings(self):
+        """ Settings that determine the export map built from a subdir's files """
+        return (self.headless_mode, self.export_format, self.export_trace_prefix, self.zero_pad_ids,
+                self.roi_export_option, self.export_rois_keyword, self.export_rois_exclusion_keyword,
+                self.is_export_amp_traces, self.is_export_snr_traces, self.is_export_latency_traces,
+                self.is_export_halfwidth_traces, self.is_export_traces, self.is_export_traces_non_polyfit,
+                self.is_export_sd_traces, self.is_export_snr_maps, self.is_export_max_amp_maps,
+                self.is_export_latency_maps, self.is_export_rli_maps,
+                self.is_export_by_trial, self.num_export_trials, copy.deepcopy(self.ppr_catalog))
+
     def export_slice(self, subdir, slic_id, aPhz, data_map, export_map, rebuild_map_only):
         slic_roi_files = [None]
         if self.roi_export_option == 'Slice':
@@ -345,13 +487,71 @@ class AutoExporter(AutoPhotoZ):
             print("\nExporting Slice " + str(slic_id) + ", Location " + str(loc_id),
                   " rec files: ", data_map[subdir][slic_id][loc_id]['zda_files'])
             for zda_file in data_map[subdir][slic_id][loc_id]['zda_files']:
-                if self.headless_mode:
+                if self.is_parallel_export(rebuild_map_only):
+                    # queued for run_export_work_units; skip files marked as done here
+                    if not self.check_if_done(zda_file):
+                        self.export_work_units.append((curr_rois, subdir, slic_id, loc_id, zda_file, roi_prefix,
+                                                       self.last_opened_roi_file))
+                elif self.headless_mode:
                     self.export_zda_file_headless(curr_rois, subdir, slic_id, loc_id, zda_file, roi_prefix, export_map, rebuild_map_only)
+                    # one binary store per recording: write it out before moving on
+                    self.save_export_stores()
                 else:    
                     self.export_zda_file(subdir, slic_id, loc_id, zda_file, roi_prefix, aPhz, export_map, rebuild_map_only)
                 if self.stop_event.is_set():
                     return
                 
+    def is_parallel_export(self, rebuild_map_only):
+        return self.headless_mode and not rebuild_map_only and self.num_export_workers > 1
+
+    def run_export_work_units(self, export_map):
+        """ Export the queued ZDA files (export_work_units) across num_export_workers processes.
+            Each worker returns its files' export map entries, which are merged into export_map
+            in the queued order, so the result does not depend on which worker finishes first.
+            Setting stop_event cancels the files not yet started and stops the running ones
+            (through a shared event), and returns once the workers are done writing. """
+        n_workers = min(self.num_export_workers, len(self.export_work_units))
+        print("Exporting", len(self.export_work_units), "ZDA files with", n_workers, "worker processes")
+        manager = multiprocessing.Manager()
+        worker_stop_event = manager.Event()
+        executor = ProcessPoolExecutor(max_workers=n_workers,
+                                       initializer=init_export_worker,
+                                       initargs=(self, worker_stop_event))
+        try:
+            futures = [executor.submit(export_zda_file_worker, work_unit) for work_unit in self.export_work_units]
+            pending = set(futures)
+            while len(pending) > 0:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                if len(done) > 0:
+                    self.progress.increment_progress_value(len(done))
+                if self.stop_event.is_set():
+                    print("Export stopped. Cancelling", len(pending), "ZDA files.")
+                    worker_stop_event.set()
+                    # wait for the running files to stop, so nothing is written after export() returns
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    return
+            executor.shutdown()
+        finally:
+            manager.shutdown()
+
+        for work_unit, future in zip(self.export_work_units, futures):
+            _, subdir, slic_id, loc_id, zda_file, _, _ = work_unit
+            try:
+                loc_export_map = future.result()
+            except Exception as e:
+                print("Failed to export", zda_file, ":", e)
+                continue
+            self.merge_export_map(export_map, subdir, slic_id, loc_id, loc_export_map)
+        self.export_work_units = []
+
+    def merge_export_map(self, export_map, subdir, slic_id, loc_id, loc_export_map):
+        """ Add the entries of one location's export map (rec_id -> trace_type -> roi_prefix) to export_map """
+        for rec_id in loc_export_map:
+            for trace_type in loc_export_map[rec_id]:
+                for roi_prefix in loc_export_map[rec_id][trace_type]:
+                    self.update_export_map(export_map, subdir, slic_id, loc_id, rec_id, trace_type, roi_prefix,
+                                           loc_export_map[rec_id][trace_type][roi_prefix])
+
     def check_if_done(self, zda_file):
         # check if this zda file has already been exported and marked manually as done
         if self.ppr_catalog is None:
@@ -379,13 +579,48 @@ class AutoExporter(AutoPhotoZ):
 
         if self.check_if_done(zda_file):
             return
-        
-        loaded_zda_arr, loaded_fp_data, loaded_rli = None, None, None
 
         if not rebuild_map_only:
             print("\n", zda_file)
-            # Trials * height * width * timepoints
-            loaded_zda_arr, loaded_fp_data, loaded_rli = self.load_zda_file(zda_file)
+
+        ppr_params = None
+        if self.ppr_catalog is not None:
+            for ppr_key in self.ppr_catalog:
+                if os.path.normpath(zda_file) == os.path.normpath(ppr_key):
+                    ppr_params = self.ppr_catalog[ppr_key]
+                    print("Found PPR parameters for zda file: ", zda_file)
+                    print(ppr_params)
+                    break
+
+            if ppr_params is None:
+                print("No PPR parameters found for zda file: ", zda_file)
+                print(self.ppr_catalog)
+                return
+
+            # check if the PPR parameters are not Nan before converting to int
+            pulse1_start = ppr_params.get('pulse1_start', float('nan'))
+            pulse1_width = ppr_params.get('pulse1_width', float('nan'))
+            pulse2_start = ppr_params.get('pulse2_start', float('nan'))
+            pulse2_width = ppr_params.get('pulse2_width', float('nan'))
+            baseline_start = ppr_params.get('baseline_start', float('nan'))
+            baseline_width = ppr_params.get('baseline_width', float('nan'))
+            if not math.isnan(ppr_params['pulse1_start']):
+                pulse1_start = int(ppr_params['pulse1_start'])
+            if not math.isnan(ppr_params['pulse1_width']):
+                pulse1_width = int(ppr_params['pulse1_width'])
+            if not math.isnan(ppr_params['pulse2_start']):
+                pulse2_start = int(ppr_params['pulse2_start'])
+            if not math.isnan(ppr_params['pulse2_width']):
+                pulse2_width = int(ppr_params['pulse2_width'])
+            if not math.isnan(ppr_params['baseline_start']):
+                baseline_start = int(ppr_params['baseline_start'])
+            if not math.isnan(ppr_params['baseline_width']):
+                baseline_width = int(ppr_params['baseline_width'])
+            print("PPR parameters: ", pulse1_start, pulse1_width, pulse2_start, pulse2_width, baseline_start, baseline_width)
+
+            if not rebuild_map_only:
+                # set baseline window before the ZDA file is loaded, so it is only loaded once
+                self.set_polynomial_skip_window_headless(baseline_start, skip_width=baseline_width)
 
         rec_roi_files = [None]
         if self.roi_export_option == 'Slice_Loc_Rec':
@@ -394,106 +629,82 @@ class AutoExporter(AutoPhotoZ):
             print(rec_roi_files)
             print("found roi files for ", slic_loc_rec_id, ": ")
 
+        # (roi_prefix, rois, ROI file) of every ROI set to export from this recording
+        roi_sets = []
         for rec_roi_file in rec_roi_files:
+            rois, roi_file = curr_rois, self.last_opened_roi_file
             if rec_roi_file is not None:
                 roi_prefix = rec_roi_file.split('.')[0]
+                roi_file = subdir + "/" + rec_roi_file
                 if not rebuild_map_only:
-                    curr_rois = self.load_roi_file(subdir + "/" + rec_roi_file)
+                    rois = self.load_roi_file(roi_file)
                     print("Opened ROI file:", rec_roi_file)
-                self.last_opened_roi_file = subdir + "/" + rec_roi_file
+            roi_sets.append((roi_prefix, rois, roi_file))
             if self.stop_event.is_set():
                 return
 
-            trial_loop_iterations = self.num_export_trials if self.is_export_by_trial else 1
+        # one reader for the whole recording: each trial (or the trial average) is loaded
+        # and preprocessed once, then exported for every ROI set
+        data_loader = None
+        if not rebuild_map_only:
+            data_loader = self.open_zda_file_headless(zda_file)
+            if data_loader is None:
+                return
 
-            for i_trial in range(trial_loop_iterations):
+        trial_loop_iterations = self.num_export_trials if self.is_export_by_trial else 1
+        # export map entries of each ROI set, merged in ROI set order at the end
+        roi_set_export_maps = [{subdir: {slic_id: {loc_id: {}}}} for _ in roi_sets]
+
+        for i_trial in range(trial_loop_iterations):
+            trial_arr, trial_arr_no_baseline, loaded_fp_data, loaded_rli = None, None, None, None
+            if not rebuild_map_only:
+                # height * width * timepoints, only this trial (or the trial average) is held in memory
+                trial_arr, trial_arr_no_baseline, loaded_fp_data, loaded_rli = \
+                    self.load_trial_arr(data_loader, i_trial, no_baseline=self.is_export_traces_non_polyfit)
+            if self.stop_event.is_set():
+                return
+
+            for (roi_prefix, rois, roi_file), roi_set_export_map in zip(roi_sets, roi_set_export_maps):
+                self.last_opened_roi_file = roi_file
                 roi_prefix2 = roi_prefix
                 if len(roi_prefix) < 2:
                     # pull the last opened roi file from aPhz
                     roi_prefix2 = self.last_opened_roi_file
                     if roi_prefix2 is not None and len(roi_prefix2) > 0:
                         roi_prefix2 = roi_prefix2.split('.')[0].split('/')[-1].split('\\')[-1]
-                trial_arr = None
                 if self.is_export_by_trial:
                     roi_prefix2 += " trial" + str(i_trial + 1)
-                    if not rebuild_map_only:
-                        trial_arr = loaded_zda_arr[i_trial, :, :, :]
-                else:
-                    if not rebuild_map_only:
-                        trial_arr = np.average(loaded_zda_arr, axis=0)
 
                 # implement PPR export
-                if self.ppr_catalog is None:
-                    self.export_single_file_headless(subdir, zda_file, i_trial, trial_arr, curr_rois, 
-                                                     slic_id, loc_id, rec_id, roi_prefix2, export_map, 
-                                                     rebuild_map_only, fp_data=loaded_fp_data, rli=loaded_rli)
+                if ppr_params is None:
+                    self.export_single_file_headless(subdir, zda_file, i_trial, trial_arr, rois,
+                                                     slic_id, loc_id, rec_id, roi_prefix2, roi_set_export_map,
+                                                     rebuild_map_only, fp_data=loaded_fp_data, rli=loaded_rli,
+                                                     zda_arr_no_baseline=trial_arr_no_baseline)
                 else:
-                    ppr_params = None
-
-                    for ppr_key in self.ppr_catalog:
-                        if os.path.normpath(zda_file) == os.path.normpath(ppr_key):
-                            ppr_params = self.ppr_catalog[ppr_key]
-                            print("Found PPR parameters for zda file: ", zda_file)
-                            print(ppr_params)
-                            break
-
-                    if ppr_params is None:
-                        print("No PPR parameters found for zda file: ", zda_file)
-                        print(self.ppr_catalog)
-                        return
-                    
-                    # check if the PPR parameters are not Nan before converting to int
-                    pulse1_start = ppr_params.get('pulse1_start', float('nan'))
-                    pulse1_width = ppr_params.get('pulse1_width', float('nan'))
-                    pulse2_start = ppr_params.get('pulse2_start', float('nan'))
-                    pulse2_width = ppr_params.get('pulse2_width', float('nan'))
-                    baseline_start = ppr_params.get('baseline_start', float('nan'))
-                    baseline_width = ppr_params.get('baseline_width', float('nan'))
-                    if not math.isnan(ppr_params['pulse1_start']):
-                        pulse1_start = int(ppr_params['pulse1_start'])
-                    if not math.isnan(ppr_params['pulse1_width']):
-                        pulse1_width = int(ppr_params['pulse1_width'])
-                    if not math.isnan(ppr_params['pulse2_start']):
-                        pulse2_start = int(ppr_params['pulse2_start'])
-                    if not math.isnan(ppr_params['pulse2_width']):
-                        pulse2_width = int(ppr_params['pulse2_width'])
-                    if not math.isnan(ppr_params['baseline_start']):
-                        baseline_start = int(ppr_params['baseline_start'])
-                    if not math.isnan(ppr_params['baseline_width']):
-                        baseline_width = int(ppr_params['baseline_width'])
-                    print("PPR parameters: ", pulse1_start, pulse1_width, pulse2_start, pulse2_width, baseline_start, baseline_width)
-                    
                     if not rebuild_map_only:
-                        # set baseline window
-                        need_to_reload_zda = ((baseline_start != self.skip_window_start) or \
-                                              (baseline_width != self.skip_window_width))
-                        self.set_polynomial_skip_window_headless(baseline_start, skip_width=baseline_width)
                         # set measure window 1
                         self.set_measure_window_headless(pulse1_start, pulse1_width)
-                        # reload zda file and reselect trial if baseline changed
-                        if need_to_reload_zda:
-                            loaded_zda_arr, loaded_fp_data, loaded_rli = self.load_zda_file(zda_file)
-                            if self.is_export_by_trial:
-                                trial_arr = loaded_zda_arr[i_trial, :, :, :]
-                            else:
-                                trial_arr = np.average(loaded_zda_arr, axis = 0)
                     if roi_prefix2 is None:
                         roi_prefix2 = ""
-                    self.export_single_file_headless(subdir, zda_file, i_trial, trial_arr, curr_rois, slic_id, loc_id, rec_id, roi_prefix2 + " pulse1", 
-                                                     export_map, rebuild_map_only, fp_data=loaded_fp_data, ppr_pulse=1, rli=loaded_rli)
+                    self.export_single_file_headless(subdir, zda_file, i_trial, trial_arr, rois, slic_id, loc_id, rec_id, roi_prefix2 + " pulse1",
+                                                     roi_set_export_map, rebuild_map_only, fp_data=loaded_fp_data, ppr_pulse=1, rli=loaded_rli,
+                                                     zda_arr_no_baseline=trial_arr_no_baseline)
 
                     # set measure window 2 if it is entered
                     if (not math.isnan(pulse2_start)) or (not math.isnan(pulse2_width)):
                         if not rebuild_map_only:
                             # don't need to reselect 
                             self.set_measure_window_headless(pulse2_start, pulse2_width)
-                        if roi_prefix2 is None:
-                            roi_prefix2 = ""
-                        self.export_single_file_headless(subdir, zda_file, i_trial, trial_arr, curr_rois, slic_id, loc_id, rec_id, roi_prefix2 + " pulse2", 
-                                                         export_map, rebuild_map_only, fp_data=loaded_fp_data, ppr_pulse=2, rli=loaded_rli)
-                
+                        self.export_single_file_headless(subdir, zda_file, i_trial, trial_arr, rois, slic_id, loc_id, rec_id, roi_prefix2 + " pulse2",
+                                                         roi_set_export_map, rebuild_map_only, fp_data=loaded_fp_data, ppr_pulse=2, rli=loaded_rli,
+                                                         zda_arr_no_baseline=trial_arr_no_baseline)
+
                 if self.stop_event.is_set():
                     return
+        for roi_set_export_map in roi_set_export_maps:
+            self.merge_export_map(export_map, subdir, slic_id, loc_id, roi_set_export_map[subdir][slic_id][loc_id])
+        if self.progress is not None:
             self.progress.increment_progress_value(1)
 
     def set_polynomial_skip_window_headless(self, skip_start, skip_width=None):
@@ -608,30 +819,17 @@ class AutoExporter(AutoPhotoZ):
 
     def export_single_file_headless(self, subdir, zda_file, i_trial, zda_arr, rois, slic_id, 
                                     loc_id, rec_id, roi_prefix2, export_map, rebuild_map_only, 
-                                    fp_data=None, ppr_pulse=None, rli=None):
+                                    fp_data=None, ppr_pulse=None, rli=None, zda_arr_no_baseline=None):
         
         # first, build set of ROI traces 
         print(f"\nexport_single_file_headless Exporting {roi_prefix2} for Slice {slic_id}, Location {loc_id}, Rec {rec_id}, Trial {i_trial+1} from file: {zda_file}")
         roi_traces = []
         rli_values = []
         if not rebuild_map_only:
-            for roi in rois:
-                if len(roi) < 1:
-                    continue
-                zda_arr_ = zda_arr
-                if len(zda_arr.shape) == 3:
-                    # should be 4 D to use TraceSelector: trials * height * width * timepoints
-                    # make trials dim have length 1
-                    zda_arr_ = zda_arr.reshape(1, zda_arr.shape[0], zda_arr.shape[1], zda_arr.shape[2])
-                trace = TraceSelector(zda_arr_).get_trace_from_roi(roi)
-                roi_traces.append(trace)
-                
-                # get the RLI value for this trace by averaging the RLI values within the ROI
-                rli_value = []
-                for px in roi:
-                    rli_value.append(rli['rli_high'][px[1], px[0]])
-                rli_value = np.mean(np.array(rli_value))
-                rli_values.append(rli_value)
+            # all ROI traces and ROI RLI means from one sparse matrix multiply each
+            roi_mask = self.get_roi_mask(rois, zda_arr.shape[-3:-1])
+            roi_traces = list(roi_mask.get_traces(zda_arr))
+            rli_values = list(roi_mask.get_means(rli['rli_high']))
 
             # run measurements if amp, snr, latency, halfwidth are checked
             trace_measurements = []
@@ -743,22 +941,8 @@ class AutoExporter(AutoPhotoZ):
         if self.is_export_traces_non_polyfit:
             trace_filename = self.get_export_target_filename(subdir, slic_id, loc_id, rec_id, 'trace_non_polyfit', roi_prefix2)
             if not rebuild_map_only:
-                zda_arr_no_baseline, _, _ = self.load_zda_file(zda_file, baseline_correction=False)
-                if self.is_export_by_trial:
-                    zda_arr_no_baseline = zda_arr_no_baseline[i_trial, :, :, :]
-                else:
-                    zda_arr_no_baseline = np.average(zda_arr_no_baseline, axis = 0)
-                roi_traces_no_baseline = []
-                for roi in rois:
-                    if len(roi) < 1:
-                        continue
-                    zda_arr_no_baseline_ = zda_arr_no_baseline
-                    if len(zda_arr_no_baseline_.shape) == 3:
-                        # should be 4 D to use TraceSelector: trials * height * width * timepoints
-                        # make trials dim have length 1
-                        zda_arr_no_baseline_ = zda_arr_no_baseline_.reshape(1, zda_arr_no_baseline_.shape[0], zda_arr_no_baseline_.shape[1], zda_arr_no_baseline_.shape[2])
-                    trace = TraceSelector(zda_arr_no_baseline_).get_trace_from_roi(roi)
-                    roi_traces_no_baseline.append(trace)
+                # loaded alongside zda_arr, see load_trial_arr
+                roi_traces_no_baseline = list(roi_mask.get_traces(zda_arr_no_baseline))
                 self.save_traces_file(trace_filename, roi_traces_no_baseline)
                 print("\tExported:", trace_filename)
             self.update_export_map(export_map, subdir, slic_id, loc_id, rec_id, 'trace_non_polyfit', roi_prefix2, trace_filename)
@@ -770,26 +954,17 @@ class AutoExporter(AutoPhotoZ):
         # if either map setting, need to make measurements for every pixel
         if not rebuild_map_only:
             if any([self.is_export_max_amp_maps, self.is_export_snr_maps, self.is_export_latency_maps, self.is_export_rli_maps]):
-                tp_map = []
-                for i in range(zda_arr.shape[0]):
-                    tp_map.append([])
-                    for j in range(zda_arr.shape[1]):
-                        tp_map[i].append([])
-                        tp = TraceProperties(zda_arr[i, j, :], 
-                                        self.measure_window_start,
-                                        self.measure_window_width,
-                                        0.5,  # assume 2000 Hz
-                                        rli=rli['rli_high'][i, j]
-                                        )
-                        tp_map[i][j] = tp
+                map_properties = MapProperties(zda_arr,
+                                               self.measure_window_start,
+                                               self.measure_window_width,
+                                               0.5,  # assume 2000 Hz
+                                               rli=rli['rli_high']
+                                               )
 
         if self.is_export_max_amp_maps:
             amp_array_filename = self.get_export_target_filename(subdir, slic_id, loc_id, rec_id, 'amp_array', roi_prefix2)
             if not rebuild_map_only:
-                arr = np.array(
-                    [[tp.get_max_amp() for tp in tp_row] 
-                     for tp_row in tp_map]
-                )
+                arr = map_properties.get_max_amp()
                 self.save_array_file(amp_array_filename, arr, transpose=True)
                 print("\tExported:", amp_array_filename)
             self.update_export_map(export_map, subdir, slic_id, loc_id, rec_id, 'amp_array', roi_prefix2, amp_array_filename)
@@ -799,10 +974,7 @@ class AutoExporter(AutoPhotoZ):
         if self.is_export_snr_maps:
             snr_array_filename = self.get_export_target_filename(subdir, slic_id, loc_id, rec_id, 'snr_array', roi_prefix2)
             if not rebuild_map_only:
-                arr = np.array(
-                    [[tp.get_SNR() for tp in tp_row]
-                     for tp_row in tp_map]
-                )
+                arr = map_properties.get_SNR()
                 self.save_array_file(snr_array_filename, arr, transpose=True)
                 print("\tExported:", snr_array_filename)
             self.update_export_map(export_map, subdir, slic_id, loc_id, rec_id, 'snr_array', roi_prefix2, snr_array_filename)
@@ -812,10 +984,7 @@ class AutoExporter(AutoPhotoZ):
         if self.is_export_latency_maps:
             lat_array_filename = self.get_export_target_filename(subdir, slic_id, loc_id, rec_id, 'latency_array', roi_prefix2)
             if not rebuild_map_only:
-                arr = np.array(
-                    [[tp.get_half_amp_latency() for tp in tp_row]
-                     for tp_row in tp_map]
-                )
+                arr = map_properties.get_half_amp_latency()
                 self.save_array_file(lat_array_filename, arr, transpose=True)
                 print("\tExported:", lat_array_filename)
             self.update_export_map(export_map, subdir, slic_id, loc_id, rec_id, 'latency_array', roi_prefix2, lat_array_filename)
@@ -825,10 +994,7 @@ class AutoExporter(AutoPhotoZ):
         if self.is_export_rli_maps:
             rli_array_filename = self.get_export_target_filename(subdir, slic_id, loc_id, rec_id, 'rli_array', roi_prefix2)
             if not rebuild_map_only:
-                arr = np.array(
-                    [[tp.get_RLI() for tp in tp_row]
-                     for tp_row in tp_map]
-                )
+                arr = map_properties.get_RLI()
                 self.save_array_file(rli_array_filename, arr, transpose=True)
                 print("\tExported:", rli_array_filename)
             self.update_export_map(export_map, subdir, slic_id, loc_id, rec_id, 'rli_array', roi_prefix2, rli_array_filename)
@@ -921,7 +1087,10 @@ class AutoExporter(AutoPhotoZ):
         self.export(rebuild_map_only=True)
 
     def read_array_file(self, filename, w=80, h=80):
-        """ Read in a .dat file and return the numpy array """
+        """ Read in a .dat file (or ExportStore reference) and return the numpy array """
+        if ExportStore.is_reference(filename):
+            store, key = self.get_export_store(filename)
+            return store.get(key).reshape((w, h))
         data_arr = pd.read_csv(filename,
                                 sep='\t',
                                 header=None,
@@ -930,23 +1099,36 @@ class AutoExporter(AutoPhotoZ):
         return data_arr
 
     def read_trace_value_file(self, filename):
-        """ Read in a .dat file and return the numpy array """
+        """ Read in a .dat file (or ExportStore reference) and return the numpy array """
+        if ExportStore.is_reference(filename):
+            store, key = self.get_export_store(filename)
+            values = store.get(key)
+            return pd.DataFrame({'ROI': np.arange(1, len(values) + 1), 'Value': values})
         return pd.read_csv(filename, sep="\t", header=None, names=['ROI', 'Value'])
     
     def save_array_file(self, filename, arr, transpose=False):
         """ flatten 80x80 to 6400 values and write to array file
             matching format of read_array_file() method (PhotoZ .dat)"""
+        if transpose:
+            arr = arr.T
+        if ExportStore.is_reference(filename):
+            # stored as read_array_file() returns it
+            store, key = self.get_export_store(filename)
+            store.put(key, np.ascontiguousarray(np.asarray(arr).T))
+            return
         # flatten arr
         idx = 1
         with open(filename, mode='w') as f:
-            if transpose:
-                arr = arr.T
             for i in range(arr.shape[1]):
                 for j in range(arr.shape[0]):
                     f.write(str(idx) + "\t" + str(arr[j, i]) + "\n")
                     idx += 1
 
     def save_trace_value_file(self, filename, arr):
+        if ExportStore.is_reference(filename):
+            store, key = self.get_export_store(filename)
+            store.put(key, np.asarray(arr, dtype=np.float64))
+            return
         with open(filename, "w") as f:
             for i in range(len(arr)):
                 f.write(str(i+1) + "\t" + str(arr[i]) + "\n")
@@ -957,6 +1139,11 @@ class AutoExporter(AutoPhotoZ):
         "Pt" then "ROI1", ROI2, ... """
         if len(traces) < 1:
             return
+        if ExportStore.is_reference(filename):
+            # ROIs x points
+            store, key = self.get_export_store(filename)
+            store.put(key, np.array(traces))
+            return
         with open(filename, "w") as f:
             n_pts = len(traces[0])
             n_rois = len(traces)
@@ -971,10 +1158,13 @@ class AutoExporter(AutoPhotoZ):
     def type_is_trace_value(self, trace_type):
         return 'array' not in trace_type and 'trace' != trace_type and 'trace_non_polyfit' != trace_type
 
-    def generate_summary_csv(self, export_map):
+    def generate_summary_csv(self, export_map, manifest, map_settings, cached_subdirs):
         """ Generate a summary csv file with the metrics. Each row identified by date, slice, loc, rec, roi.
             Each column is a metric type: amp, snr, latency, halfwidth, trace, snr_map, max_amp_map 
-            Use pandas dataframe, read in text files whose filenames are stored in the export_map 
+            Use pandas dataframe, read in text files whose filenames are stored in the export_map.
+            Rows of recordings whose files did not change since the last summary are reused from
+            the export manifest instead of being re-read. In cached_subdirs (export map reused from
+            the manifest, so nothing was exported there since), only ROI and electrode files are checked.
             
             export_map: dict with keys: subdir, slic_id, loc_id, rec_id, trace_type, roi_prefix, filename"""
         csv_filename = self.data_dir + "/export_summary.csv"
@@ -1009,161 +1199,19 @@ class AutoExporter(AutoPhotoZ):
                             stim_file = self.get_electrode_filename(subdir, rec_slic_loc_id, 
                                                                     self.electrode_export_keyword)
 
-                        tmp_dict = {}
-                        for trace_type in export_map[subdir][slic_id][loc_id][rec_id]:
-                            if rec_id == 'zda_files':
-                                continue
-                            for roi_prefix in export_map[subdir][slic_id][loc_id][rec_id][trace_type]:
-                                filename = export_map[subdir][slic_id][loc_id][rec_id][trace_type][roi_prefix]
-                                if not os.path.exists(filename):
-                                    data = None
-                                if self.type_is_trace_value(trace_type):
-                                    try:
-                                        data = self.read_trace_value_file(filename)
-                                    except FileNotFoundError:
-                                        print("File not found:", filename, "Cannot include in summary csv.")
-                                        data = None
-                                    if data is not None:
-                                        print("Including data from file:", filename)
-                                else:
-                                    # otherwise, just put the filename in the column
-                                    data = filename
-                                if roi_prefix not in tmp_dict:
-                                    tmp_dict[roi_prefix] = {}
-                                tmp_dict[roi_prefix][trace_type] = data
-                                
-                        # unload the tmp_dict into the data_df_dict in the correct order for this recording
-                        for roi_prefix in tmp_dict:
-                            n = None
-                            rois = []
-                            for trace_type in tmp_dict[roi_prefix]:
-                                data = tmp_dict[roi_prefix][trace_type]
-                                if data is not None and type(data) != str:
-                                    n = len(data['Value'])
-                                    if n == 0:
-                                        print("Empty data for roi: ", roi_prefix, " trace_type: ", trace_type)
-                                    if 'ROI' not in data_df_dict:
-                                        data_df_dict['ROI'] = []
-                                    if trace_type not in data_df_dict:
-                                        data_df_dict[trace_type] = []
-                                    data_df_dict[trace_type] += list(data['Value'].values)
-                                    print("Adding data for roi: ", roi_prefix, " trace_type: ", trace_type)
-                                    rois = list(data['ROI'].values)
-
-                            # if we have a stim file, also find the ROI file and calculate distance to stim
-                            distances = []
-                            x_centers = []
-                            y_centers = []
-                            roi_file = ''
-                            rois_ = []
-                            if roi_prefix is not None and len(roi_prefix) > 0:
-                                roi_file = subdir + "/" + roi_prefix.split(" ")[0] + ".dat"
-                                if os.path.exists(roi_file):
-                                    # load rois 
-                                    rois_ = ROIFileReaderLegacy(roi_file).get_roi_list()
-                                    rois_ = [LaminarROI(r, input_diode_numbers=True)
-                                            for r in rois_]
-                                    # remove any empty rois
-                                    rois_ = [r for r in rois_ if len(r.get_points()) > 0]
-                                    assert len(rois_) == n, \
-                                        "Number of ROIs in ROI file (" + str(len(rois_)) + ")does not match number of " + \
-                                        "ROIs in exported data ("  + str(n) + ") for roi: "+ \
-                                        roi_prefix + " Date " + date + " Slice " + str(slic_id) + \
-                                        " Location " + str(loc_id) + " Recording " + str(rec_id)
-                                    
-                                    rois_points = [roi.get_points() for roi in rois_]
-
-                                    if stim_file is not None:
-                                        
-                                        stim_point = ROIFileReaderLegacy(subdir + "/" + stim_file).get_roi_list()
-                                        stim_point = LaminarROI(stim_point[0], input_diode_numbers=True).get_points()[0]
-                                        
-                                        # calculate distance from electrode
-                                        distances = [Line(stim_point, roi[0]).get_length() * self.microns_per_pixel
-                                                    if len(roi) > 0 
-                                                    else None
-                                                    for roi in rois_points]
-                                    elif 'Stim_Distance' in data_df_dict:
-                                        print("Warning: stim file not found for roi: ", roi_prefix, "Date",
-                                                date, "Slice", slic_id, "Location", loc_id, "Recording", rec_id,
-                                                " but Stim_Distance column already exists.")
-
-                                    # x, y pixel locations of center of each roi
-                                    centers = [roi.get_center() for roi in rois_]
-                                    x_centers = [c[0] for c in centers]
-                                    y_centers = [c[1] for c in centers]
-
-                            # initialize Stim_Distance, X_Center, Y_Center columns if not present
-                            if 'Stim_Distance' not in data_df_dict and stim_file is not None:
-                                data_df_dict['Stim_Distance'] = []
-                            if 'X_Center' not in data_df_dict:
-                                data_df_dict['X_Center'] = []
-                            if 'Y_Center' not in data_df_dict:
-                                data_df_dict['Y_Center'] = []
-                            
-                            if n is None:
-                                n = len(rois_)
-                                print("Estimate length of this roi set from X_Center column: n = ", n)
-                            if stim_file is not None:
-                                data_df_dict['Stim_Distance'] += distances
-                            if (n is None or n < 1) and os.path.exists(roi_file):  
-                                # 2 cases here:
-                                # Not 1-ROI-one-row: e.g. no ROI file or ROI-based values (e.g. map-only export)
-                                # ROI file exists but no ROIs in it; it may still be 1-ROI-one-row
-                                if enable_placeholder_rows:
-                                    print("Inserting placeholder row for non-DAT data for roi: ", roi_prefix,
-                                        date, slic_id, loc_id, rec_id)
-                                    n = 1  # placeholder row to insert any non-DAT data
-                                    #if 'Stim_Distance' in data_df_dict:
-                                    #    del data_df_dict['Stim_Distance']  # Stim_Distance should have been empty if this line was reached
-                                    del data_df_dict['X_Center']
-                                    del data_df_dict['Y_Center']
-                                    if 'ROI_File' not in data_df_dict:
-                                        data_df_dict['ROI_File'] = []
-                                    data_df_dict['ROI_File'].append(roi_file)
-                            else:
-                                data_df_dict['X_Center'] += x_centers
-                                data_df_dict['Y_Center'] += y_centers
-                                print("Adding " + str(x_centers) + " centers for rois: ", roi_prefix)
-
-                            print("Adding n = ", n, " rows")
-
-                            if 'Date' not in data_df_dict:
-                                data_df_dict['ROI_Set'] = []
-                                if len(rois) > 0:
-                                    data_df_dict['ROI'] = []
-                                data_df_dict['Date'] = []
-                                data_df_dict['Slice'] = []
-                                data_df_dict['Location'] = []
-                                data_df_dict['Recording'] = []
-                                
-                            data_df_dict['ROI_Set'] += [roi_prefix for _ in range(n)]
-                            if len(rois) > 0:
-                                data_df_dict['ROI'] += rois
-                            data_df_dict['Date'] += [date for _ in range(n)]
-                            data_df_dict['Slice'] += [slic_id for _ in range(n)]
-                            data_df_dict['Location'] += [loc_id for _ in range(n)]
-                            data_df_dict['Recording'] += [rec_id for _ in range(n)]
-
-                            for trace_type in tmp_dict[roi_prefix]:
-                                if trace_type in ['trace', 'snr_array', 'amp_array', 'trace_non_polyfit', 'latency_array']:
-                                    print("Adding filename for roi: ", roi_prefix, " trace_type: ", trace_type)
-                                    if trace_type not in data_df_dict:
-                                        data_df_dict[trace_type] = []
-                                    data = tmp_dict[roi_prefix][trace_type]
-
-                                    # replace spaces with underscores in the file name but not the file path
-                                    data_end_filename = data.split("/")[-1]
-                                    data = data.replace(data_end_filename, data_end_filename.replace(" ", "_"))
-                                    data_df_dict[trace_type] += [data for _ in range(n)]
-
-                            # check if lengths are equal in the data_df_dict
-                            for k in data_df_dict:
-                                if len(data_df_dict[k]) != len(data_df_dict['Date']) and k != "Stim_Distance":
-                                    if self.debug:
-                                        raise Exception("Unequal lengths in data_df_dict: ", 
-                                                k, len(data_df_dict[k]), len(data_df_dict['Date']),
-                                                "Date: ", date, slic_id, loc_id, rec_id, "\n # ROIs in ROI file: ", len(rois), "(roi_prefix: ", roi_prefix, ")")
+                        if rec_id == 'zda_files':
+                            continue
+                        rows = self.get_cached_summary_rows(manifest, export_map, subdir, date, slic_id, loc_id, rec_id,
+                                                            stim_file, enable_placeholder_rows,
+                                                            check_exported_files=subdir not in cached_subdirs)
+                        for k in rows:
+                            if k not in data_df_dict:
+                                data_df_dict[k] = []
+                            data_df_dict[k] += rows[k]
+            if subdir not in cached_subdirs:
+                manifest.set_subdir_map(subdir, self.get_subdir_listing(subdir), map_settings,
+                                        copy.deepcopy(export_map[subdir]))
+        manifest.save()
 
         key_delete = []    
         unequal_flag = False
@@ -1198,12 +1246,233 @@ class AutoExporter(AutoPhotoZ):
                 pa.alert("Permission error. Do you have " + csv_filename + " open? Please close and then click ok.")
                 df.to_csv(csv_filename, index=False)  
 
+    def get_exported_value_files(self, export_map, subdir, slic_id, loc_id, rec_id):
+        """ Exported trace value files (or their ExportStores) of one recording """
+        filenames = set()
+        rec_map = export_map[subdir][slic_id][loc_id][rec_id]
+        for trace_type in rec_map:
+            if self.type_is_trace_value(trace_type):
+                for roi_prefix in rec_map[trace_type]:
+                    filename = rec_map[trace_type][roi_prefix]
+                    if ExportStore.is_reference(filename):
+                        filename, _ = ExportStore.split_reference(filename)
+                    filenames.add(filename)
+        return filenames
+
+    def get_summary_input_files(self, export_map, subdir, slic_id, loc_id, rec_id, stim_file):
+        """ Files that the summary rows of one recording are read from: trace value files
+            (or their ExportStores), ROI files and the electrode file """
+        filenames = self.get_exported_value_files(export_map, subdir, slic_id, loc_id, rec_id)
+        rec_map = export_map[subdir][slic_id][loc_id][rec_id]
+        for trace_type in rec_map:
+            for roi_prefix in rec_map[trace_type]:
+                if roi_prefix is not None and len(roi_prefix) > 0:
+                    filenames.add(subdir + "/" + roi_prefix.split(" ")[0] + ".dat")
+        if stim_file is not None:
+            filenames.add(subdir + "/" + stim_file)
+        return sorted(filenames)
+
+    def get_cached_summary_rows(self, manifest, export_map, subdir, date, slic_id, loc_id, rec_id,
+                                stim_file, enable_placeholder_rows, check_exported_files=True):
+        """ Summary rows of one recording, from the manifest if none of its files changed.
+            Without check_exported_files, only its ROI and electrode files are checked """
+        key = (subdir, slic_id, loc_id, rec_id)
+        filenames = self.get_summary_input_files(export_map, subdir, slic_id, loc_id, rec_id, stim_file)
+        settings = (date, stim_file, enable_placeholder_rows, self.microns_per_pixel,
+                    copy.deepcopy(export_map[subdir][slic_id][loc_id][rec_id]))
+        unchecked_files = set()
+        if not check_exported_files:
+            unchecked_files = self.get_exported_value_files(export_map, subdir, slic_id, loc_id, rec_id)
+        rows = manifest.get_rows(key, filenames, settings, unchecked_files=unchecked_files)
+        if rows is not None:
+            print("Unchanged since last summary:", date, slic_id, loc_id, rec_id)
+            return rows
+        rows = self.get_summary_rows(export_map, subdir, date, slic_id, loc_id, rec_id,
+                                     stim_file, enable_placeholder_rows)
+        manifest.set_rows(key, filenames, settings, rows)
+        return rows
+
+    def get_summary_rows(self, export_map, subdir, date, slic_id, loc_id, rec_id, stim_file, enable_placeholder_rows):
+        """ Summary csv rows of one recording, as a dict of column name -> list of values """
+        data_df_dict = {}
+        tmp_dict = {}
+        for trace_type in export_map[subdir][slic_id][loc_id][rec_id]:
+            for roi_prefix in export_map[subdir][slic_id][loc_id][rec_id][trace_type]:
+                filename = export_map[subdir][slic_id][loc_id][rec_id][trace_type][roi_prefix]
+                if not os.path.exists(filename):
+                    data = None
+                if self.type_is_trace_value(trace_type):
+                    try:
+                        data = self.read_trace_value_file(filename)
+                    except FileNotFoundError:
+                        print("File not found:", filename, "Cannot include in summary csv.")
+                        data = None
+                    if data is not None:
+                        print("Including data from file:", filename)
+                else:
+                    # otherwise, just put the filename in the column
+                    data = filename
+                if roi_prefix not in tmp_dict:
+                    tmp_dict[roi_prefix] = {}
+                tmp_dict[roi_prefix][trace_type] = data
+
+        # unload the tmp_dict into the data_df_dict in the correct order for this recording
+        for roi_prefix in tmp_dict:
+            n = None
+            rois = []
+            for trace_type in tmp_dict[roi_prefix]:
+                data = tmp_dict[roi_prefix][trace_type]
+                if data is not None and type(data) != str:
+                    n = len(data['Value'])
+                    if n == 0:
+                        print("Empty data for roi: ", roi_prefix, " trace_type: ", trace_type)
+                    if 'ROI' not in data_df_dict:
+                        data_df_dict['ROI'] = []
+                    if trace_type not in data_df_dict:
+                        data_df_dict[trace_type] = []
+                    data_df_dict[trace_type] += list(data['Value'].values)
+                    print("Adding data for roi: ", roi_prefix, " trace_type: ", trace_type)
+                    rois = list(data['ROI'].values)
+
+            # if we have a stim file, also find the ROI file and calculate distance to stim
+            distances = []
+            x_centers = []
+            y_centers = []
+            roi_file = ''
+            rois_ = []
+            if roi_prefix is not None and len(roi_prefix) > 0:
+                roi_file = subdir + "/" + roi_prefix.split(" ")[0] + ".dat"
+                if os.path.exists(roi_file):
+                    # load rois 
+                    rois_ = ROIFileReaderLegacy(roi_file).get_roi_list()
+                    rois_ = [LaminarROI(r, input_diode_numbers=True)
+                            for r in rois_]
+                    # remove any empty rois
+                    rois_ = [r for r in rois_ if len(r.get_points()) > 0]
+                    assert len(rois_) == n, \
+                        "Number of ROIs in ROI file (" + str(len(rois_)) + ")does not match number of " + \
+                        "ROIs in exported data ("  + str(n) + ") for roi: "+ \
+                        roi_prefix + " Date " + date + " Slice " + str(slic_id) + \
+                        " Location " + str(loc_id) + " Recording " + str(rec_id)
+
+                    rois_points = [roi.get_points() for roi in rois_]
+
+                    if stim_file is not None:
+
+                        stim_point = ROIFileReaderLegacy(subdir + "/" + stim_file).get_roi_list()
+                        stim_point = LaminarROI(stim_point[0], input_diode_numbers=True).get_points()[0]
+
+                        # calculate distance from electrode
+                        distances = [Line(stim_point, roi[0]).get_length() * self.microns_per_pixel
+                                    if len(roi) > 0 
+                                    else None
+                                    for roi in rois_points]
+                    elif 'Stim_Distance' in data_df_dict:
+                        print("Warning: stim file not found for roi: ", roi_prefix, "Date",
+                                date, "Slice", slic_id, "Location", loc_id, "Recording", rec_id,
+                                " but Stim_Distance column already exists.")
+
+                    # x, y pixel locations of center of each roi
+                    centers = [roi.get_center() for roi in rois_]
+                    x_centers = [c[0] for c in centers]
+                    y_centers = [c[1] for c in centers]
+
+            # initialize Stim_Distance, X_Center, Y_Center columns if not present
+            if 'Stim_Distance' not in data_df_dict and stim_file is not None:
+                data_df_dict['Stim_Distance'] = []
+            if 'X_Center' not in data_df_dict:
+                data_df_dict['X_Center'] = []
+            if 'Y_Center' not in data_df_dict:
+                data_df_dict['Y_Center'] = []
+
+            if n is None:
+                n = len(rois_)
+                print("Estimate length of this roi set from X_Center column: n = ", n)
+            if stim_file is not None:
+                data_df_dict['Stim_Distance'] += distances
+            if (n is None or n < 1) and os.path.exists(roi_file):  
+                # 2 cases here:
+                # Not 1-ROI-one-row: e.g. no ROI file or ROI-based values (e.g. map-only export)
+                # ROI file exists but no ROIs in it; it may still be 1-ROI-one-row
+                if enable_placeholder_rows:
+                    print("Inserting placeholder row for non-DAT data for roi: ", roi_prefix,
+                        date, slic_id, loc_id, rec_id)
+                    n = 1  # placeholder row to insert any non-DAT data
+                    #if 'Stim_Distance' in data_df_dict:
+                    #    del data_df_dict['Stim_Distance']  # Stim_Distance should have been empty if this line was reached
+                    del data_df_dict['X_Center']
+                    del data_df_dict['Y_Center']
+                    if 'ROI_File' not in data_df_dict:
+                        data_df_dict['ROI_File'] = []
+                    data_df_dict['ROI_File'].append(roi_file)
+            else:
+                data_df_dict['X_Center'] += x_centers
+                data_df_dict['Y_Center'] += y_centers
+                print("Adding " + str(x_centers) + " centers for rois: ", roi_prefix)
+
+            print("Adding n = ", n, " rows")
+
+            if 'Date' not in data_df_dict:
+                data_df_dict['ROI_Set'] = []
+                if len(rois) > 0:
+                    data_df_dict['ROI'] = []
+                data_df_dict['Date'] = []
+                data_df_dict['Slice'] = []
+                data_df_dict['Location'] = []
+                data_df_dict['Recording'] = []
+
+            data_df_dict['ROI_Set'] += [roi_prefix for _ in range(n)]
+            if len(rois) > 0:
+                data_df_dict['ROI'] += rois
+            data_df_dict['Date'] += [date for _ in range(n)]
+            data_df_dict['Slice'] += [slic_id for _ in range(n)]
+            data_df_dict['Location'] += [loc_id for _ in range(n)]
+            data_df_dict['Recording'] += [rec_id for _ in range(n)]
+
+            for trace_type in tmp_dict[roi_prefix]:
+                if trace_type in ['trace', 'snr_array', 'amp_array', 'trace_non_polyfit', 'latency_array']:
+                    print("Adding filename for roi: ", roi_prefix, " trace_type: ", trace_type)
+                    if trace_type not in data_df_dict:
+                        data_df_dict[trace_type] = []
+                    data = tmp_dict[roi_prefix][trace_type]
+
+                    # replace spaces with underscores in the file name but not the file path
+                    data_end_filename = data.split("/")[-1]
+                    data = data.replace(data_end_filename, data_end_filename.replace(" ", "_"))
+                    data_df_dict[trace_type] += [data for _ in range(n)]
+
+            # check if lengths are equal in the data_df_dict
+            for k in data_df_dict:
+                if len(data_df_dict[k]) != len(data_df_dict['Date']) and k != "Stim_Distance":
+                    if self.debug:
+                        raise Exception("Unequal lengths in data_df_dict: ", 
+                                k, len(data_df_dict[k]), len(data_df_dict['Date']),
+                                "Date: ", date, slic_id, loc_id, rec_id, "\n # ROIs in ROI file: ", len(rois), "(roi_prefix: ", roi_prefix, ")")
+        return data_df_dict
+
     def pad_zeros(self, x, n_digits=2):
         """ Pad zeros to the front of the string integer IF it is enabled """
         if not self.zero_pad_ids:
             return x
         return '0' * (n_digits - len(str(x))) + str(x)
-        
-                            
 
-                    
+
+# worker process state for AutoExporter.run_export_work_units
+worker_exporter = None
+
+
+def init_export_worker(exporter, stop_event):
+    global worker_exporter
+    worker_exporter = exporter
+    # shared with the exporting process, so setting its stop_event stops the running file
+    worker_exporter.stop_event = stop_event
+
+
+def export_zda_file_worker(work_unit):
+    """ Export one ZDA file in a worker process and return its export map entries (rec_id -> trace_type -> roi_prefix) """
+    curr_rois, subdir, slic_id, loc_id, zda_file, roi_prefix, last_opened_roi_file = work_unit
+    worker_exporter.last_opened_roi_file = last_opened_roi_file
+    export_map = {subdir: {slic_id: {loc_id: {}}}}
+    worker_exporter.export_zda_file_headless(curr_rois, subdir, slic_id, loc_id, zda_file, roi_prefix, export_map, False)
+    worker_exporter.save_export_stores()
+    return export_map[subdir][slic_id][loc_id]
@@ -2,58 +2,180 @@ import os
 import time
 import threading
 
+try:
+    # optional: file system events (inotify, ReadDirectoryChangesW, ...) instead of polling only
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
 
 class FileDetector:
-    """ Automatically detect and convert files in directory """
-    def __init__(self, directory=None, file_type='.tsm'):
+    """ Automatically detect and convert files in directory.
+        A .tsm file is reported once it and its .tbn file are completely written: both exist
+        and their sizes have not changed for stability_interval seconds.
+        Directory changes wake detection immediately if watchdog is installed,
+        otherwise the directory is polled every poll_interval seconds. """
+    def __init__(self, directory=None, file_type='.tsm', pair_type='.tbn',
+                 stability_interval=1.0, poll_interval=1.0):
         self.directory = directory
         if self.directory is None:
             self.directory = os.getcwd()
-        self.file_list = []
         self.file_type = file_type
+        self.pair_type = pair_type
+        self.stability_interval = stability_interval
+        self.poll_interval = poll_interval
+
+        self.known_files = set()  # files already reported
+        self.pending_files = {}  # file -> (sizes, time the sizes were first seen)
         self.unprocessed_files = []
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()  # set by file system events
+        self.new_file_event = threading.Event()  # set when a file is reported
+        self.observer = None
 
         self.stop_flag = False
 
-    def update_file_list(self):
-        files = os.listdir(self.directory)
-        for f in files:
-            if f[-4:] == self.file_type:
-                self.file_list.append(f)
+    def get_file_states(self, f):
+        """ (size, mtime) of f and its pair file, (-1, 0) for a file that does not exist (yet) """
+        path = os.path.join(self.directory, f)
+        filenames = [path]
+        if self.pair_type is not None:
+            filenames.append(path[:-len(self.file_type)] + self.pair_type)
+        states = []
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+                states.append((st.st_size, st.st_mtime))
+            except OSError:
+                states.append((-1, 0))
+        return states
+
+    def is_complete(self, f, now):
+        """ True once f and its pair file exist and have kept the same sizes for stability_interval seconds """
+        states = self.get_file_states(f)
+        sizes = tuple(size for size, mtime in states)
+        if sizes[0] < 0:
+            self.pending_files.pop(f, None)
+            return False
+        if f not in self.pending_files or self.pending_files[f][0] != sizes:
+            # new or still growing: start timing from the last write to either file
+            last_write = max(mtime for size, mtime in states)
+            self.pending_files[f] = (sizes, min(now, last_write))
+        return min(sizes) >= 0 and now - self.pending_files[f][1] >= self.stability_interval
 
     def detect_files_background(self):
         while not self.stop_flag:
-            time.sleep(5)
             self.detect_files()
+            # wake on a file system event, or poll
+            timeout = self.poll_interval
+            if len(self.pending_files) > 0:
+                timeout = min(timeout, self.stability_interval / 2)
+            self.wake_event.wait(timeout=timeout)
+            self.wake_event.clear()
 
     def detect_files(self):
-        old_files = [x for x in self.file_list]
-        self.update_file_list()
-        for f in self.file_list:
-            if f not in old_files:
-                self.handle_new_file(f)
+        """ One detection pass over the directory. Returns the number of newly reported files """
+        now = time.time()
+        n_new = 0
+        with self.lock:
+            for entry in os.scandir(self.directory):
+                f = entry.name
+                if f[-4:] != self.file_type or f in self.known_files:
+                    continue
+                if self.is_complete(f, now):
+                    self.known_files.add(f)
+                    self.pending_files.pop(f, None)
+                    self.handle_new_file(f)
+                    n_new += 1
+        if n_new > 0:
+            self.new_file_event.set()
+        return n_new
+
+    def wait_for_new_files(self, timeout):
+        """ Detect files until at least one new file is reported or timeout seconds have passed.
+            Returns True if there are new files """
+        deadline = time.time() + timeout
+        was_watching = self.observer is not None
+        self.start_watching()
+        try:
+            while True:
+                if self.detect_files() > 0:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                wait = remaining
+                if len(self.pending_files) > 0:
+                    wait = min(wait, self.stability_interval / 2)
+                elif self.observer is None:
+                    wait = min(wait, self.poll_interval)
+                self.wake_event.wait(timeout=wait)
+                self.wake_event.clear()
+        finally:
+            if not was_watching:
+                self.stop_watching()
+
+    def start_watching(self):
+        """ Start file system event notifications, if watchdog is available """
+        if Observer is None or self.observer is not None:
+            return
+        try:
+            self.observer = Observer()
+            self.observer.schedule(FileEventHandler(self), self.directory, recursive=False)
+            self.observer.start()
+        except Exception as e:
+            print("Could not watch", self.directory, "for file events, polling instead:", e)
+            self.observer = None
+
+    def stop_watching(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
 
     def start_file_detection_loop(self):
         self.stop_flag = False
         self.unprocessed_files = []
-        self.file_list = []
+        self.known_files = set()
+        self.pending_files = {}
+        self.start_watching()
         threading.Thread(target=self.detect_files_background,
                          args=(),
                          daemon=True).start()
 
     def stop_file_detection_loop(self):
         self.stop_flag = True
+        self.wake_event.set()
+        self.stop_watching()
 
     def handle_new_file(self, filename):
         self.unprocessed_files.append(filename)
 
     def get_unprocessed_file_list(self):
-        self.unprocessed_files.sort()
-        ls = [self.directory + "/" + x for x in self.unprocessed_files]
-        self.unprocessed_files = []  # mark files processed
+        with self.lock:
+            self.unprocessed_files.sort()
+            ls = [self.directory + "/" + x for x in self.unprocessed_files]
+            self.unprocessed_files = []  # mark files processed
+            self.new_file_event.clear()
         return ls
 
 
+class FileEventHandler(FileSystemEventHandler):
+    """ Wakes a FileDetector when a file of interest is created, written, closed or renamed """
+
+    def __init__(self, file_detector):
+        super().__init__()
+        self.file_detector = file_detector
+
+    def on_any_event(self, event):
+        path = getattr(event, 'dest_path', '') or event.src_path
+        if path.endswith(self.file_detector.file_type) or \
+                (self.file_detector.pair_type is not None and path.endswith(self.file_detector.pair_type)):
+            self.file_detector.wake_event.set()
+
+
 class AutoLauncher:
     """ Automatically open relevant programs and folders """
     def __init__(self, desktop='./Shortcuts/',
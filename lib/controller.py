@@ -5,6 +5,11 @@ import os
 from datetime import date
 import winshell
 from lib.automation import FileDetector
+from lib.tsm_converter import TSM_Converter
+from lib.conversion_worker import ConversionWorker
+from lib.auto_GUI.auto_TSM import AutoTSM
+from lib.auto_GUI.auto_PhotoZ import AutoPhotoZ
+from lib.auto_GUI.auto_Pulser import AutoPulser
 from lib.auto_GUI.auto_DAT import AutoDAT
 from lib.auto_GUI.auto_trace import AutoTrace
 from lib.raspberry_pi.fan import Fan
@@ -13,6 +18,7 @@ from lib.analysis.movie_maker import MovieMaker
 from lib.analysis.paired_pulse import PairedPulseExporter
 from lib.analysis.cell_roi import ROIWizard
 from lib.analysis.roi_annotator import BarrelLayerROIAnnotator, MaxSNRROIAnnotator
+from ZDA_Adventure.tools import PreprocessCache
 import random
 
 
@@ -110,7 +116,7 @@ class Controller:
         # roi wizard
         self.roi_wizard_max_rois = 100
         self.roi_wizard_pixels_per_roi = 1
-        self.roi_wizard_roi_type_options = ['Random', 'Bands/Stripes', 'Ladder', '3x3 SNR Maximal', '5x5 SNR Maximal', 'Masked Grid']
+        self.roi_wizard_roi_type_options = ['Random', 'Bands/Stripes', 'Ladder', '3x3 SNR Maximal', '5x5 SNR Maximal', 'Masked Grid', '7x7 SNR Maximal']
         self.roi_wizard_roi_type_idx = 0
         self.roi_wizard_stripe_dir_keyword = 'stripe_dir'
 
@@ -124,6 +130,10 @@ class Controller:
         self.enable_headless_spatial_filter = False
         self.headless_spatial_filter_sigma = 1.0
         self.headless_binning_factor = 1
+        self.export_format_options = ['DAT', 'NPZ']
+        self.export_format_idx = 0
+        self.num_export_workers = 1
+        self.enable_preprocess_disk_cache = False  # keep preprocessed arrays on disk across runs
 
         # roi annotator workflow settings
         self.roi_annotator_brush_size = 4
@@ -232,17 +242,26 @@ class Controller:
 
     def record(self, **kwargs):
         self.estimate_time_total_progress_bar()
+        conversion_worker = None
+        if self.should_convert_files:
+            # convert each recording's trials while the next ones are acquired
+            conversion_worker = self.start_conversion_worker()
         if not self.acqui_data.is_paired_pulse_recording:
             self.run_recording_schedule(kwargs['stop_event'])
         else:
             self.run_paired_pulse_recording_schedule(kwargs['stop_event'])
         if self.should_cancel_task(kwargs['stop_event']):
+            if conversion_worker is not None:
+                conversion_worker.cancel()
+                self.acqui_data.record_no += conversion_worker.n_groups
             self.progress.complete()
             return
 
-        if self.should_convert_files:
+        if conversion_worker is not None:
             self.progress.update_status_message("Converting files...")
-            self.detect_and_convert()
+            conversion_worker.finish()
+            # record numbers are only advanced here, on the thread that owns acqui_data
+            self.acqui_data.record_no += conversion_worker.n_groups
         self.progress.complete()
 
     def run_recording_schedule(self,
@@ -372,25 +391,48 @@ class Controller:
                     stim_times += "\t" + str(coin_flips[i])
                 f.write(str(stim_times) + "\n")
 
-    def detect_and_convert(self, detection_loops=1, **kwargs):
-        new_files = []
-        # archive directory
+    def get_archive_dir(self):
+        """ Directory 'slice_loc' that converted TSM files are moved to. Created if needed """
         dst_dir = self.get_data_dir() \
                   + "/" + str(self.acqui_data.slice_no) \
                   + "_" + str(self.acqui_data.location_no)
         if not os.path.exists(dst_dir):
             os.makedirs(dst_dir)
+        return dst_dir
+
+    def start_conversion_worker(self):
+        """ Start converting trial groups in the background as their files are written """
+        dst_dir = self.get_archive_dir()
+        print("Converting new files in the background from:", self.get_data_dir())
+        conversion_worker = ConversionWorker(self.get_data_dir(),
+                                             self.get_data_dir(no_date=False) + "/converted_zda",
+                                             self.acqui_data.num_trials,
+                                             self.get_tsm_converter(),
+                                             archive_dir=dst_dir,
+                                             archive_file=self.archive_tsm_file)
+        conversion_worker.start()
+        return conversion_worker
+
+    def detect_and_convert(self, detection_loops=1, detection_timeout=8, **kwargs):
+        new_files = []
+        # archive directory
+        dst_dir = self.get_archive_dir()
 
         print("Searching for new files in:", self.get_data_dir())
         fd = FileDetector(directory=self.get_data_dir())
         for i in range(detection_loops):
-            time.sleep(3)
-            fd.detect_files()
-            new_files += fd.get_unprocessed_file_list()
+            # wait until TurboSM has finished writing a full trial group of TSM/TBN pairs,
+            # or give up after detection_timeout seconds
+            deadline = time.time() + detection_timeout
+            while len(new_files) < self.acqui_data.num_trials:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                fd.wait_for_new_files(timeout=remaining)
+                new_files += fd.get_unprocessed_file_list()
             if len(new_files) >= self.acqui_data.num_trials:
                 new_files.sort()
                 print("Preparing to process into ZDA file(s)... ")
-                time.sleep(5)  # wait for TurboSM to safely finish writing to disk
 
                 # process new files
                 n_process = len(new_files) - (len(new_files) % self.acqui_data.num_trials)
@@ -563,185 +605,73 @@ class Controller:
     def is_recording(self):
         return self.aTSM is not None and self.aTSM.is_recording
 
+    def find_selected_files(self):
+        """ Map each selected filename to the first matching file path in the data directory,
+            without loading any of them """
+        file_paths = []
+        for dirName, subdirList, fileList in os.walk(self.get_data_dir(), topdown=True):
+            for file in fileList:
+                if file[-4:] == self.file_type:
+                    file_paths.append(str(dirName + "/" + file))
+
+        selected_paths = []
+        for fn in self.selected_filenames:
+            matches = [file for file in file_paths if fn in file]
+            selected_paths.append(matches[0] if len(matches) > 0 else None)
+        return selected_paths
+
+    def get_tsm_converter(self):
+        return TSM_Converter(self.cam_settings,
+                             self.binning,
+                             self.get_t_cropping(),
+                             self.acqui_data.num_trials,
+                             self.acqui_data.slice_no,
+                             self.acqui_data.location_no,
+                             self.acqui_data.record_no,
+                             num_flatten_points=self.acqui_data.num_flatten_points,
+                             apply_preprocess=self.apply_preprocess,
+                             filename_PhotoZ_format=self.filename_PhotoZ_format,
+                             assign_ascending_recording_numbers=self.assign_ascending_recording_numbers)
+
     def process_files(self, no_plot=False):
+        """ Convert the selected files to ZDA as a stream: each file is read, processed and written
+            into its trial slot of the group's ZDA file before the next file is read, so memory use
+            stays at about one trial regardless of how many files are selected.
+            See TSM_Converter, which convert_tsm_batch.py also uses for headless batch conversion. """
         n_group_by_trials = self.acqui_data.num_trials
-        data_loader = DataLoader()
-
-        if self.file_type == '.tsm':
-            data_loader.load_all_tsm(data_dir=self.get_data_dir(), verbose=False)
-
-        print(data_loader.get_n_files_loaded(), "files loaded.")
 
         # Select data of interest
-        selected_datasets = [data_loader.select_data_by_keyword(fn) for fn in self.selected_filenames]
-
-        for i in range(len(self.selected_filenames) - 1, 0):
-            if selected_datasets[i] is None:
-                del selected_datasets[i]
+        selected_paths = self.find_selected_files()
+        for i in range(len(selected_paths) - 1, -1, -1):
+            if selected_paths[i] is None:
+                print("Dataset not found:", self.selected_filenames[i])
+                del selected_paths[i]
                 del self.selected_filenames[i]
 
-        print("# datasets to analyze:", len(selected_datasets))
-        if len(selected_datasets) % n_group_by_trials != 0:
-            print("Cannot group", len(selected_datasets), "trials into groups of", str(n_group_by_trials) + ".")
-        n_discard = int(len(selected_datasets) % n_group_by_trials)
+        print("# datasets to analyze:", len(selected_paths))
+        if len(selected_paths) % n_group_by_trials != 0:
+            print("Cannot group", len(selected_paths), "trials into groups of", str(n_group_by_trials) + ".")
+        n_discard = int(len(selected_paths) % n_group_by_trials)
         print("Discarding last", n_discard, "files.")
         if n_discard > 0:
-            del selected_datasets[-n_discard:]
+            del selected_paths[-n_discard:]
             del self.selected_filenames[-n_discard:]
-        print("New # datasets to analyze:", len(selected_datasets))
+        print("New # datasets to analyze:", len(selected_paths))
 
-        # binning and cropping
-        for i in range(len(selected_datasets)):
-            sd = selected_datasets[i]
-            if sd is None:
-                print("Dataset not found:", self.selected_filenames[i])
-            else:
-                print(self.cam_settings)
-                sd.clip_data(y_range=self.cam_settings['cropping'],
-                             t_range=self.get_t_cropping())
-                sd.bin_data(binning=self.binning)
-                sd.flatten_points(self.acqui_data.num_flatten_points)
-
-        # load data
-        datasets = [{'filename': self.selected_filenames[i],
-                     'raw_data': selected_datasets[i].get_data(),
-                     'meta': selected_datasets[i].get_meta(),
-                     'rli': selected_datasets[i].get_rli(),
-                     'fp_data': selected_datasets[i].get_fp_data()}
-                    for i in range(len(selected_datasets))]
-
-        # print("fp data array shape:", datasets[0]['fp_data'].shape)
-
-        for i in range(len(datasets)):
-            data = datasets[i]
-            # if we're a lot (>1) off for image dimension, auto-correct
-            if data['raw_data'].shape[2] > data['raw_data'].shape[3] + 1:
-                print("Large auto-correct cropping", data['raw_data'].shape,
-                      "binning:", self.binning,
-                      "crop margin:", self.cam_settings['cropping'])
-                diff = data['raw_data'].shape[2] - data['raw_data'].shape[3]
-                d = int(diff / 2)
-                data['raw_data'] = data['raw_data'][:, :, d:-d, :]
-            elif data['raw_data'].shape[3] > data['raw_data'].shape[2] + 1:
-                print("Large auto-correct cropping", data['raw_data'].shape,
-                      "binning:", self.binning,
-                      "crop margin:", self.cam_settings['cropping'])
-                diff = data['raw_data'].shape[3] - data['raw_data'].shape[2]
-                d = int(diff / 2)
-                data['raw_data'] = data['raw_data'][:, :, :, d:-d]
-            # if we're just one off for image dimension, small adjustment now
-            if data['raw_data'].shape[2] - data['raw_data'].shape[3] == 1:
-                print("One-off auto-correct cropping")
-                data['raw_data'] = data['raw_data'][:, :, :-1, :]
-            elif data['raw_data'].shape[3] - data['raw_data'].shape[2] == 1:
-                print("One-off auto-correct cropping")
-                data['raw_data'] = data['raw_data'][:, :, :, :-1]
-
-            data['rli_high_cp'] = np.copy(data['raw_data'][0, 0, :, :]).astype(np.uint16)
-
-            # view frames
-            if i % 10 == 0 and not no_plot:
-                fig, axes = plt.subplots(1, 2)
-                axes[0].imshow(data['raw_data'][0, 0, :, :], cmap='gray')
-                axes[1].imshow(data['raw_data'][0, -1, :, :], cmap='jet')
-                plt.show()
-
-                plt.subplots()
-                plt.plot(data['raw_data'][0, :, 0, 0])
-
-            # final check
-            if data['raw_data'].shape[2] != data['raw_data'].shape[3]:
-                raise Exception("PhotoZ will not work with non-square array!" + str(data['raw_data'].shape) +
-                                " Adjust cropping and/or binning")
-
-        # Fill in missing metadata as needed
-        mm = MissingMetadata(n_group_by_trials,
-                             self.acqui_data.record_no,
-                             self.cam_settings,
-                             self.assign_ascending_recording_numbers)
-        for data in datasets:
-            mm.fill(data, self.acqui_data.slice_no, self.acqui_data.location_no)
-
-        if self.apply_preprocess:
-            for data in datasets:
-                # Apply baseline correction here. Because PhotoZ chokes on baseline correcting TurboSM data
-                tr = Tracer()
-                # data inversing
-                data['raw_data'] = -data['raw_data']
-
-                # Need to subtract off the low-frequency voltage drift. First-order correction
-                tr.correct_background(data['meta'], data['raw_data'])
-
-        for i in range(len(datasets)):
-            data = datasets[i]
-
-            # normalize raw data to 12-bit range
-            data['fp_data'] = normalize_bit_range(data['fp_data'])
-            data['raw_data'] = normalize_bit_range(data['raw_data'])
-
-            # view frames
-            if i % 10 == 0 and not no_plot:
-                fig, axes = plt.subplots(1, 2)
-                print(data['raw_data'].shape)
-                axes[0].imshow(data['raw_data'][0, 0, :, :], cmap='jet')
-                axes[1].imshow(data['raw_data'][0, -1, :, :], cmap='jet')
-                plt.show()
-
-        # resize FP data
-        for i in range(len(datasets)):
-            data = datasets[i]
-            meta = data['meta']
-            fp_data = data['fp_data']
-
-            fp_data_final = np.zeros((1, fp_data.shape[0], meta['num_fp_pts']))
-            fp_data_final[0, :, :fp_data.shape[1]] = fp_data[:, :]
-            data['fp_data'] = np.swapaxes(fp_data_final, 2, 1)[:, :, :]
-
-        # group data by trials
+        # group data by trials, and write each trial into its slot of the group's ZDA file
         print("n_group_by_trials:", n_group_by_trials)
-        if n_group_by_trials > 1:
-            tg = TrialGrouper(n_group_by_trials)
-            datasets = tg.make_groupings(datasets)
-
-        # Write data
-        zda_writer = ZDA_Writer()
-        files_created = []
-        for data in datasets:
-            meta = data['meta']
-            raw_data = data['raw_data']
-            rli = data['rli']
-            fp_data = data['fp_data']
-            if self.filename_PhotoZ_format:
-                slic = str(meta['slice_number'])
-                if len(slic) < 2:
-                    slic = "0" + slic
-                loc = str(meta['location_number'])
-                if len(loc) < 2:
-                    loc = "0" + loc
-                rec = str(meta['record_number'])
-                if len(rec) < 2:
-                    rec = "0" + rec
-                data['filename'] = slic + "_" + loc + "_" + rec
-
-            zda_writer.write_zda_to_file(raw_data, meta, data['filename'] + ".zda", rli, fp_data)
-            files_created.append(data['filename'] + ".zda")
-            print("Written to " + data['filename'] + ".zda")
-
-        # move created files to target directory
         target_dir = self.get_data_dir(no_date=False) + "/converted_zda"
-        previous_dir = os.getcwd()
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
-        try:
-            for f in files_created:
-                os.rename(previous_dir + "/" + f, target_dir + "/" + f)
-        except Exception as e:
-            print(e)
-            print("Could not move some or all files to selected directory."
-                  " Look in", previous_dir, "instead.")
-            return
-        print("Created file(s) in", target_dir, "(moved from", previous_dir + ")")
-        print(files_created, "number datasets:", len(datasets))
+        converter = self.get_tsm_converter()
+        path_groups, filename_groups = converter.group_files(selected_paths, self.selected_filenames)
+        files_created = []
+        for i_group in range(len(path_groups)):
+            stats = converter.convert_group(path_groups[i_group], filename_groups[i_group], i_group,
+                                            out_dir=target_dir, no_plot=no_plot)
+            files_created.append(os.path.basename(stats['zda_file']))
+        print("Created file(s) in", target_dir)
+        print(files_created, "number datasets:", len(files_created))
 
     def set_convert_files_switch(self, **kwargs):
         self.should_convert_files = kwargs['values']
@@ -916,6 +846,8 @@ class Controller:
             enable_spatial_filter=self.enable_headless_spatial_filter,
             spatial_filter_sigma=self.headless_spatial_filter_sigma,
             binning_factor=self.headless_binning_factor,
+            export_format=self.export_format_options[self.export_format_idx].lower(),
+            num_export_workers=self.num_export_workers,
             headless_mode=self.get_headless_export_mode(),
             data_dir=self.get_data_dir(),
             progress=self.progress,
@@ -971,6 +903,7 @@ class Controller:
 
     def set_save_attributes(self, data):
         self.__dict__.update(data)
+        PreprocessCache.set_default_disk_cache(self.enable_preprocess_disk_cache)
 
     def generate_ppr_catalog(self, **kwargs):
         ppr = PairedPulseExporter(self.get_data_dir())
@@ -1060,6 +993,16 @@ class Controller:
     def set_binning_factor(self, **kwargs):
         self.headless_binning_factor = kwargs["value"]
 
+    def set_export_format_idx(self, **kwargs):
+        self.export_format_idx = self.export_format_options.index(kwargs["values"])
+
+    def set_num_export_workers(self, **kwargs):
+        self.num_export_workers = kwargs["value"]
+
+    def set_preprocess_disk_cache(self, **kwargs):
+        self.enable_preprocess_disk_cache = kwargs["values"]
+        PreprocessCache.set_default_disk_cache(self.enable_preprocess_disk_cache)
+
     def set_roi_annotator_brush_size(self, **kwargs):
         self.roi_annotator_brush_size = kwargs["value"]
 
@@ -0,0 +1,164 @@
+import os
+import copy
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.automation import FileDetector
+
+
+class ConversionWorker:
+    """ Converts TSM/TBN files to ZDA in the background while the next trials are recorded.
+        A detection thread collects complete .tsm/.tbn pairs (see FileDetector) into trial groups
+        of n_trials files and queues them; a conversion thread hands each queued group to a separate
+        worker process and archives its files, so a recording's ZDA file is ready shortly after its
+        last trial. Parsing and writing run in the worker process, so they do not compete with the
+        acquisition loop for the GIL, and the worker process runs at lowered OS priority.
+
+        Trial groups are numbered from converter.record_no in the order they are queued. The
+        record numbers are not written back: after finish() or cancel(), n_groups is the number
+        of record numbers used. The queue holds at most max_queued_groups groups. """
+
+    def __init__(self, data_dir, out_dir, n_trials, converter,
+                 archive_dir=None,
+                 archive_file=None,
+                 max_queued_groups=2,
+                 low_priority=True,
+                 final_wait=3):
+        self.data_dir = data_dir
+        self.out_dir = out_dir
+        self.n_trials = n_trials
+        self.converter = converter  # TSM_Converter of the first trial group
+        self.archive_dir = archive_dir
+        self.archive_file = archive_file  # archive_file(tsm_file, dst_file)
+        self.low_priority = low_priority
+        self.final_wait = final_wait  # seconds without new files before detection ends after finish()
+
+        self.file_detector = FileDetector(directory=data_dir)
+        self.jobs = queue.Queue(maxsize=max_queued_groups)
+        self.recording_done = threading.Event()
+        self.cancel_event = threading.Event()
+        self.threads = []
+        self.n_groups = 0  # trial groups queued, only changed by the detection thread
+        self.files_created = []
+
+    def start(self):
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        self.threads = [threading.Thread(target=self.detect_groups, daemon=True),
+                        threading.Thread(target=self.convert_groups, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def finish(self):
+        """ Recording is done: convert the remaining complete groups, then return """
+        self.recording_done.set()
+        for thread in self.threads:
+            thread.join()
+        print("Created file(s) in", self.out_dir)
+        print(self.files_created, "number datasets:", len(self.files_created))
+
+    def cancel(self):
+        """ Stop detecting and drop the queued groups. The group being converted is finished """
+        self.cancel_event.set()
+        self.recording_done.set()
+        for thread in self.threads:
+            thread.join()
+
+    def detect_groups(self):
+        new_files = []
+        self.file_detector.start_watching()
+        try:
+            while not self.cancel_event.is_set():
+                # after the recording, stop once no new file has shown up for final_wait seconds
+                timeout = self.final_wait if self.recording_done.is_set() else 1
+                found = self.file_detector.wait_for_new_files(timeout=timeout)
+                new_files += self.file_detector.get_unprocessed_file_list()
+                new_files.sort()
+                while len(new_files) >= self.n_trials:
+                    if not self.submit(new_files[:self.n_trials]):
+                        return
+                    new_files = new_files[self.n_trials:]
+                if self.recording_done.is_set() and not found:
+                    break
+            if len(new_files) > 0:
+                print("Cannot group", len(new_files), "trials into groups of", str(self.n_trials) + ".",
+                      "Leaving unconverted:", new_files)
+        finally:
+            self.file_detector.stop_watching()
+            self.put_job(None)
+
+    def submit(self, paths):
+        """ Queue one trial group under the next record number, waiting while the queue is full.
+            False if cancelled """
+        print("Queueing", len(paths), "file(s) for conversion:", paths)
+        converter = copy.copy(self.converter)
+        converter.record_no = self.converter.record_no + self.n_groups
+        self.n_groups += 1
+        return self.put_job((converter, paths))
+
+    def put_job(self, job):
+        while True:
+            if self.cancel_event.is_set() and job is not None:
+                return False
+            try:
+                self.jobs.put(job, timeout=0.5)
+                return True
+            except queue.Full:
+                if self.cancel_event.is_set() and job is None:
+                    # conversion thread is stopping anyway; make room for the end marker
+                    self.drop_queued_jobs()
+
+    def drop_queued_jobs(self):
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except queue.Empty:
+            pass
+
+    def convert_groups(self):
+        executor = ProcessPoolExecutor(max_workers=1,
+                                       initializer=init_conversion_worker,
+                                       initargs=(self.low_priority,))
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None or self.cancel_event.is_set():
+                    return
+                converter, paths = job
+                try:
+                    self.convert_group(executor, converter, paths)
+                except Exception as e:
+                    print(e)
+                    print("Error while converting", paths, "- files left in place.")
+        finally:
+            executor.shutdown()
+
+    def convert_group(self, executor, converter, paths):
+        # this thread only waits for the worker process
+        stats = executor.submit(converter.convert_group, paths, paths, 0, self.out_dir, True).result()
+        self.files_created.append(os.path.basename(stats['zda_file']))
+
+        # auto-archive processed files
+        if self.archive_dir is not None and self.archive_file is not None:
+            for tsm_file in paths:
+                self.archive_file(tsm_file, self.archive_dir + "/" + os.path.basename(tsm_file))
+
+
+def init_conversion_worker(low_priority):
+    if low_priority:
+        lower_process_priority()
+
+
+def lower_process_priority():
+    """ Lower the OS scheduling priority of the calling (worker) process """
+    try:
+        if os.name == 'nt':
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            below_normal_priority_class = 0x4000
+            kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), below_normal_priority_class)
+        else:
+            os.nice(10)
+    except Exception as e:
+        print("Could not lower conversion process priority:", e)
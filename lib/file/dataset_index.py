@@ -0,0 +1,183 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+
+from lib.utilities import parse_date
+
+
+class DatasetIndex:
+    """ Persistent SQLite index of the files under data directories (ZDA, ROI/electrode .dat, shuffle,
+        TIF, ... files), so the data tree does not have to be re-listed on every pass.
+
+        A directory's entries are re-read only when its mtime has changed since it was indexed, so a
+        refresh costs one stat per directory. Within refresh_interval seconds of that check, a directory
+        is taken from the index without touching the file system, so the lookups of one export or
+        analysis run share a single pass over the tree. walk() and listdir() are drop-in replacements
+        for os.walk() and os.listdir(); find_files() queries files by extension, date and the
+        slice/location/record parsed from names like 01_02_03.zda.
+
+        for_data_dir() keeps one index file per data directory in default_index_dir (local, since
+        SQLite locking is unreliable on network shares); set_default_index_dir() moves it. """
+
+    schema_version = 2
+
+    # directories modified this recently may still get entries within the same mtime tick; re-list them
+    mtime_margin_ns = 2 * 10 ** 9
+
+    default_index_dir = os.path.join(os.path.expanduser("~"), ".tsm_to_zda", "dataset_index")
+
+    def __init__(self, index_file=None, refresh_interval=30):
+        if index_file is None:
+            index_file = os.path.join(self.default_index_dir, "dataset_index.sqlite")
+        self.index_file = index_file
+        self.refresh_interval = refresh_interval
+        self.connection = None
+        self.checked = {}  # directory key -> time.monotonic() of its last mtime check
+
+    @classmethod
+    def for_data_dir(cls, data_dir, **kwargs):
+        """ Index with its own file for data_dir, in default_index_dir """
+        if data_dir is None:
+            return cls(**kwargs)
+        key = cls.get_key(data_dir)
+        name = re.sub(r"[^\w\-]", "_", os.path.basename(key.rstrip("\\/")))
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+        return cls(os.path.join(cls.default_index_dir, name + "_" + digest + ".sqlite"), **kwargs)
+
+    @classmethod
+    def set_default_index_dir(cls, index_dir):
+        cls.default_index_dir = index_dir
+
+    def __getstate__(self):
+        # each process opens its own connection
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def get_connection(self):
+        if self.connection is None:
+            index_dir = os.path.dirname(self.index_file)
+            if len(index_dir) > 0 and not os.path.exists(index_dir):
+                os.makedirs(index_dir, exist_ok=True)
+            self.connection = sqlite3.connect(self.index_file, timeout=30)
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.schema_version:
+                # index of an older layout: start over
+                self.connection.executescript("""
+                    DROP TABLE IF EXISTS dirs;
+                    DROP TABLE IF EXISTS entries;
+                    PRAGMA user_version = %d;
+                """ % self.schema_version)
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, scanned_ns INTEGER);
+                CREATE TABLE IF NOT EXISTS entries (dir TEXT, name TEXT, is_dir INTEGER, is_link INTEGER, ext TEXT,
+                                                    slice_no INTEGER, location_no INTEGER, record_no INTEGER);
+                CREATE INDEX IF NOT EXISTS entries_dir ON entries (dir);
+                CREATE INDEX IF NOT EXISTS entries_ext ON entries (ext);
+            """)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @staticmethod
+    def get_key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    @staticmethod
+    def parse_recording_ids(name):
+        """ (slice, location, record) of names like 01_02_03.zda or 01_02_03_rois.dat, else Nones """
+        match = re.match(r"(\d+)_(\d+)_(\d+)(?:\D|$)", name)
+        if match is None:
+            return None, None, None
+        return tuple(int(x) for x in match.groups())
+
+    def scan_dir(self, path, key, mtime_ns):
+        """ Re-list one directory into the index, keeping the os.scandir order """
+        entries = []
+        for entry in os.scandir(path):
+            try:
+                is_dir = entry.is_dir()
+                is_link = entry.is_symlink()
+            except OSError:
+                is_dir, is_link = False, False
+            ext = '' if is_dir else os.path.splitext(entry.name)[1].lower()
+            entries.append((key, entry.name, int(is_dir), int(is_link), ext) + self.parse_recording_ids(entry.name))
+        connection = self.get_connection()
+        with connection:
+            connection.execute("DELETE FROM entries WHERE dir = ?", (key,))
+            connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+            connection.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (key, mtime_ns, time.time_ns()))
+
+    def refresh_dir(self, path, force=False):
+        """ Make sure the index of directory path is current, checking its mtime unless that was
+            done in the last refresh_interval seconds (or force). Returns its key """
+        key = self.get_key(path)
+        now = time.monotonic()
+        if not force and key in self.checked and now - self.checked[key] < self.refresh_interval:
+            return key
+        mtime_ns = os.stat(path).st_mtime_ns
+        row = self.get_connection().execute("SELECT mtime_ns, scanned_ns FROM dirs WHERE path = ?",
+                                            (key,)).fetchone()
+        if row is None or row[0] != mtime_ns or row[1] - mtime_ns < self.mtime_margin_ns:
+            self.scan_dir(path, key, mtime_ns)
+        self.checked[key] = now
+        return key
+
+    def get_entries(self, path):
+        """ (names of subdirectories, names of files, names of symlinked subdirectories) in directory path """
+        key = self.refresh_dir(path)
+        rows = self.get_connection().execute("SELECT name, is_dir, is_link FROM entries WHERE dir = ? ORDER BY rowid",
+                                             (key,)).fetchall()
+        dirs = [name for name, is_dir, _ in rows if is_dir]
+        files = [name for name, is_dir, _ in rows if not is_dir]
+        links = set(name for name, is_dir, is_link in rows if is_dir and is_link)
+        return dirs, files, links
+
+    def listdir(self, path, force=False):
+        """ Like os.listdir(path). force re-checks the directory even if it was checked recently """
+        key = self.refresh_dir(path, force=force)
+        rows = self.get_connection().execute("SELECT name FROM entries WHERE dir = ? ORDER BY rowid",
+                                             (key,)).fetchall()
+        return [row[0] for row in rows]
+
+    def walk(self, top):
+        """ Like os.walk(top) (top-down): yields (dirpath, dirnames, filenames). Each directory is listed
+            when it is reached, and dirnames may be modified in place to prune the walk. As with os.walk,
+            symlinked directories are listed in dirnames but not walked into, so link cycles terminate. """
+        try:
+            dirs, files, links = self.get_entries(top)
+        except OSError:
+            return
+        yield top, dirs, files
+        for name in dirs:
+            if name not in links:
+                yield from self.walk(os.path.join(top, name))
+
+    def find_files(self, top, ext=None, date=None, slice_no=None, location_no=None, record_no=None,
+                   recursive=True):
+        """ (dirpath, filename, slice, location, record) of the files under top (only in top if not
+            recursive), in walk order. ext (e.g. '.zda'), date (as parse_date returns it for dirpath)
+            and the recording ids, if given, select the files. Ids are None for names without them """
+        dir_order = {}  # key -> (position in walk order, dirpath)
+        for dirpath, dirs, files in self.walk(top):
+            if date is None or parse_date(dirpath) == date:
+                dir_order[self.get_key(dirpath)] = (len(dir_order), dirpath)
+            if not recursive:
+                break
+        if len(dir_order) == 0:
+            return []
+
+        query = "SELECT dir, name, slice_no, location_no, record_no, rowid FROM entries WHERE is_dir = 0"
+        params = []
+        for column, value in [('ext', ext), ('slice_no', slice_no),
+                              ('location_no', location_no), ('record_no', record_no)]:
+            if value is not None:
+                query += " AND " + column + " = ?"
+                params.append(value)
+        rows = [row for row in self.get_connection().execute(query, params) if row[0] in dir_order]
+        rows.sort(key=lambda row: (dir_order[row[0]][0], row[5]))
+        return [(dir_order[row[0]][1],) + tuple(row[1:5]) for row in rows]
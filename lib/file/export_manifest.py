@@ -0,0 +1,104 @@
+import hashlib
+import os
+import pickle
+
+
+class ExportManifest:
+    """ Persistent record of the summary CSV rows of each exported recording, together with
+        the state (mtime, size and content hash) of the files the rows were built from.
+        Lets the summary CSV be regenerated by rebuilding only the recordings whose files changed.
+
+        Also records the export map of each data subdirectory, keyed on the subdirectory's listing,
+        so regenerating the summary only rebuilds the maps of new or changed subdirectories. """
+
+    version = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.recordings = {}  # recording key -> {'settings', 'files', 'rows'}
+        self.subdirs = {}  # subdir -> {'listing', 'settings', 'export_map'}
+        self.is_modified = False
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    saved = pickle.load(f)
+                if saved.get('version') == self.version:
+                    self.recordings = saved['recordings']
+                    self.subdirs = saved['subdirs']
+            except Exception as e:
+                print("Could not read export manifest", filename, "- rebuilding it:", e)
+
+    @staticmethod
+    def hash_file(filename, block_size=1 << 20):
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            block = f.read(block_size)
+            while len(block) > 0:
+                h.update(block)
+                block = f.read(block_size)
+        return h.hexdigest()
+
+    @staticmethod
+    def get_file_state(filename, old_state=None):
+        """ (mtime, size, hash) of filename, or None if it does not exist.
+            The hash is reused from old_state if mtime and size are unchanged """
+        if filename is None or not os.path.exists(filename):
+            return None
+        st = os.stat(filename)
+        if old_state is not None and old_state[0] == st.st_mtime_ns and old_state[1] == st.st_size:
+            return old_state
+        return st.st_mtime_ns, st.st_size, ExportManifest.hash_file(filename)
+
+    def get_rows(self, key, filenames, settings, unchecked_files=()):
+        """ Return the saved rows of recording key, or None if its settings or the
+            content of any of its files changed since the rows were saved.
+            Files in unchecked_files must match by name only and are not stat'ed """
+        entry = self.recordings.get(key)
+        if entry is None or entry['settings'] != settings or set(entry['files']) != set(filenames):
+            return None
+        for filename in filenames:
+            if filename in unchecked_files:
+                continue
+            old_state = entry['files'][filename]
+            state = self.get_file_state(filename, old_state)
+            if (state is None) != (old_state is None):
+                return None
+            if state is not None and state[2] != old_state[2]:
+                return None
+            if state != old_state:
+                # touched but same content: remember the new mtime to skip hashing next time
+                entry['files'][filename] = state
+                self.is_modified = True
+        return entry['rows']
+
+    def set_rows(self, key, filenames, settings, rows):
+        self.recordings[key] = {'settings': settings,
+                                'files': {filename: self.get_file_state(filename) for filename in filenames},
+                                'rows': rows}
+        self.is_modified = True
+
+    def get_subdir_map(self, subdir, listing, settings):
+        """ Return the saved export map of subdir, or None if its listing or the settings changed """
+        entry = self.subdirs.get(subdir)
+        if entry is None or entry['listing'] != listing or entry['settings'] != settings:
+            return None
+        return entry['export_map']
+
+    def set_subdir_map(self, subdir, listing, settings, export_map):
+        self.subdirs[subdir] = {'listing': listing, 'settings': settings, 'export_map': export_map}
+        self.is_modified = True
+
+    def clear_subdir_maps(self):
+        """ Forget all subdirectory export maps, e.g. before exported files are rewritten in place """
+        if len(self.subdirs) > 0:
+            self.subdirs = {}
+            self.is_modified = True
+
+    def save(self):
+        if not self.is_modified:
+            return
+        tmp_filename = self.filename + ".part"
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({'version': self.version, 'recordings': self.recordings, 'subdirs': self.subdirs}, f)
+        os.replace(tmp_filename, self.filename)
+        self.is_modified = False
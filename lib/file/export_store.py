@@ -0,0 +1,63 @@
+import os
+import numpy as np
+
+
+class ExportStore:
+    """ Binary store of one recording's exported trace values, traces and maps,
+        saved as a single .npz file with one array per key (trace type + ROI set).
+        Arrays are kept in memory until save() is called. """
+
+    # separates the store filename from the array key in export references
+    key_separator = "::"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.arrays = {}
+        self.is_modified = False
+        if os.path.exists(filename):
+            with np.load(filename) as npz:
+                self.arrays = {k: npz[k] for k in npz.files}
+
+    @staticmethod
+    def is_reference(reference):
+        return ExportStore.key_separator in reference
+
+    @staticmethod
+    def make_reference(filename, key):
+        """ A filename-like string naming one array in the store """
+        return filename + ExportStore.key_separator + key
+
+    @staticmethod
+    def split_reference(reference):
+        filename, key = reference.rsplit(ExportStore.key_separator, 1)
+        return filename, key
+
+    @staticmethod
+    def load_reference(reference):
+        """ Load the array named by a reference (a 'store.npz::key' entry of the summary CSV),
+            reading only that array: trace values per ROI, traces as ROIs x points, maps as 2-D arrays """
+        filename, key = ExportStore.split_reference(reference)
+        with np.load(filename) as npz:
+            if key not in npz.files:
+                raise FileNotFoundError("No array " + key + " in export store " + filename)
+            return npz[key]
+
+    def put(self, key, arr):
+        self.arrays[key] = np.asarray(arr)
+        self.is_modified = True
+
+    def get(self, key):
+        if key not in self.arrays:
+            raise FileNotFoundError("No array " + key + " in export store " + self.filename)
+        return self.arrays[key]
+
+    def save(self):
+        """ Write all arrays to the .npz file. Written under a temporary name and renamed,
+            so an interrupted save never leaves a truncated store. """
+        if not self.is_modified:
+            return
+        tmp_filename = self.filename + ".part"
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **self.arrays)
+        os.replace(tmp_filename, self.filename)
+        self.is_modified = False
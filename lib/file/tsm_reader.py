@@ -1,13 +1,22 @@
 import os
 import struct
 import numpy as np
+from collections import namedtuple
 
 
 # RedshirtImaging website says it works with ImageJ, which supports:
 #   https://imagej.nih.gov/ij/docs/guide/146-7.html#sub:Native-Formats
+# Parsed FITS header of a TSM file: image dimensions, exposure (ms) and byte offset of the image block
+TSM_Header = namedtuple('TSM_Header', ['width', 'height', 'num_pts', 'int_pts', 'data_offset'])
+
+
 class TSM_Reader():
 
-    def __init__(self):
+    fits_block_size = 2880
+    fits_card_size = 80
+    header_cache = {}  # (path, size, mtime) -> TSM_Header, shared by all readers
+
+    def __init__(self, use_memmap=True):
 
         self.width = None
         self.height = None
@@ -17,6 +26,7 @@ class TSM_Reader():
         self.fp_arr = None
         self.dark_frame = None
         self.metadata = {}
+        self.use_memmap = use_memmap
         
     def get_dim(self):
         return [self.num_pts, self.width, self.height]
@@ -24,36 +34,72 @@ class TSM_Reader():
     def get_int_pts(self):
         return self.int_pts
 
+    @classmethod
+    def read_header(cls, filename):
+        """ Parse the FITS header into a TSM_Header, reading it from disk only once per file version """
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if key in cls.header_cache:
+            return cls.header_cache[key]
+
+        width, height, num_pts, int_pts = None, None, None, None
+        data_offset = 0
+        with open(filename, 'rb') as file:
+            is_end = False
+            while not is_end:
+                block = file.read(cls.fits_block_size)
+                if len(block) < cls.fits_block_size:
+                    raise ValueError(filename + " ended before the end of its header")
+                data_offset += cls.fits_block_size
+                for i in range(0, cls.fits_block_size, cls.fits_card_size):
+                    card = block[i:i + cls.fits_card_size].decode('ascii', errors='replace')
+                    keyword = card[:8].strip()
+                    value = card[10:].split('/')[0].strip()
+                    if keyword == "END":
+                        is_end = True
+                        break
+                    if keyword == "NAXIS1":
+                        width = int(value)
+                    elif keyword == "NAXIS2":
+                        height = int(value)
+                    elif keyword == "NAXIS3":
+                        num_pts = int(value)
+                    elif keyword == "EXPOSURE":
+                        int_pts = float(value) * 1000  # ms
+
+        header = TSM_Header(width, height, num_pts, int_pts, data_offset)
+        cls.header_cache[key] = header
+        return header
+
     def load_tsm(self, filename):
+        """ Map the image block without reading it: cropping the images in time or rows (e.g. Dataset.get_data's
+            t_range) only pages in the kept frames/rows. Frames are stored row by row, so a column crop (the
+            camera cropping in y_range) still reads every row. The small dark frame and TBN data are read into memory. """
         print(filename, "to be treated as TSM file to open")
 
-        file = open(filename, 'rb')
-        header = str(file.read(2880))
-
-        # header parsing
-        header = [x.strip() for x in header.split(" ") if x != "=" and len(x) > 0]
-        for i in range(len(header)):
-            if header[i] == "NAXIS1":
-                self.width = int(header[i+1])
-            if header[i] == "NAXIS2":
-                self.height = int(header[i+1])
-            if header[i] == "NAXIS3":
-                self.num_pts = int(header[i+1])
-            if header[i] == "EXPOSURE=":
-                self.int_pts = float(header[i+1]) * 1000 # ms
+        header = self.read_header(filename)
+        self.width, self.height, self.num_pts, self.int_pts = header.width, header.height, header.num_pts, header.int_pts
 
         self.metadata['number_of_trials'] = 1
 
         print("Reading file as", self.num_pts, "images of size", self.width, "x", self.height)
 
-        self.images = np.fromfile(file,
-                                dtype=np.int16,
-                                count=self.num_pts * self.width * self.height).reshape(self.num_pts, self.height, self.width)
-        self.images = self.images.reshape((1,)+self.images.shape)
-        self.dark_frame = np.fromfile(file,
-                                dtype=np.int16,
-                                count=self.width * self.height).reshape(self.height, self.width)
-        file.close()
+        image_shape = (self.num_pts, self.height, self.width)
+        image_bytes = 2 * self.num_pts * self.height * self.width
+        if self.use_memmap:
+            self.images = np.memmap(filename, dtype=np.int16, mode='r',
+                                    offset=header.data_offset, shape=image_shape)
+        else:
+            with open(filename, 'rb') as file:
+                file.seek(header.data_offset, 0)
+                self.images = np.fromfile(file, dtype=np.int16,
+                                          count=self.num_pts * self.width * self.height).reshape(image_shape)
+        self.images = self.images.reshape((1,) + self.images.shape)
+        with open(filename, 'rb') as file:
+            file.seek(header.data_offset + image_bytes, 0)
+            self.dark_frame = np.fromfile(file,
+                                          dtype=np.int16,
+                                          count=self.width * self.height).reshape(self.height, self.width)
 
         tbn_filename = filename.split(".tsm")[0] + ".tbn"
         return self.load_tbn(tbn_filename, self.num_pts)
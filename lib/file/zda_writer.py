@@ -2,25 +2,17 @@ import struct
 import numpy as np
 
 from lib.file.file_writer import FileWriter
+from ZDA_Adventure.zda_reader import ZDA_Reader
 
 
 class ZDA_Writer:
 
+    # header as written by PhotoLib's Controller::saveRecControl: ZDA_Reader.header_fields, then depth
+    header_format = '<BhhhiBBhiq10fiii'
+
     def __init__(self):
         pass
 
-    @staticmethod
-    def pack_binary_data(data, bytes_type):
-        if bytes_type == 'c':
-            data = bytes(str(data), "utf-8")
-        elif bytes_type in ['H', 'i', 'f', 'q']:
-            data = int(data)
-
-        endianness = "<" if bytes_type in ['i', 'f', 'q'] else ">"
-
-        bytes_type = bytes(endianness + bytes_type, "utf-8")
-        return struct.pack(bytes_type, data)
-
     @staticmethod
     def write_zda_to_file_c_interface(images, metadata, filename, rli, fp_array):
         fw = FileWriter()
@@ -59,112 +51,151 @@ class ZDA_Writer:
         # rliLow, rliHigh, rliMax, sliceNo, locNo, recNo, program, int_trials)
 
     def write_zda_to_file(self, images, metadata, filename, rli, fp_array):
-        self.write_zda_to_file_c_interface(images, metadata, filename, rli, fp_array)
-        '''
-        try:
-            self.write_zda_to_file_c_interface(images, metadata, filename, rli, fp_array)
-        except Exception as e:
-            print(e)
-            # print("Writing ZDA directly instead.")
-            # self.write_zda_to_file_directly(images, metadata, filename, rli, fp_array)
-            '''
+        self.write_zda_to_file_numpy(images, metadata, filename, rli, fp_array)
 
-    def overwrite_all_except_meta_header(self, images, metadata, filename, rli, fp_array):
-        """ overwrite only the RLI frames of the ZDA file. """
-        file = open(filename, 'r+b')
-        shSize = 'H'  # 2
-        file.seek(1024, 0)
-        file.truncate()
-        # RLI
-        num_fp_pts = 4
-        num_diodes = metadata['raw_width'] * metadata['raw_height']
-        for rli_type in ['rli_low', 'rli_high', 'rli_max']:
-            for i in range(num_diodes):
-                file.write(self.pack_binary_data(rli[rli_type][i], shSize))
-            for i in range(num_fp_pts):
-                file.write(self.pack_binary_data(0, shSize))
+    @staticmethod
+    def pack_header(header_values):
+        """ Pack the metadata header (in ZDA_Reader.header_fields order, plus depth)
+            and zero-pad it to the 1024-byte header block """
+        values = list(header_values)
+        i_time = ZDA_Reader.header_fields.index('time_RecControl')
+        if isinstance(values[i_time], bytes):
+            values[i_time] = int.from_bytes(values[i_time], "little")
+        header = struct.pack(ZDA_Writer.header_format, *values)
+        return header.ljust(ZDA_Reader.header_size, b'\0')
 
-        for i in range(metadata['number_of_trials']):
-            for jw in range(metadata['raw_width']):
-                for jh in range(metadata['raw_height']):
-                    for k in range(metadata['points_per_trace']):
-                        file.write(self.pack_binary_data(images[i, k, jw, jh], shSize))
+    @staticmethod
+    def get_c_interface_header_values(metadata, num_trials, num_pts, width, height):
+        """ Header values exactly as PhotoLib's Controller::saveRecControl writes them """
+        return [5, metadata['slice_number'], metadata['location_number'], metadata['record_number'],
+                metadata['camera_program'], num_trials, metadata['interval_between_trials'], 1, num_pts, 1,
+                0, 0, 0, 1000,
+                100, 1, 0, 0,
+                0, metadata['interval_between_samples'],
+                width, height, 2]
 
-        print("wrote", metadata['points_per_trace'], "points for", metadata['raw_width'], "x", metadata['raw_height'],
-              "x", metadata['number_of_trials'],
-              "px")
+    @staticmethod
+    def get_metadata_header_values(metadata):
+        """ Header values taken from the metadata dict """
+        return [metadata[k] for k in ZDA_Reader.header_fields] + [2]
+
+    @staticmethod
+    def write_rli_blocks(file, rli, num_diodes):
+        """ Write the three RLI frames, zero-padded if only given for the image pixels """
+        for rli_type in ['rli_low', 'rli_high', 'rli_max']:
+            rli_frame = np.zeros(num_diodes, dtype='<u2')
+            rli_values = np.asarray(rli[rli_type]).reshape(-1)[:num_diodes]
+            rli_frame[:rli_values.size] = rli_values
+            rli_frame.tofile(file)
 
-        if fp_array is not None:
-            print(fp_array.shape)
-            for _ in range(metadata['number_of_trials']):
+    @staticmethod
+    def write_trial_block(file, images, fp_array, trial_block):
+        """ Write one trial's image + FP traces at the current position of file.
+            images shape (t, x, y); fp_array shape (num_fp_pts, t) or None for zeros.
+            trial_block is a reusable (num_diodes, t) unsigned short buffer. Values are cast
+            to unsigned shorts exactly as the C interface's uint16 buffer does. """
+        num_pts, width, height = images.shape
+        num_px = width * height
+        # (t, x, y) -> (x, y, t) so each diode's trace is contiguous
+        trial_block[:num_px] = np.transpose(images, (1, 2, 0)).reshape(num_px, num_pts)
+        if fp_array is None:
+            trial_block[num_px:] = 0
+        else:
+            trial_block[num_px:] = np.asarray(fp_array).reshape(-1, num_pts)
+        trial_block.tofile(file)
 
-                for i in range(num_fp_pts):
-                    for k in range(metadata['points_per_trace']):
-                        file.write(self.pack_binary_data(fp_array[k, i], shSize))
+    @staticmethod
+    def write_data_blocks(file, images, rli, fp_array, num_fp_pts):
+        """ Write the RLI frames and the per-trial image + FP traces in PhotoZ's on-disk layout
+            (see ZDA_Reader), starting at the current position of file.
+            images shape (trial, t, x, y); fp_array shape (trial, num_fp_pts, t) or None for zeros. """
+        num_trials, num_pts, width, height = images.shape
+        num_diodes = width * height + num_fp_pts
 
-        file.close()
+        ZDA_Writer.write_rli_blocks(file, rli, num_diodes)
+        trial_block = np.zeros((num_diodes, num_pts), dtype='<u2')
+        for i in range(num_trials):
+            ZDA_Writer.write_trial_block(file, images[i], None if fp_array is None else fp_array[i], trial_block)
 
-    def write_zda_to_file_directly(self, images, metadata, filename, rli, fp_array):
-        file = open(filename, 'wb')
-
-        # data type sizes in bytes
-        chSize = 'c'  # 1
-        shSize = 'H'  # 2
-        nSize = 'i'  # 4
-        tSize = 'q'  # 8
-        fSize = 'f'  # 4
-
-        file.write(self.pack_binary_data(metadata['version'], chSize))
-        file.write(self.pack_binary_data(metadata['slice_number'], shSize))
-        file.write(self.pack_binary_data(metadata['location_number'], shSize))
-        file.write(self.pack_binary_data(metadata['record_number'], shSize))
-        file.write(self.pack_binary_data(metadata['camera_program'], nSize))
-
-        file.write(self.pack_binary_data(metadata['number_of_trials'], chSize))
-        file.write(self.pack_binary_data(metadata['interval_between_trials'], chSize))
-        file.write(self.pack_binary_data(metadata['acquisition_gain'], shSize))
-        file.write(self.pack_binary_data(metadata['points_per_trace'], nSize))
-        file.write(self.pack_binary_data(metadata['time_RecControl'], tSize))
-
-        file.write(self.pack_binary_data(metadata['reset_onset'], fSize))
-        file.write(self.pack_binary_data(metadata['reset_duration'], fSize))
-        file.write(self.pack_binary_data(metadata['shutter_onset'], fSize))
-        file.write(self.pack_binary_data(metadata['shutter_duration'], fSize))
-
-        file.write(self.pack_binary_data(metadata['stimulation1_onset'], fSize))
-        file.write(self.pack_binary_data(metadata['stimulation1_duration'], fSize))
-        file.write(self.pack_binary_data(metadata['stimulation2_onset'], fSize))
-        file.write(self.pack_binary_data(metadata['stimulation2_duration'], fSize))
-
-        file.write(self.pack_binary_data(metadata['acquisition_onset'], fSize))
-        file.write(self.pack_binary_data(metadata['interval_between_samples'], fSize))
-        file.write(self.pack_binary_data(metadata['raw_width'], nSize))
-        file.write(self.pack_binary_data(metadata['raw_height'], nSize))
-        
-        num_fp_pts = 4
-        num_diodes = metadata['raw_width'] * metadata['raw_height'] + num_fp_pts
-
-        file.seek(1024, 0)
-        # RLI
-        for rli_type in ['rli_low', 'rli_high', 'rli_max']:
-            for i in range(num_diodes):
-                file.write(self.pack_binary_data(rli[rli_type][i], shSize))
+    def open_zda_stream(self, metadata, filename, rli):
+        """ Start a ZDA file to be filled one trial at a time; see ZDA_TrialStream """
+        return ZDA_TrialStream(metadata, filename, rli)
 
+    def write_zda_to_file_numpy(self, images, metadata, filename, rli, fp_array):
+        """ Pure-NumPy equivalent of write_zda_to_file_c_interface: byte-identical output without PhotoLib.dll """
+        num_trials, num_pts, width, height = images.shape
+        header_values = self.get_c_interface_header_values(metadata, num_trials, num_pts, width, height)
+        with open(filename, 'wb') as file:
+            file.write(self.pack_header(header_values))
+            self.write_data_blocks(file, images, rli, fp_array, metadata['num_fp_pts'])
 
-        for i in range(metadata['number_of_trials']):
-            for jw in range(metadata['raw_width']):
-                for jh in range(metadata['raw_height']):
-                    for k in range(metadata['points_per_trace']):
-                        file.write(self.pack_binary_data(images[i,k,jw,jh], shSize))
-                        
-        print("wrote", metadata['points_per_trace'], "points for", metadata['raw_width'], "x", metadata['raw_height'] , "x", metadata['number_of_trials'],
+    def overwrite_all_except_meta_header(self, images, metadata, filename, rli, fp_array):
+        """ overwrite everything after the 1024-byte metadata header (RLI frames, images and FP data)
+            of the ZDA file. images shape (trial, t, x, y) """
+        num_fp_pts = metadata.get('num_fp_pts')
+        if num_fp_pts is None:
+            # keep the FP channel count of the file being overwritten
+            zda_reader = ZDA_Reader()
+            num_fp_pts = zda_reader.infer_num_fp_pts(filename, zda_reader.read_header(filename))
+        with open(filename, 'r+b') as file:
+            file.seek(ZDA_Reader.header_size, 0)
+            file.truncate()
+            self.write_data_blocks(file, images, rli, fp_array, num_fp_pts)
+
+        print("wrote", metadata['points_per_trace'], "points for", metadata['raw_width'], "x", metadata['raw_height'],
+              "x", metadata['number_of_trials'],
               "px")
 
-        print(fp_array.shape)
-        for _ in range(metadata['number_of_trials']):
+    def write_zda_to_file_directly(self, images, metadata, filename, rli, fp_array):
+        """ Like write_zda_to_file, but the header is taken from the metadata dict
+            instead of PhotoLib's defaults """
+        with open(filename, 'wb') as file:
+            file.write(self.pack_header(self.get_metadata_header_values(metadata)))
+            self.write_data_blocks(file, images, rli, fp_array, metadata['num_fp_pts'])
+
+        print("wrote", metadata['points_per_trace'], "points for", metadata['raw_width'], "x", metadata['raw_height'],
+              "x", metadata['number_of_trials'],
+              "px")
 
-            for i in range(num_fp_pts):
-                for k in range(metadata['points_per_trace']):
-                    file.write(self.pack_binary_data(fp_array[k, i], shSize))
 
-        file.close()
+class ZDA_TrialStream:
+    """ Writes a ZDA file one trial at a time, so that only one trial needs to be in memory.
+        The header and RLI frames are written up front (header as in write_zda_to_file),
+        and each trial is written straight into its slot of the file. """
+
+    def __init__(self, metadata, filename, rli):
+        self.filename = filename
+        self.num_trials = metadata['number_of_trials']
+        self.num_pts = metadata['points_per_trace']
+        self.width = metadata['raw_width']
+        self.height = metadata['raw_height']
+        self.num_fp_pts = metadata['num_fp_pts']
+        self.num_diodes = self.width * self.height + self.num_fp_pts
+        self.trial_block = np.zeros((self.num_diodes, self.num_pts), dtype='<u2')
+        self.trials_written = set()
+
+        header_values = ZDA_Writer.get_c_interface_header_values(metadata, self.num_trials, self.num_pts,
+                                                                 self.width, self.height)
+        self.file = open(filename, 'wb')
+        self.file.write(ZDA_Writer.pack_header(header_values))
+        ZDA_Writer.write_rli_blocks(self.file, rli, self.num_diodes)
+        self.data_offset = self.file.tell()
+
+    def write_trial(self, i_trial, images, fp_array):
+        """ Write trial i_trial. images shape (t, x, y); fp_array shape (num_fp_pts, t) or None """
+        if i_trial < 0 or i_trial >= self.num_trials:
+            raise IndexError("Trial " + str(i_trial) + " out of range for " + str(self.num_trials) + " trials")
+        if images.shape != (self.num_pts, self.width, self.height):
+            raise TypeError("Trial is wrong shape:", images.shape,
+                            "expected", (self.num_pts, self.width, self.height))
+        self.file.seek(self.data_offset + 2 * i_trial * self.num_diodes * self.num_pts, 0)
+        ZDA_Writer.write_trial_block(self.file, images, fp_array, self.trial_block)
+        self.trials_written.add(i_trial)
+
+    def is_complete(self):
+        return len(self.trials_written) == self.num_trials
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
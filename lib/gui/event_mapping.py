@@ -428,6 +428,18 @@ class EventMapping:
                 'function': gui.validate_and_pass_int,
                 'args': {'call': gui.controller.set_binning_factor}
             },
+            'export_format_idx': {
+                'function': gui.controller.set_export_format_idx,
+                'args': {}
+            },
+            'num_export_workers': {
+                'function': gui.validate_and_pass_int,
+                'args': {'call': gui.controller.set_num_export_workers}
+            },
+            'preprocess_disk_cache': {
+                'function': gui.controller.set_preprocess_disk_cache,
+                'args': {}
+            },
             'roi_annotator_brush_size': {
                 'function': gui.validate_and_pass_int,
                 'args': {'call': gui.controller.set_roi_annotator_brush_size},
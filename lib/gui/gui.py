@@ -181,6 +181,10 @@ class GUI:
         self.window['headless_spatial_filter'].update(save_dict['Controller'].get('enable_headless_spatial_filter', False))
         self.window['headless_spatial_filter_sigma'].update(save_dict['Controller'].get('headless_spatial_filter_sigma', 1.0))
         self.window['headless_binning_factor'].update(save_dict['Controller'].get('headless_binning_factor', 1))
+        export_format_options = self.controller.export_format_options
+        self.window['export_format_idx'].update(export_format_options[save_dict['Controller'].get('export_format_idx', 0)])
+        self.window['num_export_workers'].update(save_dict['Controller'].get('num_export_workers', 1))
+        self.window['preprocess_disk_cache'].update(save_dict['Controller'].get('enable_preprocess_disk_cache', False))
 
         self.window['roi_annotator_brush_size'].update(save_dict['Controller'].get('roi_annotator_brush_size', 4))
         self.window['roi_annotator_skip_existing'].update(save_dict['Controller'].get('roi_annotator_skip_existing', False))
@@ -548,6 +548,24 @@ class Layouts:
                 enable_events=True,
                 size=field_size,
                 tooltip='Binning factor for export. Binning is done by averaging within a square of side length of this field.'),],
+            [sg.Text("Export Format:"),
+             sg.Combo(gui.controller.export_format_options,
+                      enable_events=True,
+                      default_value=gui.controller.export_format_options[gui.controller.export_format_idx],
+                      key='export_format_idx',
+                      size=(8, 1),
+                      tooltip='DAT: one PhotoZ-compatible text file per export. ' +
+                      'NPZ: one binary file per recording (faster to write and summarize).')],
+            [sg.Text("Workers:"),
+             sg.InputText(key="num_export_workers",
+                default_text=str(gui.controller.num_export_workers),
+                enable_events=True,
+                size=field_size,
+                tooltip='Number of processes exporting ZDA files in parallel. Only used if Headless Mode is enabled.'),],
+            [sg.Checkbox("Disk Cache", size=checkbox_size, key="preprocess_disk_cache",
+                enable_events=True, default=gui.controller.enable_preprocess_disk_cache,
+                tooltip="When checked, keep preprocessed ZDA data in a cache in your home directory (up to 4 GB), " +
+                "so exports, movies and ROI tools can reuse it in later runs.")],
         ]
     
     def create_annotator_tab(self, gui):
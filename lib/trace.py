@@ -3,6 +3,8 @@ from sklearn.linear_model import LinearRegression
 from numpy.polynomial import polynomial
 import matplotlib.pyplot as plt
 
+from ZDA_Adventure.tools import Tools
+
 
 class Tracer:
 
@@ -121,23 +123,17 @@ class Tracer:
                                       - reg).reshape(-1)
 
     def correct_background(self, meta, raw_data, trial_dim=True):
-        """ subtract background drift off of all traces """
-        if trial_dim:
-            for i in range(raw_data.shape[0]):
-                for jw in range(raw_data.shape[2]):
-                    for jh in range(raw_data.shape[3]):
-                        self.subtract_noise(raw_data, i, jw, jh,
-                                              meta['interval_between_samples'],
-                                              plot=(i==0 and jw==0 and jh==0),
-                                              reg_type=3)
-        else:
-            for jw in range(raw_data.shape[1]):
-                for jh in range(raw_data.shape[2]):
-                    self.subtract_noise(raw_data, None, jw, jh,
-                                          meta['interval_between_samples'],
-                                          plot=False,
-                                          reg_type=3)
-
+        """ subtract background drift off of all traces: the same 8th-order polynomial fit as
+            polynomial_subtract_noise, solved for every pixel at once """
+        traces = raw_data
+        if not trial_dim:
+            traces = raw_data[np.newaxis]
+        H = Tools.polynomial_baseline_operator(traces.shape[1], 8)
+        for i in range(traces.shape[0]):
+            reg = np.tensordot(H, traces[i], axes=(1, 0))
+            if trial_dim and i == 0:
+                self.plot_trace(raw_data, 0, 0, meta['interval_between_samples'], trial=0, reg=reg[:, 0, 0])
+            traces[i] = traces[i] - reg
 
     def get_half_width(self, location, trace):
         """ Return TRACE's zeros on either side, if any, of location 
@@ -54,3 +54,28 @@ class TrialGrouper:
             if verbose:
                 print("# of trial-grouped datasets:", len(datasets))
         return trial_datasets
+
+    def group_filenames(self, filenames):
+        """ Split a list of per-trial files into lists of n_group_by_trials, dropping any leftover files """
+        n_groups = len(filenames) // self.n_group_by_trials
+        return [filenames[i * self.n_group_by_trials:(i + 1) * self.n_group_by_trials]
+                for i in range(n_groups)]
+
+    def stream_groupings(self, datasets, verbose=False):
+        """ Generator version of make_groupings for single-trial datasets: yields (i_trial, data)
+            one dataset at a time instead of concatenating whole groups in memory.
+            The first dataset of each group (i_trial == 0) carries the group's meta and RLI. """
+        trial_ct = 0
+        for data in datasets:
+            i_trial = trial_ct % self.n_group_by_trials
+            if data['raw_data'].shape[0] != 1:
+                raise TypeError("Trial axis is wrong shape:",
+                                data['raw_data'].shape)
+            if i_trial == 0:
+                data['meta']['number_of_trials'] = self.n_group_by_trials
+                if verbose:
+                    print("trial group", trial_ct // self.n_group_by_trials)
+            if verbose:
+                print("\t", data['filename'])
+            yield i_trial, data
+            trial_ct += 1
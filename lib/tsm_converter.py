@@ -0,0 +1,192 @@
+import os
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+
+from lib.utilities import Dataset, normalize_bit_range
+from lib.file.zda_writer import ZDA_Writer
+from lib.trace import Tracer
+from lib.trial_grouping import TrialGrouper
+from lib.missing_metadata import MissingMetadata
+
+
+class TSM_Converter:
+    """ Converts TSM/TBN recordings into ZDA files, one trial group per ZDA file.
+        Holds only plain settings, so a converter can be sent to worker processes
+        and each trial group converted independently. """
+
+    def __init__(self, cam_settings, binning, t_cropping, n_group_by_trials,
+                 slice_no, location_no, record_no,
+                 num_flatten_points=0,
+                 apply_preprocess=False,
+                 filename_PhotoZ_format=True,
+                 assign_ascending_recording_numbers=True):
+        self.cam_settings = cam_settings
+        self.binning = binning
+        self.t_cropping = list(t_cropping)
+        self.n_group_by_trials = n_group_by_trials
+        self.slice_no = slice_no
+        self.location_no = location_no
+        self.record_no = record_no
+        self.num_flatten_points = num_flatten_points
+        self.apply_preprocess = apply_preprocess
+        self.filename_PhotoZ_format = filename_PhotoZ_format
+        self.assign_ascending_recording_numbers = assign_ascending_recording_numbers
+
+    def group_files(self, paths, filenames):
+        """ Split the files into trial groups of n_group_by_trials, discarding the leftover files """
+        tg = TrialGrouper(self.n_group_by_trials)
+        return tg.group_filenames(paths), tg.group_filenames(filenames)
+
+    def get_group_record_no(self, i_group):
+        """ Record number of the i_group-th trial group, as MissingMetadata assigns it """
+        if self.assign_ascending_recording_numbers:
+            return self.record_no + i_group
+        return self.record_no
+
+    def get_zda_filename(self, filename, i_group):
+        if self.filename_PhotoZ_format:
+            slic = str(self.slice_no)
+            if len(slic) < 2:
+                slic = "0" + slic
+            loc = str(self.location_no)
+            if len(loc) < 2:
+                loc = "0" + loc
+            rec = str(self.get_group_record_no(i_group))
+            if len(rec) < 2:
+                rec = "0" + rec
+            return slic + "_" + loc + "_" + rec + ".zda"
+        return os.path.basename(filename) + ".zda"
+
+    def generate_datasets(self, paths, filenames, mm, no_plot=True, plot_offset=0):
+        """ Generator: load, crop/bin, flatten, fill metadata, preprocess and normalize one file at a time.
+            Yields single-trial data dicts ready for grouping and writing. """
+        for i in range(len(paths)):
+            sd = Dataset(paths[i])
+
+            # binning and cropping
+            print(self.cam_settings)
+            sd.clip_data(y_range=self.cam_settings['cropping'],
+                         t_range=self.t_cropping)
+            sd.bin_data(binning=self.binning)
+            sd.flatten_points(self.num_flatten_points)
+
+            # load data
+            data = {'filename': filenames[i],
+                    'raw_data': sd.get_data(),
+                    'meta': sd.get_meta(),
+                    'rli': sd.get_rli(),
+                    'fp_data': sd.get_fp_data()}
+            del sd
+
+            # if we're a lot (>1) off for image dimension, auto-correct
+            if data['raw_data'].shape[2] > data['raw_data'].shape[3] + 1:
+                print("Large auto-correct cropping", data['raw_data'].shape,
+                      "binning:", self.binning,
+                      "crop margin:", self.cam_settings['cropping'])
+                diff = data['raw_data'].shape[2] - data['raw_data'].shape[3]
+                d = int(diff / 2)
+                data['raw_data'] = data['raw_data'][:, :, d:-d, :]
+            elif data['raw_data'].shape[3] > data['raw_data'].shape[2] + 1:
+                print("Large auto-correct cropping", data['raw_data'].shape,
+                      "binning:", self.binning,
+                      "crop margin:", self.cam_settings['cropping'])
+                diff = data['raw_data'].shape[3] - data['raw_data'].shape[2]
+                d = int(diff / 2)
+                data['raw_data'] = data['raw_data'][:, :, :, d:-d]
+            # if we're just one off for image dimension, small adjustment now
+            if data['raw_data'].shape[2] - data['raw_data'].shape[3] == 1:
+                print("One-off auto-correct cropping")
+                data['raw_data'] = data['raw_data'][:, :, :-1, :]
+            elif data['raw_data'].shape[3] - data['raw_data'].shape[2] == 1:
+                print("One-off auto-correct cropping")
+                data['raw_data'] = data['raw_data'][:, :, :, :-1]
+
+            data['rli_high_cp'] = np.copy(data['raw_data'][0, 0, :, :]).astype(np.uint16)
+
+            # view frames
+            if (plot_offset + i) % 10 == 0 and not no_plot:
+                fig, axes = plt.subplots(1, 2)
+                axes[0].imshow(data['raw_data'][0, 0, :, :], cmap='gray')
+                axes[1].imshow(data['raw_data'][0, -1, :, :], cmap='jet')
+                plt.show()
+
+                plt.subplots()
+                plt.plot(data['raw_data'][0, :, 0, 0])
+
+            # final check
+            if data['raw_data'].shape[2] != data['raw_data'].shape[3]:
+                raise Exception("PhotoZ will not work with non-square array!" + str(data['raw_data'].shape) +
+                                " Adjust cropping and/or binning")
+
+            # Fill in missing metadata as needed
+            mm.fill(data, self.slice_no, self.location_no)
+
+            if self.apply_preprocess:
+                # Apply baseline correction here. Because PhotoZ chokes on baseline correcting TurboSM data
+                tr = Tracer()
+                # data inversing
+                data['raw_data'] = -data['raw_data']
+
+                # Need to subtract off the low-frequency voltage drift. First-order correction
+                tr.correct_background(data['meta'], data['raw_data'])
+
+            # normalize raw data to 12-bit range
+            data['fp_data'] = normalize_bit_range(data['fp_data'])
+            data['raw_data'] = normalize_bit_range(data['raw_data'])
+
+            # view frames
+            if (plot_offset + i) % 10 == 0 and not no_plot:
+                fig, axes = plt.subplots(1, 2)
+                print(data['raw_data'].shape)
+                axes[0].imshow(data['raw_data'][0, 0, :, :], cmap='jet')
+                axes[1].imshow(data['raw_data'][0, -1, :, :], cmap='jet')
+                plt.show()
+
+            # resize FP data
+            meta = data['meta']
+            fp_data = data['fp_data']
+            fp_data_final = np.zeros((1, fp_data.shape[0], meta['num_fp_pts']))
+            fp_data_final[0, :, :fp_data.shape[1]] = fp_data[:, :]
+            data['fp_data'] = np.swapaxes(fp_data_final, 2, 1)[:, :, :]
+
+            yield data
+
+    def convert_group(self, paths, filenames, i_group, out_dir=".", no_plot=True):
+        """ Convert one trial group into out_dir, streaming each trial into its slot of the ZDA file.
+            The file is written under a .part name and renamed when complete, so an interrupted
+            conversion never leaves a ZDA file that looks finished.
+            Returns the ZDA file path and timing stats. """
+        start_time = time.time()
+        zda_file = os.path.join(out_dir, self.get_zda_filename(filenames[0], i_group))
+        part_file = zda_file + ".part"
+
+        mm = MissingMetadata(self.n_group_by_trials,
+                             self.get_group_record_no(i_group),
+                             self.cam_settings,
+                             self.assign_ascending_recording_numbers)
+        datasets = self.generate_datasets(paths, filenames, mm, no_plot=no_plot,
+                                          plot_offset=i_group * self.n_group_by_trials)
+
+        tg = TrialGrouper(self.n_group_by_trials)
+        zda_writer = ZDA_Writer()
+        zda_stream = None
+        try:
+            for i_trial, data in tg.stream_groupings(datasets):
+                if i_trial == 0:
+                    zda_stream = zda_writer.open_zda_stream(data['meta'], part_file, data['rli'])
+                zda_stream.write_trial(i_trial, data['raw_data'][0], data['fp_data'][0])
+            zda_stream.close()
+            if not zda_stream.is_complete():
+                raise Exception("Only " + str(len(zda_stream.trials_written)) + " of " +
+                                str(self.n_group_by_trials) + " trials written to " + part_file)
+            os.replace(part_file, zda_file)
+        finally:
+            if zda_stream is not None:
+                zda_stream.close()
+        print("Written to " + zda_file)
+
+        return {'zda_file': zda_file,
+                'n_files': len(paths),
+                'n_bytes': sum([os.path.getsize(p) for p in paths]),
+                'seconds': time.time() - start_time}
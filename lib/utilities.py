@@ -27,14 +27,12 @@ from skimage.measure import block_reduce
 
 from lib.file.tsm_reader import TSM_Reader
 from lib.file.zda_writer import ZDA_Writer
+from ZDA_Adventure.zda_reader import ZDA_Reader
 from lib.trace import Tracer
 from lib.camera_settings import CameraSettings
 from lib.automation import AutoLauncher
 from lib.trial_grouping import TrialGrouper
 from lib.missing_metadata import MissingMetadata
-from lib.auto_GUI.auto_TSM import AutoTSM
-from lib.auto_GUI.auto_PhotoZ import AutoPhotoZ
-from lib.auto_GUI.auto_Pulser import AutoPulser
 
 
 ############################# Data load functions ##########################
@@ -241,80 +239,17 @@ class Dataset:
 
     def read_zda_to_df(self, zda_file):
         ''' Reads ZDA file to dataframe, and returns
-        metadata as a dict. 
-        ZDA files are a custom PhotoZ binary format that must be interpreted byte-
-        by-byte'''
-        file = open(zda_file, 'rb')
-        # data type sizes in bytes
-        chSize = 1
-        shSize = 2
-        nSize = 4
-        tSize = 8
-        fSize = 4
-
-        metadata = {}
-        metadata['version'] = (file.read(chSize))
-        metadata['slice_number'] = (file.read(shSize))
-        metadata['location_number'] = (file.read(shSize))
-        metadata['record_number'] = (file.read(shSize))
-        metadata['camera_program'] = (file.read(nSize))
-
-        metadata['number_of_trials'] = (file.read(chSize))
-        metadata['interval_between_trials'] = (file.read(chSize))
-        metadata['acquisition_gain'] = (file.read(shSize))
-        metadata['points_per_trace'] = (file.read(nSize))
-        metadata['time_RecControl'] = (file.read(tSize))
-
-        metadata['reset_onset'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['reset_duration'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['shutter_onset'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['shutter_duration'] = struct.unpack('f', (file.read(fSize)))[0]
-
-        metadata['stimulation1_onset'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['stimulation1_duration'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['stimulation2_onset'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['stimulation2_duration'] = struct.unpack('f', (file.read(fSize)))[0]
-
-        metadata['acquisition_onset'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['interval_between_samples'] = struct.unpack('f', (file.read(fSize)))[0]
-        metadata['raw_width'] = (file.read(nSize))
-        metadata['raw_height'] = (file.read(nSize))
-
-        # Bytes to Python data type
-        for k in metadata:
-            if k in ['interval_between_samples', ] or 'onset' in k or 'duration' in k:
-                pass  # any additional float processing can go here
-            elif k == 'time_RecControl':
-                pass  # TO DO: timestamp processing
-            else:
-                metadata[k] = int.from_bytes(metadata[k], "little")  # endianness
-
-        num_diodes = metadata['raw_width'] * metadata['raw_height']
-
-        file.seek(1024, 0)
-        # RLI 
-        rli = {}
-        rli['rli_low'] = [int.from_bytes(file.read(shSize), "little") for _ in range(num_diodes)]
-        rli['rli_high'] = [int.from_bytes(file.read(shSize), "little") for _ in range(num_diodes)]
-        rli['rli_max'] = [int.from_bytes(file.read(shSize), "little") for _ in range(num_diodes)]
-
-        raw_data = np.zeros((metadata['number_of_trials'],
-                             metadata['points_per_trace'],
-                             metadata['raw_width'],
-                             metadata['raw_height'])).astype(int)
-
-        for i in range(metadata['number_of_trials']):
-            for jw in range(metadata['raw_width']):
-                for jh in range(metadata['raw_height']):
-                    for k in range(metadata['points_per_trace']):
-                        pt = file.read(shSize)
-                        if not pt:
-                            print("Ran out of points.", len(raw_data))
-                            file.close()
-                            return None, metadata, None
-                        raw_data[i, k, jw, jh] = int.from_bytes(pt, "little")
-
-        file.close()
+        metadata as a dict.
+        ZDA files are a custom PhotoZ binary format; see ZDA_Reader for the layout '''
+        zr = ZDA_Reader(use_memmap=False)
+        is_complete = zr.load_zda(zda_file)
+        metadata = zr.get_meta()
+        if not is_complete:
+            return None, metadata, None
+
+        # Trials x Width x Height x Points -> Trials x Points x Width x Height
+        raw_data = np.transpose(zr.get_images(signed=False), (0, 3, 1, 2)).astype(int)
+        rli = {k: zr.get_rli()[k].astype(int) for k in zr.get_rli()}
         return raw_data, metadata, rli
 
 